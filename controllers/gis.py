@@ -2288,6 +2288,28 @@ def feature_query():
 
     return output
 
+# =============================================================================
+def tile():
+    """
+        Tiled features of a Feature Layer as GeoJSON, for low bandwidth:
+        /gis/tile/<layer_id>/<z>/<x>/<y>.geojson
+    """
+
+    try:
+        layer_id, z, x, y = [int(arg) for arg in request.args[:4]]
+    except ValueError:
+        raise HTTP(400, BADFORMAT)
+    if len(request.args) != 4 or z < 0 or z > 22 or \
+       not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTP(400, BADFORMAT)
+
+    output = gis.get_feature_tile(layer_id, z, x, y)
+    if output is None:
+        raise HTTP(404, T("Layer not found"))
+
+    response.headers["Content-Type"] = "application/json"
+    return output
+
 # =============================================================================
 def display_feature():
     """
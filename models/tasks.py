@@ -44,6 +44,25 @@ def gis_update_location_tree(feature, user_id=None):
 
 tasks["gis_update_location_tree"] = gis_update_location_tree
 
+# -----------------------------------------------------------------------------
+def gis_update_simplified(location_ids, user_id=None):
+    """
+        Cache the simplified geometries of locations which are not
+        cached yet (queued when a map request found them missing)
+
+        @param location_ids: list of gis_location IDs (in JSON format)
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task
+    for location_id in json.loads(location_ids):
+        gis.update_simplified(location_id, refresh=False)
+    return
+
+tasks["gis_update_simplified"] = gis_update_simplified
+
 # -----------------------------------------------------------------------------
 def sync_synchronize(repository_id, user_id=None, manual=False):
     """
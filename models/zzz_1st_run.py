@@ -152,6 +152,11 @@ if len(pop_list) > 0:
 
     # Synchronisation
     db.sync_config.insert() # Defaults are fine
+    if settings.get_sync_journal():
+        # Index for the overlap when reading ranges of the journal
+        tablename = s3base.S3SyncJournal.define_table()._tablename
+        field = "timestmp"
+        db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
 
     # Person Registry
     tablename = "pr_person"
@@ -178,6 +183,16 @@ if len(pop_list) > 0:
     tablename = "gis_location"
     field = "name"
     db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+    tablename = "gis_location_ancestor"
+    field = "location_id"
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+    field = "ancestor_id"
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+    tablename = "gis_location_simplified"
+    db.executesql("CREATE INDEX %s__idx on %s(location_id, tier);" % (tablename, tablename))
+
+    # Text index for searches (if enabled)
+    s3base.S3TextIndex.create_indexes()
 
     # Messaging Module
     if settings.has_module("msg"):
@@ -29,6 +29,8 @@
 
 __all__ = ["S3LocationModel",
            "S3LocationNameModel",
+           "S3LocationAncestorModel",
+           "S3LocationSimplifiedModel",
            "S3LocationTagModel",
            "S3LocationGroupModel",
            "S3LocationHierarchyModel",
@@ -233,7 +235,15 @@ class S3LocationModel(S3Model):
         location_id = S3ReusableField("location_id", table,
                                       sortby = "name",
                                       label = T("Location"),
-                                      represent = gis_location_represent,
+                                      represent = S3Represent("gis_location",
+                                                              gis_location_represent,
+                                                              fields=["name",
+                                                                      "level",
+                                                                      "parent",
+                                                                      "path",
+                                                                      "addr_street",
+                                                                      "lat",
+                                                                      "lon"]),
                                       widget = S3LocationSelectorWidget(),
                                       requires = IS_NULL_OR(IS_LOCATION_SELECTOR()),
                                       # Alternate simple Autocomplete (e.g. used by pr_person_presence)
@@ -269,6 +279,7 @@ class S3LocationModel(S3Model):
                         onvalidation=self.gis_location_onvalidation,
                         onaccept=self.gis_location_onaccept,
                         deduplicate=self.gis_location_deduplicate,
+                        text_index=["name"],
                         list_fields = ["id",
                                        "name",
                                        "level",
@@ -370,8 +381,14 @@ class S3LocationModel(S3Model):
             On Accept for GIS Locations (after DB I/O)
         """
 
-        # Update the Path (async if-possible)
         vars = form.vars
+        if "wkt" in vars:
+            # Drop the simplified geometries (re-built by the async task)
+            current.gis.delete_simplified(vars.id)
+        # Update the spatial index in this process
+        S3SpatialIndex.update(vars.id)
+
+        # Update the Path (async if-possible)
         feature = json.dumps(dict(id=vars.id,
                                   level=vars.get("level", False),
                                   ))
@@ -664,6 +681,72 @@ class S3LocationNameModel(S3Model):
         return Storage(
                 )
 
+# =============================================================================
+class S3LocationAncestorModel(S3Model):
+    """
+        Location Ancestors model
+        - closure table of the location hierarchy, maintained by
+          gis.update_location_tree, to look up the ancestors and the
+          descendants of a location with indexed joins
+    """
+
+    names = ["gis_location_ancestor"]
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Location Ancestors
+        #
+        tablename = "gis_location_ancestor"
+        table = self.define_table(tablename,
+                                  Field("location_id", "reference gis_location",
+                                        ondelete = "CASCADE"),
+                                  Field("ancestor_id", "reference gis_location",
+                                        ondelete = "CASCADE"),
+                                  # Level of the ancestor
+                                  Field("level", length=2),
+                                  # 1 = parent, 2 = grandparent etc
+                                  Field("depth", "integer"),
+                                  )
+
+        # ---------------------------------------------------------------------
+        # Pass variables back to global scope (s3db.*)
+        #
+        return Storage(
+                )
+
+# =============================================================================
+class S3LocationSimplifiedModel(S3Model):
+    """
+        Simplified Location Geometries model
+        - cache of the simplified WKT/GeoJSON of Line & Polygon locations
+          at several tolerances, maintained by gis.update_simplified, to
+          serve map layers without simplifying the geometries per request
+    """
+
+    names = ["gis_location_simplified"]
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Simplified Location Geometries
+        #
+        tablename = "gis_location_simplified"
+        table = self.define_table(tablename,
+                                  Field("location_id", "reference gis_location",
+                                        ondelete = "CASCADE"),
+                                  # Index of the tolerance in GIS.SIMPLIFY_TOLERANCES
+                                  Field("tier", "integer"),
+                                  Field("wkt", "text"),
+                                  Field("geojson", "text"),
+                                  )
+
+        # ---------------------------------------------------------------------
+        # Pass variables back to global scope (s3db.*)
+        #
+        return Storage(
+                )
+
 # =============================================================================
 class S3LocationTagModel(S3Model):
     """
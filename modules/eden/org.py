@@ -423,7 +423,9 @@ class S3OrganisationModel(S3Model):
                                                                   org_organisation_represent,
                                                                   orderby="org_organisation.name",
                                                                   sort=True)),
-                                          represent = org_organisation_represent,
+                                          represent = S3Represent("org_organisation",
+                                                                  org_organisation_represent,
+                                                                  bulk=org_organisation_bulk_represent),
                                           label = T("Organization"),
                                           comment = organisation_comment,
                                           ondelete = "RESTRICT",
@@ -497,6 +499,7 @@ class S3OrganisationModel(S3Model):
                   referenced_by = [(utablename, "organisation_id")],
                   search_method=organisation_search,
                   deduplicate=self.organisation_duplicate,
+                  text_index = ["name", "acronym"],
                   list_fields = ["id",
                                  "name",
                                  "acronym",
@@ -1192,8 +1195,10 @@ class S3SiteModel(S3Model):
                                   #readable = True,
                                   label = T("Facility"),
                                   default = auth.user.site_id if auth.is_logged_in() else None,
-                                  represent = lambda id: \
-                                    org_site_represent(id, show_link=True),
+                                  represent = S3Represent("org_site",
+                                                          org_site_represent,
+                                                          bulk=org_site_bulk_represent,
+                                                          show_link=True),
                                   orderby = "org_site.name",
                                   sort = True,
                                   # Comment these to use a Dropdown & not an Autocomplete
@@ -2216,6 +2221,55 @@ def org_organisation_represent(id, row=None, show_link=False,
 
     return represent
 
+# =============================================================================
+def org_organisation_bulk_represent(ids, show_link=False,
+                                    acronym=True, parent=True):
+    """
+        Represent many Organisations at once, same as
+        org_organisation_represent
+
+        @param ids: the org_organisation record IDs
+        @param show_link: whether to make the output into a hyperlink
+        @param acronym: whether to show any acronym present
+        @param parent: whether to show the parent Org for branches
+
+        @returns: dict {id: representation}
+    """
+
+    db = current.db
+    table = db.org_organisation
+    rows = db(table.id.belongs(ids)).select(table.id,
+                                            table.name,
+                                            table.acronym)
+
+    parents = {}
+    if parent:
+        btable = db.org_organisation_branch
+        ptable = table.with_alias("org_parent_organisation")
+        query = (btable.branch_id.belongs(ids)) & \
+                (ptable.id == btable.organisation_id)
+        branches = db(query).select(btable.branch_id, ptable.name)
+        for branch in branches:
+            branch_id = branch[btable.branch_id]
+            if branch_id not in parents:
+                parents[branch_id] = branch[ptable.name]
+
+    represents = {}
+    for row in rows:
+        id = row.id
+        represent = row.name
+        if id in parents:
+            represent = "%s > %s" % (parents[id], represent)
+        elif acronym and row.acronym:
+            represent = "%s (%s)" % (represent, row.acronym)
+        if show_link:
+            represent = A(represent,
+                          _href = URL(c="org", f="organisation",
+                                      args=id))
+        represents[id] = represent
+
+    return represents
+
 # =============================================================================
 def org_site_represent(id, row=None, show_link=True):
     """
@@ -2275,6 +2329,59 @@ def org_site_represent(id, row=None, show_link=True):
 
     return represent
 
+# =============================================================================
+def org_site_bulk_represent(ids, show_link=True):
+    """
+        Represent many Facilities at once, same as org_site_represent,
+        with one query per instance type rather than two per site
+
+        @param ids: the org_site record IDs
+        @param show_link: whether to render the representations as links
+
+        @returns: dict {site_id: representation}
+    """
+
+    db = current.db
+    s3db = current.s3db
+    table = s3db.org_site
+    pkey = table._id
+
+    rows = db(pkey.belongs(ids)).select(pkey, table.instance_type)
+    instance_types = {}
+    for row in rows:
+        instance_type = row.instance_type
+        if instance_type in instance_types:
+            instance_types[instance_type].append(row[pkey.name])
+        else:
+            instance_types[instance_type] = [row[pkey.name]]
+
+    represents = {}
+    for instance_type, site_ids in instance_types.items():
+        instance_type_nice = table.instance_type.represent(instance_type)
+        try:
+            itable = s3db[instance_type]
+        except:
+            continue
+        records = db(itable.site_id.belongs(site_ids)).select(itable.id,
+                                                              itable.site_id,
+                                                              itable.name)
+        c, f = instance_type.split("_", 1)
+        for r in records:
+            site_id = r.site_id
+            if site_id in represents:
+                continue
+            if r.name:
+                represent = "%s (%s)" % (r.name, instance_type_nice)
+            else:
+                represent = "[site %d] (%s)" % (site_id, instance_type_nice)
+            if show_link:
+                # extension="" removes the .aaData extension in paginated views
+                represent = A(represent,
+                              _href = URL(c=c, f=f, args=[r.id], extension=""))
+            represents[site_id] = represent
+
+    return represents
+
 # =============================================================================
 def org_rheader(r, tabs=[]):
     """ Organisation/Office page headers """
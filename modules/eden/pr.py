@@ -734,6 +734,11 @@ class S3PersonModel(S3Model):
                         onvalidation=self.pr_person_onvalidation,
                         search_method=pr_person_search,
                         deduplicate=self.person_deduplicate,
+                        text_index=["pe_label",
+                                    "first_name",
+                                    "middle_name",
+                                    "last_name",
+                                    "local_name"],
                         main="first_name",
                         extra="last_name"
                         )
@@ -751,7 +756,9 @@ class S3PersonModel(S3Model):
                                                           orderby="pr_person.first_name",
                                                           sort=True,
                                                           error_message=T("Person must be specified!"))),
-                                    represent = pr_person_represent,
+                                    represent = S3Represent("pr_person",
+                                                            pr_person_represent,
+                                                            bulk=pr_person_bulk_represent),
                                     label = T("Person"),
                                     comment = person_id_comment,
                                     ondelete = "RESTRICT",
@@ -2993,6 +3000,28 @@ def pr_person_represent(person_id, show_link=False):
                  _href = URL(c="hrm", f="person", args=[person_id]))
     return name
 
+# =============================================================================
+def pr_person_bulk_represent(person_ids, show_link=False):
+    """
+        Represent many Persons at once, same as pr_person_represent
+
+        @param person_ids: the pr_person record IDs
+        @param show_link: whether to make the output into a hyperlink
+
+        @returns: dict {person_id: representation}
+    """
+
+    names = s3_fullname(list(person_ids))
+    if not isinstance(names, dict):
+        # No persons found
+        return {}
+    if show_link:
+        for person_id, name in names.items():
+            names[person_id] = A(name,
+                                 _href = URL(c="hrm", f="person",
+                                             args=[person_id]))
+    return names
+
 # =============================================================================
 def pr_person_comment(title=None, comment=None, caller=None, child=None):
 
@@ -151,6 +151,11 @@ class SyncDataModel(S3Model):
                              Field("accept_push", "boolean",
                                    default=False,
                                    label=T("Accept Push")),
+                             Field("page_size", "integer",
+                                   default=S3Sync.PAGE_SIZE,
+                                   requires=IS_EMPTY_OR(
+                                                IS_INT_IN_RANGE(1, None)),
+                                   label=T("Page Size")),
                              *s3_meta_fields())
 
         # Field configuration
@@ -186,6 +191,10 @@ class SyncDataModel(S3Model):
                                         _title="%s|%s" % (
                                             T("Accept Push"),
                                             T("Accept unsolicited data transmissions from the repository.")))
+        table.page_size.comment = DIV(_class="tooltip",
+                                      _title="%s|%s" % (
+                                        T("Page Size"),
+                                        T("Number of records to transfer per request. Use smaller pages for slow or unreliable connections: an interrupted synchronization resumes after the last completed page.")))
 
         # CRUD Strings
         ADD_REPOSITORY = T("Add Repository")
@@ -325,6 +334,37 @@ class SyncDataModel(S3Model):
                                    default = sync_policies.NEWER,
                                    label = T("Conflict Policy"),
                                    represent = sync_policy_represent),
+                             # Progress of interrupted transfers
+                             Field("started_on", "datetime",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
+                             Field("pull_cursor",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
+                             Field("pull_until", "integer",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
+                             Field("push_cursor",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
+                             Field("push_until", "integer",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
+                             # Change journal sequence numbers synchronized
+                             # up to (of this repository and of the peer)
+                             Field("last_seq", "integer",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
+                             Field("remote_seq", "integer",
+                                   readable=False,
+                                   writable=False,
+                                   update=""),
                              *s3_meta_fields())
 
         # Field configuration
@@ -444,6 +484,12 @@ class SyncDataModel(S3Model):
                                    label=T("Remote Error"),
                                    represent=lambda opt: opt and T("yes") or ("no")),
                              Field("message", "text"),
+                             Field("bytes", "integer",
+                                   label=T("Bytes Transferred")),
+                             Field("throughput", "double",
+                                   label=T("Throughput (bytes/s)"),
+                                   represent=lambda v: v is not None and \
+                                                       "%.0f" % v or NONE),
                              *s3_meta_fields())
 
         # CRUD Strings
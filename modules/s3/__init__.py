@@ -50,6 +50,8 @@ from s3resource import *
 # Authentication, Authorization, Accounting
 from s3aaa import *
 
+from s3index import *
+
 # Utilities, Validators and Widgets
 # These names are also imported into the global namespace in
 # 00_db.py in order to access them without the s3base prefix:
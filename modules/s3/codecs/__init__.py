@@ -32,3 +32,4 @@
 
 from xls import *
 from pdf import *
+from gis import *
@@ -0,0 +1,976 @@
+# -*- coding: utf-8 -*-
+
+"""
+    S3 GeoJSON, KML and GPX codecs
+
+    @copyright: 2012 (c) Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ["S3GeoJSON",
+           "S3KML",
+           "S3GPX",
+           ]
+
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
+from xml.sax.saxutils import escape
+
+from gluon import *
+from gluon.storage import Storage
+
+from ..s3codec import S3Codec
+from ..s3fields import S3Represent
+from ..s3utils import s3_get_foreign_key, s3_has_foreign_key
+
+# =============================================================================
+class S3GISCodec(S3Codec):
+    """
+        Base class for the map export formats, encoding the records
+        directly from the rows and the locations looked-up by
+        GIS.get_locations_and_popups instead of building an S3XML tree
+        and transforming it with the export stylesheet
+
+        encode() returns a generator of UTF-8 encoded chunks, or None if
+        the export needs the stylesheet (tables with special templates,
+        exports including other records with location references) - the
+        caller must then fall back to export_xml
+    """
+
+    # Tables with their own templates in the export stylesheet
+    SPECIAL = ("gis_location",)
+
+    # -------------------------------------------------------------------------
+    def encode(self, resource, **attr):
+        """
+            Encode a resource
+
+            @param resource: the S3Resource
+            @param attr: the export parameters (start, limit, msince,
+                         fields, references, mcomponents, rcomponents)
+
+            @returns: a generator of UTF-8 encoded chunks, or None
+        """
+
+        if resource.tablename in self.SPECIAL or \
+           attr.get("msince", None) is not None:
+            return None
+        return self.export(resource, **attr)
+
+    # -------------------------------------------------------------------------
+    def export(self, resource, **attr):
+        """
+            Export a resource, to be implemented by the subclass
+
+            @param resource: the S3Resource
+            @param attr: the export parameters
+
+            @returns: a generator of UTF-8 encoded chunks, or None
+        """
+
+        raise NotImplementedError
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def load(resource, start=None, limit=None, fields=None, references=None):
+        """
+            Load the records of the resource the same way as the S3XML
+            export does
+
+            @param resource: the S3Resource
+            @param start: index of the first record
+            @param limit: maximum number of records
+            @param fields: data fields to include (None for all)
+            @param references: foreign key fields to include (None for all)
+
+            @returns: Storage(rfields, dfields, results)
+        """
+
+        xml = current.xml
+
+        (rfields, dfields) = resource.split_fields(data=fields,
+                                                   references=references)
+        table = resource.table
+        if xml.filter_mci and "mci" in table.fields:
+            resource.add_filter(table.mci >= 0)
+        results = resource.count()
+        resource.load(start=start, limit=limit)
+        rows = resource._rows
+        if rows:
+            for fieldname in rfields:
+                S3Represent.setup(table[fieldname], rows)
+
+        return Storage(rfields=rfields,
+                       dfields=dfields,
+                       results=results)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def lookup(resource, fieldname, readable=False, extra=None):
+        """
+            Bulk-lookup the records referenced by a foreign key of the
+            loaded rows, which S3XML.rmap would look up one by one
+
+            @param resource: the S3Resource
+            @param fieldname: the foreign key field name
+            @param readable: only records the user is permitted to read
+                             (i.e. those which would be dereferenced)
+            @param extra: additional fields to select from the referenced
+                          table
+
+            @returns: dict {value: Row}, the rows with an additional
+                      attribute "_uid" for the exported UID (or None)
+        """
+
+        db = current.db
+        xml = current.xml
+        UID = xml.UID
+
+        table = resource.table
+        if fieldname not in table.fields:
+            return {}
+        ktablename, pkey, multiple = s3_get_foreign_key(table[fieldname])
+        if not ktablename or multiple or pkey not in (None, "id"):
+            return {}
+        ktable = current.s3db.table(ktablename)
+        if ktable is None or UID not in ktable.fields:
+            return {}
+
+        values = set()
+        for record in resource._rows:
+            value = record[fieldname]
+            if value is not None:
+                values.add(value)
+        if not values:
+            return {}
+
+        query = ktable._id.belongs(values)
+        if xml.DELETED in ktable.fields:
+            query &= (ktable[xml.DELETED] != True)
+        if xml.filter_mci and xml.MCI in ktable.fields:
+            query &= (ktable[xml.MCI] >= 0)
+        if readable:
+            accessible = current.auth.s3_accessible_query("read", ktable)
+            if accessible is not None:
+                query &= accessible
+        fields = [ktable._id, ktable[UID]]
+        if extra:
+            fields.extend([ktable[f] for f in extra if f in ktable.fields])
+        rows = db(query).select(*fields)
+
+        export_uid = xml.export_uid
+        references = {}
+        for row in rows:
+            uid = row[UID]
+            row._uid = uid and export_uid(uid) or None
+            references[row[ktable._id.name]] = row
+        return references
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def data_text(table, record, fieldname, fields):
+        """
+            The text of a <data> element in S3XML
+
+            @param table: the table
+            @param record: the record
+            @param fieldname: the field name
+            @param fields: the exported data fields
+
+            @returns: the XML-escaped text, or None if not exported
+        """
+
+        if fieldname not in fields or fieldname not in table.fields:
+            return None
+        value = record[fieldname]
+        if value is None:
+            return None
+
+        xml = current.xml
+        field = table[fieldname]
+        fieldtype = str(field.type)
+        if field.represent is not None and fieldtype != "id":
+            return xml.represent(table, fieldname, value)
+        if fieldtype == "datetime":
+            text = xml.encode_iso_datetime(value).decode("utf-8")
+        else:
+            text = str(field.formatter(value)).decode("utf-8")
+        return xml.xml_encode(text)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def reference_text(table, fieldname, value, cache):
+        """
+            The text of a <reference> element in S3XML
+
+            @param table: the table
+            @param fieldname: the field name
+            @param value: the field value
+            @param cache: dict to cache the representations in (the same
+                          value is typically referenced by many records)
+        """
+
+        if value in cache:
+            return cache[value]
+        xml = current.xml
+        field = table[fieldname]
+        if field.represent:
+            text = xml.represent(table, fieldname, value)
+        else:
+            text = xml.xml_encode(str(field.formatter(value)).decode("utf-8"))
+        cache[value] = text
+        return text
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def gis_attributes(resource,
+                       record,
+                       location,
+                       locations=None,
+                       marker_url=None,
+                       symbol=None,
+                       local=False):
+        """
+            The GIS attributes of a location reference, same as
+            S3XML.gis_encode adds them to the <reference> element
+
+            @param resource: the S3Resource
+            @param record: the referencing record
+            @param location: the referenced gis_location Row (with lat/lon)
+            @param locations: the locations dict from
+                              GIS.get_locations_and_popups
+            @param marker_url: the marker URL
+            @param symbol: the GPS symbol
+            @param local: use local URLs (for the Sahana Mapping client)
+
+            @returns: Storage of the attributes
+        """
+
+        request = current.request
+        xml = current.xml
+
+        latlons = None
+        geojsons = None
+        wkts = None
+        tooltips = None
+        if locations:
+            latlons = locations.get("latlons", None)
+            geojsons = locations.get("geojsons", None)
+            wkts = locations.get("wkts", None)
+            tooltips = locations.get("tooltips", None)
+
+        tablename = resource.tablename
+        record_id = record[resource.table._id.name]
+
+        attributes = Storage()
+        LatLon = None
+        polygon = False
+        if latlons and tablename in latlons:
+            LatLon = latlons[tablename].get(record_id, None)
+        elif geojsons and tablename in geojsons:
+            polygon = True
+            geojson = geojsons[tablename].get(record_id, None)
+            if geojson:
+                attributes.geometry = geojson
+        elif wkts and tablename in wkts:
+            polygon = True
+            attributes.wkt = wkts[tablename].get(record_id, None)
+        # else: polygons looked-up per record (see per_record_polygons)
+
+        if not LatLon and not polygon:
+            LatLon = (location.lat, location.lon)
+
+        if LatLon:
+            lat, lon = LatLon
+            if lat is None or lon is None:
+                # Cannot display on Map
+                return attributes
+            attributes.lat = "%.4f" % lat
+            attributes.lon = "%.4f" % lon
+            if marker_url:
+                attributes.marker = marker_url
+            if symbol:
+                attributes.sym = symbol
+
+        url = URL(request.controller, request.function).split(".", 1)[0]
+        if local:
+            url = "%s/%i.plain" % (url, record_id)
+        else:
+            url = "%s%s/%i" % (current.deployment_settings.get_base_public_url(),
+                               url,
+                               record_id)
+        attributes.url = url
+
+        if tooltips and tablename in tooltips:
+            tooltip = tooltips[tablename].get(record_id, None)
+            try:
+                tooltip = xml.xml_encode(tooltip).decode("utf-8")
+            except:
+                pass
+            else:
+                if tooltip:
+                    attributes.popup = tooltip
+
+        return attributes
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def per_record_polygons(resource, locations):
+        """
+            Check whether S3XML.gis_encode would look up the polygons per
+            record ("polygons" URL var without pre-calculated locations),
+            which is not supported by the native encoders
+
+            @param resource: the S3Resource
+            @param locations: the locations dict
+        """
+
+        if "polygons" not in current.request.get_vars:
+            return False
+        if locations:
+            tablename = resource.tablename
+            for key in ("latlons", "geojsons", "wkts"):
+                items = locations.get(key, None)
+                if items and tablename in items:
+                    return False
+        return True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def exports_other_locations(resource,
+                                references=None,
+                                mcomponents=None,
+                                rcomponents=None,
+                                skip_locations=True):
+        """
+            Check whether an export would include records other than the
+            primary records which reference locations - the KML and GPX
+            stylesheets export these too, so that only the stylesheet
+            produces the correct output then
+
+            @param resource: the S3Resource
+            @param references: foreign key fields to include (None for all)
+            @param mcomponents: components of the master resource to
+                                include (list of tablenames), empty list
+                                for all, None for none
+            @param rcomponents: components of referenced resources to
+                                include
+            @param skip_locations: ignore location references of
+                                   gis_location records
+
+            @returns: True if other location references would be exported
+        """
+
+        if rcomponents is not None:
+            return True
+
+        s3db = current.s3db
+        IGNORE = current.xml.FIELDS_TO_ATTRIBUTES
+
+        def location_fields(table):
+            fields = []
+            for f in table.fields:
+                if references is not None and f not in references:
+                    continue
+                if f in IGNORE or not s3_has_foreign_key(table[f]):
+                    continue
+                ktablename = s3_get_foreign_key(table[f])[0]
+                if ktablename == "gis_location":
+                    fields.append(f)
+            return fields
+
+        table = resource.table
+        if len(location_fields(table)) > 1:
+            # Records would be exported once per location
+            return True
+
+        # Tables of the records in the export (besides the primary table)
+        tables = []
+        if mcomponents is not None:
+            for component in resource.components.values():
+                if mcomponents and component.tablename not in mcomponents:
+                    continue
+                tables.append(component.table)
+                if component.link is not None:
+                    tables.append(component.link.table)
+
+        # Follow the references
+        seen = set(t._tablename for t in tables)
+        pending = [table] + tables
+        while pending:
+            t = pending.pop()
+            for f in t.fields:
+                if references is not None and f not in references:
+                    continue
+                if f in IGNORE or not s3_has_foreign_key(t[f]):
+                    continue
+                ktablename = s3_get_foreign_key(t[f])[0]
+                if not ktablename or ktablename in seen:
+                    continue
+                ktable = s3db.table(ktablename)
+                if ktable is None:
+                    continue
+                seen.add(ktablename)
+                tables.append(ktable)
+                pending.append(ktable)
+
+        for t in tables:
+            if skip_locations and t._tablename == "gis_location":
+                continue
+            if location_fields(t):
+                return True
+        return False
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def utf8(s):
+        """
+            Encode an output chunk as UTF-8
+
+            @param s: the chunk (str or unicode)
+        """
+
+        if isinstance(s, unicode):
+            return s.encode("utf-8")
+        return s
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def element(tag, text, indent):
+        """
+            Serialize a simple XML element like lxml's pretty printer
+
+            @param tag: the tag name
+            @param text: the text (will be escaped), None or empty for
+                         an empty element
+            @param indent: the indentation
+        """
+
+        if text:
+            return "%s<%s>%s</%s>\n" % (indent, tag, escape(text), tag)
+        else:
+            return "%s<%s/>\n" % (indent, tag)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def by_location(resource, field, references):
+        """
+            Group the loaded records by their location, in the order in
+            which the export stylesheet processes them
+
+            @param resource: the S3Resource
+            @param field: the location reference field name
+            @param references: the referenced locations {id: Row}
+
+            @returns: list of tuples (location, [records])
+        """
+
+        groups = {}
+        for record in resource._rows:
+            location_id = record[field]
+            if location_id not in references:
+                continue
+            location = references[location_id]
+            if not location._uid:
+                # Not linked to the <resource> of the location
+                continue
+            if location_id in groups:
+                groups[location_id].append(record)
+            else:
+                groups[location_id] = [record]
+        return [(references[location_id], groups[location_id])
+                for location_id in sorted(groups)]
+
+# =============================================================================
+class S3GeoJSON(S3GISCodec):
+    """
+        GeoJSON export for Map Layers, same output as
+        static/formats/geojson/export.xsl
+    """
+
+    SPECIAL = ("gis_location",
+               "gis_cache",
+               "gis_feature_query",
+               )
+
+    # -------------------------------------------------------------------------
+    def export(self, resource, **attr):
+        """
+            Export a resource as GeoJSON
+
+            @param resource: the S3Resource
+            @param attr: the export parameters
+
+            @returns: a generator of UTF-8 encoded chunks, or None
+        """
+
+        setup = self.load(resource,
+                          start=attr.get("start", None),
+                          limit=attr.get("limit", None),
+                          fields=attr.get("fields", None),
+                          references=attr.get("references", None))
+
+        gis = current.gis
+        get_vars = current.request.get_vars
+        tablename = resource.tablename
+        layer_id = get_vars.get("layer", None)
+        if layer_id:
+            # GIS Feature Layer
+            locations = gis.get_locations_and_popups(resource, layer_id)
+        elif tablename == "gis_theme_data":
+            # GIS Theme Layer
+            locations = gis.get_theme_geojson(resource)
+        else:
+            # e.g. Search results
+            locations = gis.get_locations_and_popups(resource)
+
+        if self.per_record_polygons(resource, locations):
+            return None
+        # WKT geometries are converted into GeoJSON by the stylesheet
+        if locations:
+            latlons = locations.get("latlons", None)
+            geojsons = locations.get("geojsons", None)
+            wkts = locations.get("wkts", None)
+            if not (latlons and tablename in latlons) and \
+               not (geojsons and tablename in geojsons) and \
+               wkts and wkts.get(tablename, None):
+                return None
+
+        return self.features(resource, setup, locations)
+
+    # -------------------------------------------------------------------------
+    def features(self, resource, setup, locations):
+        """
+            Generator for the GeoJSON output
+
+            @param resource: the S3Resource
+            @param setup: the export setup from load()
+            @param locations: the locations dict
+        """
+
+        dumps = json.dumps
+        rows = resource._rows
+
+        if not setup.results:
+            yield "{}"
+            return
+
+        features = self.encode_features(resource, setup, locations)
+        if len(rows) == 1:
+            feature = features.next()
+            yield dumps(feature) if feature else "{}"
+            return
+
+        delimiter = None
+        for feature in features:
+            if not feature:
+                continue
+            if delimiter is None:
+                yield '{"type": "FeatureCollection", "features": ['
+                delimiter = ", "
+            else:
+                yield delimiter
+            yield dumps(feature)
+        if delimiter is None:
+            yield '{"type": "FeatureCollection"}'
+        else:
+            yield "]}"
+
+    # -------------------------------------------------------------------------
+    def encode_features(self, resource, setup, locations):
+        """
+            Generator for the GeoJSON features, one per record (None for
+            records which can not be shown on the map)
+
+            @param resource: the S3Resource
+            @param setup: the export setup from load()
+            @param locations: the locations dict
+        """
+
+        xml_decode = self.xml_decode
+        data_text = self.data_text
+        reference_text = self.reference_text
+        gis_attributes = self.gis_attributes
+
+        table = resource.table
+        dfields = setup.dfields
+        theme = resource.tablename == "gis_theme_data"
+
+        field = "location_id"
+        if field in setup.rfields:
+            references = self.lookup(resource, field, extra=["lat", "lon"])
+        else:
+            references = {}
+        represent = {}
+
+        for record in resource._rows:
+
+            location = references.get(record[field], None)
+            if location is not None:
+                attributes = gis_attributes(resource, record, location,
+                                            locations=locations,
+                                            local=True)
+                uid = location._uid
+                if uid:
+                    text = reference_text(table, field, record[field],
+                                          represent)
+                else:
+                    text = None
+            elif not theme:
+                yield None
+                continue
+            else:
+                attributes = Storage()
+                uid = text = None
+
+            if theme:
+                # Theme Layer
+                feature = {"type": "Feature"}
+                geometry = self.geometry(attributes.geometry)
+                if geometry:
+                    feature["geometry"] = geometry
+                properties = {}
+                if record.uuid:
+                    properties["id"] = current.xml.export_uid(record.uuid)
+                name = xml_decode(text) or ""
+                value = xml_decode(data_text(table, record, "value",
+                                             dfields)) or ""
+                if name:
+                    properties["name"] = name
+                if value:
+                    properties["value"] = value
+                properties["popup"] = "%s: %s" % (name, value)
+                feature["properties"] = properties
+                yield feature
+                continue
+
+            name = xml_decode(data_text(table, record, "name", dfields))
+            if attributes.geometry:
+                # Pre-prepared GeoJSON
+                feature = {"type": "Feature"}
+                geometry = self.geometry(attributes.geometry)
+                if geometry:
+                    feature["geometry"] = geometry
+                if not name and text:
+                    name = xml_decode(text)
+            elif attributes.lon:
+                feature = {"type": "Feature",
+                           "geometry": {"type": "Point",
+                                        "coordinates": [attributes.lon,
+                                                        attributes.lat],
+                                        },
+                           }
+            else:
+                yield None
+                continue
+
+            properties = {}
+            if uid:
+                properties["id"] = uid
+            if name:
+                properties["name"] = name
+            for key in ("marker", "popup", "url"):
+                value = xml_decode(attributes[key])
+                if value:
+                    properties[key] = value
+            if properties:
+                feature["properties"] = properties
+            yield feature
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geometry(geojson):
+        """
+            Parse a pre-prepared GeoJSON geometry
+
+            @param geojson: the GeoJSON string
+        """
+
+        if not geojson:
+            return None
+        try:
+            return json.loads(geojson)
+        except:
+            return None
+
+# =============================================================================
+class S3KML(S3GISCodec):
+    """
+        KML export for Map Layers, same output as
+        static/formats/kml/export.xsl
+    """
+
+    SPECIAL = ("gis_location",
+               "hms_hospital",
+               "hms_shortage",
+               "hms_ctc_capability",
+               "hrm_human_resource",
+               "inv_inv_item",
+               "org_office",
+               "inv_warehouse",
+               )
+
+    # -------------------------------------------------------------------------
+    def export(self, resource, **attr):
+        """
+            Export a resource as KML
+
+            @param resource: the S3Resource
+            @param attr: the export parameters
+
+            @returns: a generator of UTF-8 encoded chunks, or None
+        """
+
+        references = attr.get("references", None)
+        if self.exports_other_locations(resource,
+                                        references=references,
+                                        mcomponents=attr.get("mcomponents", None),
+                                        rcomponents=attr.get("rcomponents", None)):
+            return None
+
+        setup = self.load(resource,
+                          start=attr.get("start", None),
+                          limit=attr.get("limit", None),
+                          fields=attr.get("fields", None),
+                          references=references)
+
+        gis = current.gis
+        request = current.request
+        marker = gis.get_marker(request.controller, request.function)
+        locations = gis.get_locations_and_popups(resource)
+        if self.per_record_polygons(resource, locations):
+            return None
+
+        marker_url = None
+        if marker:
+            image = marker.get("image", None)
+            if image:
+                marker_url = "%s/%s/static/img/markers/%s" % \
+                    (current.deployment_settings.get_base_public_url(),
+                     request.application,
+                     image)
+
+        return self.placemarks(resource, setup, locations, marker_url)
+
+    # -------------------------------------------------------------------------
+    def placemarks(self, resource, setup, locations, marker_url):
+        """
+            Generator for the KML output
+
+            @param resource: the S3Resource
+            @param setup: the export setup from load()
+            @param locations: the locations dict
+            @param marker_url: the marker URL
+        """
+
+        utf8 = self.utf8
+        element = self.element
+        data_text = self.data_text
+        gis_attributes = self.gis_attributes
+
+        yield "<?xml version='1.0' encoding='utf-8'?>\n" \
+              "<kml xmlns=\"http://www.opengis.net/kml/2.2\">\n" \
+              "  <Document>\n" \
+              "    <Folder>\n" \
+              "      <name>Sahana Eden Locations</name>\n"
+
+        field = "location_id"
+        if field in setup.rfields:
+            references = self.lookup(resource, field,
+                                     readable=True,
+                                     extra=["lat", "lon"])
+        else:
+            references = {}
+
+        manager = current.manager
+        if manager.s3.base_url:
+            base_url = "%s/%s/%s" % (manager.s3.base_url,
+                                     resource.prefix,
+                                     resource.name)
+        else:
+            base_url = "/%s/%s" % (resource.prefix, resource.name)
+
+        table = resource.table
+        pkey = table._id.name
+        for location, records in self.by_location(resource, field, references):
+            uid = escape(location._uid, {'"': "&quot;"})
+            for record in records:
+                attributes = gis_attributes(resource, record, location,
+                                            locations=locations,
+                                            marker_url=marker_url)
+                if not attributes.lon:
+                    # Skip records without LatLon
+                    continue
+                name = data_text(table, record, "name", setup.dfields)
+                url = "%s/%s" % (base_url, record[pkey])
+                yield utf8("".join((
+                    "      <Style id=\"%s\">\n" % uid,
+                    "        <IconStyle>\n",
+                    "          <Icon>\n",
+                    element("href", attributes.marker, "            "),
+                    "          </Icon>\n",
+                    "        </IconStyle>\n",
+                    "      </Style>\n",
+                    "      <Placemark>\n",
+                    element("name", name, "        "),
+                    "        <styleUrl>#%s</styleUrl>\n" % escape(location._uid),
+                    element("description", url, "        "),
+                    "        <Point>\n",
+                    "          <coordinates>%s,%s</coordinates>\n" % \
+                        (attributes.lon, attributes.lat),
+                    "        </Point>\n",
+                    "      </Placemark>\n",
+                    )))
+
+        yield "    </Folder>\n" \
+              "  </Document>\n" \
+              "</kml>\n"
+
+# =============================================================================
+class S3GPX(S3GISCodec):
+    """
+        GPX export for Map Layers, same output as
+        static/formats/gpx/export.xsl
+    """
+
+    SPECIAL = ("gis_location",
+               "hms_hospital",
+               )
+
+    # -------------------------------------------------------------------------
+    def export(self, resource, **attr):
+        """
+            Export a resource as GPX
+
+            @param resource: the S3Resource
+            @param attr: the export parameters
+
+            @returns: a generator of UTF-8 encoded chunks, or None
+        """
+
+        if self.per_record_polygons(resource, None):
+            return None
+
+        references = attr.get("references", None)
+        # The GPX stylesheet also exports locations referencing locations
+        if self.exports_other_locations(resource,
+                                        references=references,
+                                        mcomponents=attr.get("mcomponents", None),
+                                        rcomponents=attr.get("rcomponents", None),
+                                        skip_locations=False):
+            return None
+
+        setup = self.load(resource,
+                          start=attr.get("start", None),
+                          limit=attr.get("limit", None),
+                          fields=attr.get("fields", None),
+                          references=references)
+
+        gis = current.gis
+        request = current.request
+        marker = gis.get_marker(request.controller, request.function)
+        if marker:
+            symbol = marker.get("gps_marker", gis.DEFAULT_SYMBOL)
+        else:
+            symbol = gis.DEFAULT_SYMBOL
+
+        return self.waypoints(resource, setup, symbol)
+
+    # -------------------------------------------------------------------------
+    def waypoints(self, resource, setup, symbol):
+        """
+            Generator for the GPX output
+
+            @param resource: the S3Resource
+            @param setup: the export setup from load()
+            @param symbol: the GPS symbol
+        """
+
+        utf8 = self.utf8
+        element = self.element
+        data_text = self.data_text
+        reference_text = self.reference_text
+        gis_attributes = self.gis_attributes
+
+        bounds = current.gis.get_bounds()
+        yield "<?xml version='1.0' encoding='utf-8'?>\n" \
+              "<gpx xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" " \
+              "xmlns=\"http://www.topografix.com/GPX/1/1\" " \
+              "xsi:schemaLocation=\"http://www.topografix.com/GPX/1/1\n" \
+              "            http://www.topografix.com/GPX/1/1/gpx.xsd\" " \
+              "version=\"1.1\" creator=\"Sahana Eden\">\n" \
+              "  <bounds minlat=\"%s\" minlon=\"%s\" maxlat=\"%s\" maxlon=\"%s\"/>\n" % \
+              (bounds["min_lat"], bounds["min_lon"],
+               bounds["max_lat"], bounds["max_lon"])
+
+        field = "location_id"
+        if field in setup.rfields:
+            references = self.lookup(resource, field,
+                                     readable=True,
+                                     extra=["lat", "lon"])
+        else:
+            references = {}
+        if "organisation_id" in setup.rfields:
+            organisations = self.lookup(resource, "organisation_id")
+        else:
+            organisations = {}
+        represent = {}
+
+        table = resource.table
+        dfields = setup.dfields
+        for location, records in self.by_location(resource, field, references):
+            for record in records:
+                attributes = gis_attributes(resource, record, location,
+                                            symbol=symbol)
+                desc = ""
+                organisation = organisations.get(record.organisation_id, None) \
+                               if organisations else None
+                if organisation is not None and organisation._uid:
+                    text = reference_text(table, "organisation_id",
+                                          record.organisation_id,
+                                          represent)
+                    if text:
+                        desc = "%s " % text
+                desc = "%s%s" % (desc,
+                                 data_text(table, record, "type", dfields) or "")
+                yield utf8("".join((
+                    "  <wpt lat=\"%s\" lon=\"%s\">\n" % \
+                        (attributes.lat or "", attributes.lon or ""),
+                    element("name",
+                            data_text(table, record, "name", dfields),
+                            "    "),
+                    element("desc", desc, "    "),
+                    element("sym", attributes.sym, "    "),
+                    "  </wpt>\n",
+                    )))
+
+        yield "</gpx>\n"
+
+# END =========================================================================
@@ -39,6 +39,7 @@ from gluon.languages import lazyT
 
 from ..s3rest import S3Request
 from ..s3codec import S3Codec
+from ..s3fields import S3Represent
 
 try:
     from cStringIO import StringIO    # Faster, where available
@@ -333,7 +334,15 @@ class S3RL_PDF(S3Codec):
         data = []
         # Convert the data into the represent format
         if sqltable:
-            for record in sqltable.sqlrows.records:
+            records = sqltable.sqlrows.records
+            # Look up the representations of foreign keys in bulk
+            for field in fobjs:
+                try:
+                    S3Represent.setup(field, records, show_link=False)
+                except TypeError:
+                    # Represent function without show_link
+                    pass
+            for record in records:
                 row = []
                 cnt = 0
                 for field in fobjs:
@@ -39,6 +39,7 @@ __all__ = ["AuthS3",
 
 import datetime
 import re
+import threading
 from uuid import uuid4
 
 try:
@@ -1668,8 +1669,7 @@ class AuthS3(Auth):
         session = current.session
         settings = current.deployment_settings
 
-        if "permissions" in current.response.s3:
-            del current.response.s3["permissions"]
+        self.permission.clear_cache()
 
         system_roles = self.get_system_roles()
         ANONYMOUS = system_roles.ANONYMOUS
@@ -1962,6 +1962,7 @@ class AuthS3(Auth):
             db(pquery).update(deleted=True)
             # Remove the role
             db(gquery).update(role=None, deleted=True)
+            self.permission.clear_cache(compiled=True)
 
     # -------------------------------------------------------------------------
     def s3_assign_role(self, user_id, group_id, for_pe=None):
@@ -2031,6 +2032,7 @@ class AuthS3(Auth):
                 if for_pe is not None and str(group_id) not in unrestrictable:
                     membership["pe_id"] = for_pe
                 membership_id = mtable.insert(**membership)
+        self.permission.clear_cache(compiled=True)
 
         # Update roles for current user if required
         if self.user and str(user_id) == str(self.user.id):
@@ -2105,6 +2107,7 @@ class AuthS3(Auth):
                             deleted_fk=deleted_fk,
                             user_id=None,
                             group_id=None)
+        self.permission.clear_cache(compiled=True)
 
         # Update roles for current user if required
         if self.user and str(user_id) == str(self.user.id):
@@ -2923,6 +2926,7 @@ class AuthS3(Auth):
             if key in ownership_fields:
                 data[key] = fields[key]
         if data:
+            self.permission.forget(table, record_id)
             return current.db(table._id == record_id).update(**data)
         else:
             return None
@@ -3240,6 +3244,18 @@ class S3Permission(object):
                               reduce(lambda x, y: (x[0]&y[0], x[1]&y[1]),
                                      acl, (self.ALL, self.ALL))
 
+    # Record meta-data for record-level permission checks
+    META_FIELDS = ("owned_by_user",
+                   "owned_by_group",
+                   "owned_by_entity",
+                   "approved_by")
+
+    # Process-wide cache of compiled ACLs {tablename: (version, acls)},
+    # the version counter is bumped whenever ACLs or roles are changed
+    acl_lock = threading.Lock()
+    acl_version = 0
+    compiled = {}
+
     # -------------------------------------------------------------------------
     def __init__(self, auth, tablename=None):
         """
@@ -3312,6 +3328,9 @@ class S3Permission(object):
         self.page_acls = Storage()
         self.table_acls = Storage()
 
+        # Prefetched record meta-data {tablename: {record_id: Row}}
+        self.prefetched = Storage()
+
         # Pages which never require permission:
         # Make sure that any data access via these pages uses
         # accessible_query explicitly!
@@ -3396,9 +3415,6 @@ class S3Permission(object):
             # ACLs not relevant to this security policy
             return None
 
-        if "permissions" in current.response.s3:
-            del current.response.s3["permissions"]
-
         if c is None and f is None and t is None:
             return None
         if t is not None:
@@ -3456,6 +3472,7 @@ class S3Permission(object):
                 acl["group_id"] = group_id
                 success = table.insert(**acl)
 
+        self.clear_cache(compiled=True)
         return success
 
     # -------------------------------------------------------------------------
@@ -3484,8 +3501,207 @@ class S3Permission(object):
                                entity=entity,
                                delete=True)
 
+    # -------------------------------------------------------------------------
+    def clear_cache(self, compiled=False):
+        """
+            Clear the per-request permission caches
+
+            @param compiled: also invalidate the process-wide compiled ACLs
+                             (required after changes to ACLs or roles)
+        """
+
+        if compiled:
+            with self.acl_lock:
+                S3Permission.acl_version += 1
+
+        s3 = current.response.s3
+        for key in ("permissions", "accessible_queries", "acl_stamps"):
+            if key in s3:
+                del s3[key]
+        return
+
+    # -------------------------------------------------------------------------
+    def compiled_acls(self):
+        """
+            Get the ACLs in the permissions table compiled into lookup
+            dicts, shared by all requests in this process. The compiled
+            ACLs get re-built when ACLs or roles have been changed in this
+            process, or when the permissions table has been modified by
+            another process (checked once per request).
+
+            @returns: Storage with
+                      - groups: {group_id: [rules]}
+                      - pages: {(group_id, controller): [rules]}
+                      - tables: {(group_id, tablename): [rules]}
+                      - restricted: set of tablenames which have ACLs
+        """
+
+        db = current.db
+        table = self.table
+        tablename = table._tablename
+
+        # Modification stamp of the permissions table
+        s3 = current.response.s3
+        stamps = s3.acl_stamps
+        if stamps is None:
+            stamps = s3.acl_stamps = Storage()
+        stamp = stamps.get(tablename)
+        if stamp is None:
+            count = table.id.count()
+            mtime = table.modified_on.max()
+            row = db(table.id > 0).select(count, mtime).first()
+            stamp = stamps[tablename] = (row[count], row[mtime])
+
+        version = (self.acl_version, stamp)
+        cached = self.compiled.get(tablename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with self.acl_lock:
+            cached = self.compiled.get(tablename)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            gtable = self.auth.settings.table_group
+            query = (table.deleted != True) & \
+                    (table.group_id == gtable.id)
+            rows = db(query).select(table.group_id,
+                                    table.controller,
+                                    table.function,
+                                    table.tablename,
+                                    table.entity,
+                                    table.unrestricted,
+                                    table.uacl,
+                                    table.oacl)
+
+            groups = {}
+            pages = {}
+            tables = {}
+            for row in rows:
+                rule = Storage(row)
+                group_id = rule.group_id
+                groups.setdefault(group_id, []).append(rule)
+                if rule.controller is not None:
+                    key = (group_id, rule.controller)
+                    pages.setdefault(key, []).append(rule)
+                elif rule.function is None and rule.tablename is not None:
+                    key = (group_id, rule.tablename)
+                    tables.setdefault(key, []).append(rule)
+
+            query = (table.deleted != True) & \
+                    (table.controller == None) & \
+                    (table.function == None)
+            rows = db(query).select(table.tablename, distinct=True)
+            restricted = set(row.tablename for row in rows)
+
+            acls = Storage(groups=groups,
+                           pages=pages,
+                           tables=tables,
+                           restricted=restricted)
+            self.compiled[tablename] = (version, acls)
+
+        return acls
+
     # -------------------------------------------------------------------------
     # Record Ownership
+    # -------------------------------------------------------------------------
+    def prefetch(self, table, record_ids):
+        """
+            Bulk-load the ownership and approval meta-data of multiple
+            records in one query, so that subsequent record-level
+            permission checks for these records (e.g. for the items of
+            an import job) need not look them up one by one
+
+            @param table: the table or tablename
+            @param record_ids: list of record IDs
+
+            @returns: dict {record_id: Row} of the prefetched meta-data
+                      for this table
+        """
+
+        if not hasattr(table, "_tablename"):
+            table = current.s3db.table(table)
+        if not table:
+            return {}
+
+        tablename = table._tablename
+        prefetched = self.prefetched
+        if tablename not in prefetched:
+            prefetched[tablename] = {}
+        records = prefetched[tablename]
+
+        fields = [f for f in self.META_FIELDS if f in table.fields]
+        if not fields:
+            # No ownership/approval meta-data in this table
+            return records
+
+        ids = set()
+        for record_id in record_ids:
+            try:
+                record_id = int(record_id)
+            except (TypeError, ValueError):
+                continue
+            if record_id not in records:
+                ids.add(record_id)
+        if ids:
+            pkey = table._id.name
+            fields = [table._id] + [table[f] for f in fields]
+            if len(ids) == 1:
+                query = (table._id == list(ids)[0])
+            else:
+                query = (table._id.belongs(ids))
+            rows = current.db(query).select(*fields)
+            for row in rows:
+                records[row[pkey]] = row
+        return records
+
+    # -------------------------------------------------------------------------
+    def forget(self, table, record_id=None):
+        """
+            Remove prefetched meta-data, to be called when the ownership
+            or approval status of a record changes
+
+            @param table: the table or tablename
+            @param record_id: the record ID (None for all records)
+        """
+
+        if hasattr(table, "_tablename"):
+            tablename = table._tablename
+        else:
+            tablename = table
+
+        prefetched = self.prefetched
+        if tablename in prefetched:
+            if record_id is None:
+                del prefetched[tablename]
+            else:
+                try:
+                    record_id = int(record_id)
+                except (TypeError, ValueError):
+                    return
+                prefetched[tablename].pop(record_id, None)
+        return
+
+    # -------------------------------------------------------------------------
+    def lookup(self, table, record_id):
+        """
+            Get the prefetched meta-data of a record
+
+            @param table: the table
+            @param record_id: the record ID
+
+            @returns: the meta-data Row, or None if not prefetched
+        """
+
+        records = self.prefetched.get(table._tablename)
+        if records:
+            try:
+                record_id = int(record_id)
+            except (TypeError, ValueError):
+                return None
+            return records.get(record_id)
+        return None
+
     # -------------------------------------------------------------------------
     def get_owners(self, table, record):
         """
@@ -3537,6 +3753,8 @@ class S3Permission(object):
             record_id = record
             record = None
 
+        if not record and record_id:
+            record = self.lookup(table, record_id)
         if not record and record_id:
             # Get the record
             fs = [table[f] for f in fields] + [table.id]
@@ -3771,6 +3989,8 @@ class S3Permission(object):
             record_id = record
             record = None
 
+        if record is None and record_id:
+            record = self.lookup(table, record_id)
         if record is None and record_id:
             query = table._id == record_id
             record = db(query).select(table.approved_by, limitby=(0, 1)).first()
@@ -4053,6 +4273,20 @@ class S3Permission(object):
         c = c or self.controller
         f = f or self.function
 
+        # Re-use the query if already constructed during this request
+        # (session ownership of anonymous users can change at any time)
+        queries = None
+        if logged_in:
+            response_s3 = current.response.s3
+            queries = response_s3.accessible_queries
+            if queries is None:
+                queries = response_s3.accessible_queries = {}
+            key = (tuple(method), table._tablename, c, f,
+                   user.id, self.policy)
+            if key in queries:
+                _debug("*** Accessible Query (cached) ***")
+                return queries[key]
+
         # Get the applicable ACLs
         acls = self.applicable_acls(racl,
                                     realms=realms,
@@ -4064,10 +4298,14 @@ class S3Permission(object):
         if acls is None:
             _debug("==> no ACLs defined for this case")
             _debug("*** ALL RECORDS ***")
+            if queries is not None:
+                queries[key] = ALL_RECORDS
             return ALL_RECORDS
         elif not acls:
             _debug("==> no applicable ACLs")
             _debug("*** NO RECORDS ***")
+            if queries is not None:
+                queries[key] = NO_RECORDS
             return NO_RECORDS
 
         oacls = []
@@ -4124,6 +4362,8 @@ class S3Permission(object):
 
         _debug("*** Accessible Query ***")
         _debug(str(query))
+        if queries is not None:
+            queries[key] = query
         return query
 
     # -------------------------------------------------------------------------
@@ -4226,11 +4466,6 @@ class S3Permission(object):
                       or list of applicable ACLs
         """
 
-        db = current.db
-        table = self.table
-
-        gtable = self.auth.settings.table_group
-
         if not self.use_cacls:
             # We do not use ACLs at all (allow all)
             return None
@@ -4253,37 +4488,37 @@ class S3Permission(object):
             # No roles available (deny all)
             return acls
 
-        # Base query
-        query = (table.deleted != True) & \
-                (table.group_id.belongs(roles))
-
-        # Page ACLs
-        if page_restricted:
-            q = (table.function == None)
-            if f and self.use_facls:
-                q = (q | (table.function == f))
-            q &= (table.controller == c)
-        else:
-            q = None
+        # Compiled ACLs
+        compiled = self.compiled_acls()
+        use_facls = self.use_facls
 
         # Table ACLs
         table_restricted = False
         if t and self.use_tacls:
-            tq = (table.controller == None) & \
-                 (table.function == None) & \
-                 (table.tablename == t)
-            if q:
-                q = q | tq
+            if hasattr(t, "_tablename"):
+                tablename = t._tablename
             else:
-                q = tq
-            any_acl = db((table.deleted != True) & tq).select(limitby=(0, 1))
-            table_restricted = len(any_acl) > 0
+                tablename = t
+            table_restricted = tablename in compiled.restricted
+        else:
+            tablename = None
 
         # Retrieve the ACLs
-        if q:
-            query &= q
-        query &= (table.group_id == gtable.id)
-        rows = db(query).select(gtable.id, table.ALL)
+        rules = []
+        append = rules.append
+        extend = rules.extend
+        for group_id in roles:
+            if not page_restricted and not tablename:
+                extend(compiled.groups.get(group_id, ()))
+                continue
+            if page_restricted:
+                for rule in compiled.pages.get((group_id, c), ()):
+                    function = rule.function
+                    if function is None or \
+                       f and use_facls and function == f:
+                        append(rule)
+            if tablename:
+                extend(compiled.tables.get((group_id, tablename), ()))
 
         # Cascade ACLs
         ANY = "ANY"
@@ -4291,10 +4526,6 @@ class S3Permission(object):
         ALL = (self.ALL, self.ALL)
         NONE = (self.NONE, self.NONE)
 
-        atn = table._tablename
-        gtn = gtable._tablename
-
-        use_facls = self.use_facls
         def rule_type(r):
             if rule.controller is not None:
                 if rule.function is None:
@@ -4309,14 +4540,14 @@ class S3Permission(object):
         most_restrictive = lambda x, y: (x[0] & y[0], x[1] & y[1])
 
         # Realms
-        delegation_rows = []
-        append_delegation = delegation_rows.append
-        for row in rows:
+        delegation_rules = []
+        append_delegation = delegation_rules.append
+        for rule in rules:
 
             # Get the assigning entities
-            group_id = row[gtn].id
+            group_id = rule.group_id
             if group_id in delegations:
-                append_delegation(row)
+                append_delegation(rule)
             if group_id not in realms:
                 continue
             elif self.entity_realm:
@@ -4325,7 +4556,6 @@ class S3Permission(object):
                 entities = None
 
             # Get the rule type
-            rule = row[atn]
             rtype = rule_type(rule)
             if rtype is None:
                 continue
@@ -4356,16 +4586,15 @@ class S3Permission(object):
 
         # Delegations
         if self.delegations:
-            for row in delegation_rows:
+            for rule in delegation_rules:
 
                 # Get the rule type
-                rule = row[atn]
                 rtype = rule_type(rule)
                 if rtype is None:
                     continue
 
                 # Get the delegation realms
-                group_id = row[gtn].id
+                group_id = rule.group_id
                 if group_id not in delegations:
                     continue
                 else:
@@ -4674,6 +4903,11 @@ class S3Audit(object):
         table = self.table
         tablename = "%s_%s" % (prefix, name)
 
+        if operation in ("create", "update", "delete"):
+            # Invalidate cached record counts
+            from s3resource import S3CountCache
+            S3CountCache.invalidate(tablename)
+
         if record:
             if isinstance(record, Row):
                 record = record.get("id", None)
@@ -72,11 +72,15 @@ class S3Codec(object):
         # Import the codec classes
         from codecs import S3XLS
         from codecs import S3RL_PDF
+        from codecs import S3GeoJSON, S3KML, S3GPX
 
         # Register the codec classes
         CODECS = Storage(
             xls = S3XLS,
             pdf = S3RL_PDF,
+            geojson = S3GeoJSON,
+            kml = S3KML,
+            gpx = S3GPX,
         )
 
         if format in CODECS:
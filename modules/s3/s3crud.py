@@ -43,6 +43,7 @@ from gluon.tools import callback
 
 from s3method import S3Method
 from s3export import S3Exporter
+from s3index import S3TextIndex
 #from s3gis import S3MAP
 from s3utils import s3_mark_required
 from s3widgets import S3EmbedComponentWidget
@@ -880,7 +881,7 @@ class S3CRUD(S3Method):
             # response (avoids the dataTables Ajax request unless the user
             # tries nagivating around)
             if not s3.no_sspag and items:
-                totalrows = resource.count()
+                totalrows = resource.count(approximate=True)
                 if totalrows:
                     if s3.dataTable_iDisplayLength:
                         limit = 2 * s3.dataTable_iDisplayLength
@@ -949,7 +950,8 @@ class S3CRUD(S3Method):
                 resource.build_query(filter=s3.filter,
                                      vars=session.s3.filter)
 
-            displayrows = totalrows = resource.count(distinct=distinct)
+            displayrows = totalrows = resource.count(distinct=distinct,
+                                                     approximate=True)
 
             # SSPag dynamic filter?
             if vars.sSearch:
@@ -959,7 +961,8 @@ class S3CRUD(S3Method):
                 if squery is not None:
                     resource.add_filter(squery)
                     displayrows = resource.count(left=left,
-                                                 distinct=distinct)
+                                                 distinct=distinct,
+                                                 approximate=True)
 
             # SSPag sorting
             if vars.iSortingCols:
@@ -972,22 +975,29 @@ class S3CRUD(S3Method):
             # Echo
             sEcho = int(vars.sEcho or 0)
 
-            # Get the list
-            items = resource.sqltable(fields=list_fields,
-                                      left=left,
-                                      distinct=distinct,
-                                      start=start,
-                                      limit=limit,
-                                      orderby=orderby,
-                                      linkto=linkto,
-                                      download_url=self.download_url,
-                                      as_page=True,
-                                      format=representation) or []
+            # Get the list (after the cursor of the previous page, if any)
+            try:
+                items = resource.sqltable(fields=list_fields,
+                                          left=left,
+                                          distinct=distinct,
+                                          start=start,
+                                          limit=limit,
+                                          orderby=orderby,
+                                          linkto=linkto,
+                                          download_url=self.download_url,
+                                          as_page=True,
+                                          format=representation,
+                                          after=vars.get("after")) or []
+            except SyntaxError, e:
+                r.error(400, str(e))
 
             result = dict(sEcho = sEcho,
                           iTotalRecords = totalrows,
                           iTotalDisplayRecords = displayrows,
                           aaData = items)
+            cursor = resource.get_cursor()
+            if cursor is not None:
+                result["sCursor"] = cursor
 
             output = json(result)
 
@@ -1260,6 +1270,9 @@ class S3CRUD(S3Method):
                 # Execute onaccept
                 callback(onaccept, form, tablename=tablename)
 
+                # Update the text index
+                S3TextIndex(table).update(vars.id)
+
             elif form.errors:
                 table = self.table
                 if not response.error:
@@ -1991,6 +2004,8 @@ class S3CRUD(S3Method):
 
         # Build search query
         searchq = None
+        indexed = {}
+        use_index = "%" not in context
         for field in flist:
             query = None
             ftype = str(field.type)
@@ -2004,25 +2019,51 @@ class S3CRUD(S3Method):
                     r = requires[0]
                     if isinstance(r, IS_EMPTY_OR):
                         r = r.other
-                    try:
-                        options = r.options()
-                    except:
-                        continue
-                    vlist = []
-                    for (value, text) in options:
-                        if str(text).lower().find(context) != -1:
-                            vlist.append(value)
-                    if vlist:
-                        query = field.belongs(vlist)
+                    if use_index and ftype.startswith("reference"):
+                        query = self.ssp_index_query(field, r, context)
+                    if query is None:
+                        try:
+                            options = r.options()
+                        except:
+                            continue
+                        vlist = []
+                        for (value, text) in options:
+                            if str(text).lower().find(context) != -1:
+                                vlist.append(value)
+                        if vlist:
+                            query = field.belongs(vlist)
                 else:
                     continue
             elif str(field.type) in ("string", "text"):
+                text_index = S3TextIndex(field.table)
+                if use_index and text_index.indexed([field.name]):
+                    # Collect the indexed fields per table
+                    tn = field._tablename
+                    if tn not in indexed:
+                        indexed[tn] = (text_index, [field])
+                    else:
+                        indexed[tn][1].append(field)
+                    continue
                 query = field.lower().like(wildcard)
             if searchq is None and query:
                 searchq = query
             elif query:
                 searchq = searchq | query
 
+        # Indexed fields
+        for text_index, fields in indexed.values():
+            query = text_index.query(context,
+                                     fields=[f.name for f in fields])
+            if query is None:
+                # No words in the search string
+                for field in fields:
+                    q = field.lower().like(wildcard)
+                    query = query | q if query is not None else q
+            if searchq is None:
+                searchq = query
+            else:
+                searchq = searchq | query
+
         for j in joins.values():
             for q in j:
                 if searchq is None:
@@ -2032,6 +2073,44 @@ class S3CRUD(S3Method):
 
         return searchq
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def ssp_index_query(field, requires, context):
+        """
+            Use the text index of the lookup table of a foreign key to
+            find the option labels matching the search string, instead
+            of matching against all options
+
+            @param field: the foreign key
+            @param requires: the validator of the foreign key
+            @param context: the search string
+            @returns: a query for the field, or None if the lookup
+                      table is not indexed for the option labels
+        """
+
+        ktablename = getattr(requires, "ktable", None)
+        if not ktablename:
+            return None
+        ktable = current.s3db.table(ktablename)
+        if ktable is None:
+            return None
+
+        text_index = S3TextIndex(ktable)
+        if isinstance(requires.label, str):
+            kfield = requires.kfield
+            fields = [k for k in requires.ks if k != kfield]
+            if not fields:
+                return None
+        else:
+            # Labels are computed, match against all indexed fields
+            fields = None
+        if not text_index.indexed(fields):
+            return None
+        query = text_index.query(context, fields=fields)
+        if query is None:
+            return None
+        return field.belongs(current.db(query)._select(ktable[requires.kfield]))
+
     # -------------------------------------------------------------------------
     def ssp_orderby(self, resource, fields, left=[]):
         """
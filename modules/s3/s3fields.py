@@ -30,6 +30,7 @@
 """
 
 __all__ = ["S3ReusableField",
+           "S3Represent",
            "s3_uid",
            "s3_meta_deletion_status",
            "s3_meta_deletion_fk",
@@ -63,7 +64,7 @@ from gluon import *
 #from gluon.dal import Field
 #from gluon.html import *
 #from gluon.validators import *
-from gluon.dal import Query, SQLCustomType
+from gluon.dal import Query, Row, SQLCustomType
 from gluon.storage import Storage
 
 from s3utils import S3DateTime, s3_auth_user_represent, s3_auth_group_represent
@@ -206,6 +207,210 @@ class S3ReusableField(object):
         else:
             return Field(name, self.__type, **ia)
 
+# =============================================================================
+class S3Represent(object):
+    """
+        Representation of foreign keys which can look up the
+        representations of many keys at once, e.g. all keys in a column
+        of a list view or export, instead of one query per key
+
+        Calling the instance represents a single key like the represent
+        function, using the representations found by bulk() before
+    """
+
+    def __init__(self, lookup, represent, fields=None, bulk=None, **attr):
+        """
+            Constructor
+
+            @param lookup: the name of the referenced table
+            @param represent: the represent function, represent(key, **attr),
+                              which must also accept the referenced record
+                              as keyword argument "row" unless a bulk
+                              function is given
+            @param fields: the fields of the referenced table which the
+                           represent function needs in the row
+            @param bulk: function to represent many keys at once,
+                         bulk(keys, **attr) => {key: representation}
+            @param attr: keyword arguments for the represent functions
+        """
+
+        self.lookup = lookup
+        self.represent = represent
+        self.fields = fields
+        self.bulk_represent = bulk
+        self.attr = attr
+
+        self.cache = {}
+
+    # -------------------------------------------------------------------------
+    def __call__(self, value, row=None, **attr):
+        """
+            Represent a single key
+
+            @param value: the key
+            @param row: the referenced record (if already loaded)
+            @param attr: keyword arguments for the represent function
+        """
+
+        attr = self._attr(attr)
+        if row is not None:
+            return self.represent(value, row=row, **attr)
+
+        key = self._key(value)
+        if key is None:
+            return self.represent(value, **attr)
+        cache = self._cache(attr)
+        if key not in cache:
+            cache[key] = self.represent(value, **attr)
+        return cache[key]
+
+    # -------------------------------------------------------------------------
+    def bulk(self, values, **attr):
+        """
+            Look up the representations of many keys at once
+
+            @param values: the keys
+            @param attr: keyword arguments for the represent function
+
+            @returns: dict {key: representation} for all keys found
+        """
+
+        attr = self._attr(attr)
+        cache = self._cache(attr)
+
+        keys = set()
+        for value in values:
+            key = self._key(value)
+            if key is not None:
+                keys.add(key)
+
+        missing = [key for key in keys if key not in cache]
+        if missing:
+            if self.bulk_represent is not None:
+                cache.update(self.bulk_represent(missing, **attr))
+            else:
+                cache.update(self._represent_rows(missing, attr))
+
+        return dict((key, cache[key]) for key in keys if key in cache)
+
+    # -------------------------------------------------------------------------
+    def _represent_rows(self, keys, attr):
+        """
+            Load the referenced records in one query and represent each
+            of them with the represent function
+
+            @param keys: the keys
+            @param attr: keyword arguments for the represent function
+        """
+
+        table = current.s3db.table(self.lookup)
+        if table is None:
+            return {}
+
+        pkey = table._id
+        fields = [pkey]
+        if self.fields:
+            fields.extend([table[f] for f in self.fields
+                                    if f in table.fields and f != pkey.name])
+        else:
+            fields = [table.ALL]
+        rows = current.db(pkey.belongs(keys)).select(*fields)
+
+        represent = self.represent
+        represents = {}
+        for row in rows:
+            key = row[pkey.name]
+            represents[key] = represent(key, row=row, **attr)
+        return represents
+
+    # -------------------------------------------------------------------------
+    def _attr(self, attr):
+        """
+            The keyword arguments for the represent function
+
+            @param attr: the keyword arguments of the call
+        """
+
+        if not attr:
+            return self.attr
+        _attr = dict(self.attr)
+        _attr.update(attr)
+        return _attr
+
+    # -------------------------------------------------------------------------
+    def _cache(self, attr):
+        """
+            The cache for the representations with these arguments
+
+            @param attr: the keyword arguments for the represent function
+        """
+
+        try:
+            key = tuple(sorted(attr.items()))
+            hash(key)
+        except TypeError:
+            # Unhashable arguments => don't cache
+            return {}
+        cache = self.cache
+        if key not in cache:
+            cache[key] = {}
+        return cache[key]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _key(value):
+        """
+            The key to look up and cache a representation
+
+            @param value: the field value
+
+            @returns: the key (long), or None if the value is not a key
+        """
+
+        if value is None or isinstance(value, (list, tuple, dict, Row)):
+            return None
+        try:
+            return long(value)
+        except (ValueError, TypeError):
+            return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def setup(field, rows, **attr):
+        """
+            Look up the representations of all values of a field in rows
+            in bulk (if the field's represent supports it), so that the
+            representation of each value comes from the cache
+
+            @param field: the Field
+            @param rows: the rows (Rows, or list of Rows or dicts,
+                         may contain Rows for multiple tables)
+            @param attr: keyword arguments for the represent function
+        """
+
+        if field is None:
+            return
+        represent = field.represent
+        if not isinstance(represent, S3Represent):
+            return
+
+        tablename = field.tablename
+        fieldname = field.name
+        values = set()
+        add = values.add
+        for row in rows:
+            if tablename in row and isinstance(row[tablename], (Row, dict)):
+                row = row[tablename]
+            if fieldname not in row:
+                continue
+            value = row[fieldname]
+            if isinstance(value, (list, tuple)):
+                values.update(value)
+            elif value is not None:
+                add(value)
+        if values:
+            represent.bulk(values, **attr)
+
 # =============================================================================
 # Record identity meta-fields
 
@@ -579,12 +784,24 @@ def s3_lx_update(table, record_id):
                     if country:
                         vars.L0 = country.name
             else:
-                # Get Names of ancestors at each level
-                vars = current.gis.get_parent_per_level(vars,
-                                                        location.id,
-                                                        feature=location,
-                                                        ids=False,
-                                                        names=True)
+                # Get Names of ancestors at each level from the closure
+                atable = current.s3db.gis_location_ancestor
+                query = (atable.location_id == location.id) & \
+                        (ltable.id == atable.ancestor_id)
+                ancestors = db(query).select(ltable.level, ltable.name)
+                if ancestors or not location.parent:
+                    for key in current.gis.hierarchy_level_keys:
+                        vars[key] = None
+                    for ancestor in ancestors:
+                        if ancestor.level in vars:
+                            vars[ancestor.level] = ancestor.name
+                else:
+                    # Ancestors not yet updated
+                    vars = current.gis.get_parent_per_level(vars,
+                                                            location.id,
+                                                            feature=location,
+                                                            ids=False,
+                                                            names=True)
             # Update record
             db(table.id == record_id).update(**vars)
 
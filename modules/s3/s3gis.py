@@ -30,11 +30,17 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["GIS", "S3Map", "GoogleGeocoder", "YahooGeocoder"]
+__all__ = ["GIS",
+           "S3Map",
+           "S3SpatialIndex",
+           "GoogleGeocoder",
+           "YahooGeocoder",
+           ]
 
 import os
 import re
 import sys
+import threading
 #import logging
 import urllib           # Needed for urlencoding
 import urllib2          # Needed for quoting & error handling on fetch
@@ -70,9 +76,9 @@ from gluon.storage import Storage, Messages
 from gluon.contrib.simplejson.ordered_dict import OrderedDict
 
 from s3fields import s3_all_meta_field_names
-from s3search import S3Search
+from s3search import S3Search, S3LocationNameIndex
 from s3track import S3Trackable
-from s3utils import s3_debug, s3_fullname, s3_has_foreign_key
+from s3utils import s3_debug, s3_fullname, s3_has_foreign_key, s3_unicode
 
 DEBUG = False
 if DEBUG:
@@ -94,6 +100,38 @@ GEOM_TYPES = {
     "geometrycollection": 7,
 }
 
+# -----------------------------------------------------------------------------
+def _wkt_bounds(item):
+    """
+        Compute feature type, centroid and bounds of a WKT geometry, as
+        in GIS.wkt_centroid (module-level to be usable in a worker pool)
+
+        @param item: tuple (record_id, wkt)
+        @returns: tuple (gis_feature_type, lat, lon,
+                         lat_min, lat_max, lon_min, lon_max, record_id),
+                  or None if the WKT is invalid
+    """
+
+    from shapely.wkt import loads as wkt_loads
+
+    record_id, wkt = item
+    try:
+        shape = wkt_loads(wkt)
+    except:
+        try:
+            # Perhaps this is really a LINESTRING (e.g. OSM import of an unclosed Way)
+            shape = wkt_loads("LINESTRING%s" % wkt[8:-1])
+        except:
+            return None
+    try:
+        gis_feature_type = GEOM_TYPES[shape.type.lower()]
+        centroid = shape.centroid
+        lon_min, lat_min, lon_max, lat_max = shape.bounds
+    except:
+        return None
+    return (gis_feature_type, centroid.y, centroid.x,
+            lat_min, lat_max, lon_min, lon_max, record_id)
+
 # km
 RADIUS_EARTH = 6371.01
 
@@ -222,12 +260,513 @@ GPS_SYMBOLS = [
     "Zoo"
     ]
 
+# -----------------------------------------------------------------------------
+class S3ClusterIndex(object):
+    """
+        Process-wide cache of point grids for the server-side clustering
+        of map layers (see GIS.get_clusters): the points of a resource
+        query aggregated into grid cells of the finest clustering zoom
+        level, and coarser levels aggregated from these on demand.
+
+        A grid is rebuilt when the signature of its query (number and last
+        modification of the records) changes.
+    """
+
+    MAX_ZOOM = 14           # finest clustering zoom level
+    CELLS = 4               # grid cells per tile side (i.e. 64px cells)
+    MAX_GRIDS = 50          # max number of cached grids
+
+    lock = threading.Lock()
+    grids = {}
+    counter = 0
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, key, signature, points):
+        """
+            Get the grid for a query, build it if not cached or outdated
+
+            @param key: the cache key of the query
+            @param signature: the current signature of the query
+            @param points: function returning the points of the query as
+                           iterable of tuples (record_id, lon, lat)
+        """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            cls.counter += 1
+            grid = cls.grids.get(key)
+            if grid is not None and grid["signature"] == signature:
+                grid["used"] = cls.counter
+                return grid
+        finally:
+            lock.release()
+
+        grid = {"signature": signature,
+                "levels": {cls.MAX_ZOOM: cls.build(points())},
+                "used": cls.counter,
+                }
+
+        lock.acquire()
+        try:
+            grids = cls.grids
+            grids[key] = grid
+            if len(grids) > cls.MAX_GRIDS:
+                # Drop the least recently used grids
+                lru = sorted(grids, key=lambda k: grids[k]["used"])
+                for k in lru[:len(grids) - cls.MAX_GRIDS]:
+                    del grids[k]
+        finally:
+            lock.release()
+        return grid
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build(cls, points):
+        """
+            Aggregate points into the grid cells of MAX_ZOOM
+
+            @param points: iterable of tuples (record_id, lon, lat)
+
+            @returns: dict {(column, row): [count, sum_lon, sum_lat, record_id]},
+                      record_id being that of the first point in the cell
+        """
+
+        import math
+
+        floor = math.floor
+        size = 360.0 / (2 ** cls.MAX_ZOOM * cls.CELLS)
+        cells = {}
+        for record_id, lon, lat in points:
+            if lon is None or lat is None:
+                continue
+            key = (int(floor((lon + 180) / size)),
+                   int(floor((lat + 90) / size)))
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [1, lon, lat, record_id]
+            else:
+                cell[0] += 1
+                cell[1] += lon
+                cell[2] += lat
+        return cells
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def cells(cls, grid, zoom):
+        """
+            Get the grid cells of a zoom level
+
+            @param grid: the grid
+            @param zoom: the zoom level
+        """
+
+        levels = grid["levels"]
+        zoom = max(0, min(zoom, cls.MAX_ZOOM))
+        if zoom in levels:
+            return levels[zoom]
+
+        cells = {}
+        for (column, row), cell in cls.cells(grid, zoom + 1).items():
+            key = (column >> 1, row >> 1)
+            parent = cells.get(key)
+            if parent is None:
+                cells[key] = list(cell)
+            else:
+                parent[0] += cell[0]
+                parent[1] += cell[1]
+                parent[2] += cell[2]
+        levels[zoom] = cells
+        return cells
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """ Drop all grids """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            cls.grids = {}
+        finally:
+            lock.release()
+
+# -----------------------------------------------------------------------------
+class S3SpatialIndex(object):
+    """
+        Process-wide grid index of the bounds of all locations, to
+        shortlist the locations within a bounding box where there is no
+        spatial database (see GIS.get_location_shortlist).
+
+        Built on first use, from a file cache if that is up to date with
+        the database, updated by gis_location_onaccept in this process,
+        and re-validated against the database after TTL seconds (to pick
+        up changes made in other processes). Locations modified since
+        the index was built are always included in queries (see query),
+        so the index never hides changes made in other processes.
+    """
+
+    CELL = 1.0              # grid cell size (degrees)
+    MAX_CELLS = 64          # max cells per location, larger ones are
+                            # checked individually
+    MAX_SEARCH_CELLS = 4096 # max cells per search, larger bboxes are
+                            # better served by the database
+    TTL = 60                # interval to re-validate the index (seconds)
+
+    lock = threading.Lock()
+    bounds = None
+    cells = None
+    large = None
+    signature = None
+    built = None
+    checked = 0
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def search(cls, lon_min, lat_min, lon_max, lat_max):
+        """
+            Find the locations whose bounds intersect a bounding box
+
+            @returns: set of gis_location IDs, or None if the bounding box
+                      is too large for the index
+        """
+
+        keys = cls.keys((lon_min, lat_min, lon_max, lat_max),
+                        cls.MAX_SEARCH_CELLS)
+        if keys is None:
+            return None
+        cls.check()
+
+        bounds = cls.bounds
+        cells = cls.cells
+        large = cls.large
+        if bounds is None:
+            return None
+        def intersects(b):
+            return b[0] <= lon_max and b[2] >= lon_min and \
+                   b[1] <= lat_max and b[3] >= lat_min
+
+        ids = set()
+        add = ids.add
+        for key in keys:
+            for location_id in cells.get(key, ()):
+                if location_id not in ids:
+                    b = bounds.get(location_id)
+                    if b and intersects(b):
+                        add(location_id)
+        for location_id, b in large.items():
+            if intersects(b):
+                add(location_id)
+        return ids
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def query(cls, lon_min, lat_min, lon_max, lat_max, max_ids=None):
+        """
+            Query to shortlist the locations which may intersect a
+            bounding box: the locations found in the index, plus all
+            locations modified since the index was built. This never
+            excludes a location, so the caller must still apply the
+            actual bbox conditions.
+
+            @param max_ids: the maximum number of IDs to filter by
+
+            @returns: a Query, or None if the index can not be used for
+                      this bounding box
+        """
+
+        cls.check()
+        # NB read before searching: a concurrent rebuild can only make
+        #    the index more recent than this
+        built = cls.built
+        ids = cls.search(lon_min, lat_min, lon_max, lat_max)
+        if ids is None or max_ids is not None and len(ids) > max_ids:
+            return None
+
+        table = current.s3db.gis_location
+        query = (table.id.belongs(list(ids)))
+        if built is not None:
+            query |= (table.modified_on >= built)
+        return query
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update(cls, location_id):
+        """
+            Update the index for a location (if the index has been built)
+
+            @param location_id: the gis_location ID
+        """
+
+        if cls.bounds is None:
+            return
+        table = current.s3db.gis_location
+        row = current.db(table.id == location_id).select(table.deleted,
+                                                         table.lat,
+                                                         table.lon,
+                                                         table.lat_min,
+                                                         table.lat_max,
+                                                         table.lon_min,
+                                                         table.lon_max,
+                                                         limitby=(0, 1)
+                                                         ).first()
+        b = None
+        if row and not row.deleted:
+            b = cls.get_bounds(row.lon_min, row.lat_min, row.lon_max, row.lat_max,
+                               row.lon, row.lat)
+
+        # NB the signature is kept, so that changes made in other processes
+        #    are still detected when the index is re-validated
+        lock = cls.lock
+        lock.acquire()
+        try:
+            if cls.bounds is None:
+                return
+            cls.remove(location_id)
+            if b:
+                cls.add(location_id, b, cls.bounds, cls.cells, cls.large)
+        finally:
+            lock.release()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """
+            Drop the index, e.g. after a bulk update of the location bounds
+        """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            cls.bounds = cls.cells = cls.large = None
+            cls.signature = cls.built = None
+            path = cls.path()
+            for filename in (path, "%s.json" % path):
+                if os.path.exists(filename):
+                    os.remove(filename)
+        finally:
+            lock.release()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def check(cls):
+        """ Build or re-validate the index if required """
+
+        import time
+
+        now = time.time()
+        if cls.bounds is not None and now - cls.checked < cls.TTL:
+            return
+        signature, built = cls.get_signature()
+        if cls.bounds is not None and signature == cls.signature:
+            cls.checked = now
+            return
+
+        from array import array
+
+        # Read the file cache, or rebuild it from the database
+        data = cls.read(signature)
+        if data is None:
+            db = current.db
+            table = current.s3db.gis_location
+            sql = db(table.deleted != True)._select(table.id,
+                                                    table.lon_min,
+                                                    table.lat_min,
+                                                    table.lon_max,
+                                                    table.lat_max,
+                                                    table.lon,
+                                                    table.lat)
+            data = array("d")
+            get_bounds = cls.get_bounds
+            for row in db.executesql(sql):
+                b = get_bounds(*row[1:])
+                if b:
+                    data.append(row[0])
+                    data.extend(b)
+            cls.write(signature, data)
+
+        bounds = {}
+        cells = {}
+        large = {}
+        add = cls.add
+        for i in xrange(0, len(data), 5):
+            add(int(data[i]), tuple(data[i + 1:i + 5]), bounds, cells, large)
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            cls.bounds = bounds
+            cls.cells = cells
+            cls.large = large
+            cls.signature = signature
+            cls.built = built
+            cls.checked = now
+        finally:
+            lock.release()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_signature():
+        """
+            Signature of the gis_location table to detect changes
+
+            @returns: tuple (signature, latest modification date)
+        """
+
+        table = current.s3db.gis_location
+        count = table.id.count()
+        mtime = table.modified_on.max()
+        row = current.db(table.deleted != True).select(count, mtime).first()
+        return ("%s|%s" % (row[count], row[mtime]), row[mtime])
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_bounds(lon_min, lat_min, lon_max, lat_max, lon, lat):
+        """
+            The bounds of a location, falling back to its Lat/Lon
+
+            @returns: tuple (lon_min, lat_min, lon_max, lat_max), or None
+        """
+
+        if None in (lon_min, lat_min, lon_max, lat_max):
+            if lon is None or lat is None:
+                return None
+            return (lon, lat, lon, lat)
+        return (lon_min, lat_min, lon_max, lat_max)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def keys(cls, b, max_cells):
+        """
+            The grid cells covered by bounds
+
+            @param b: the bounds (lon_min, lat_min, lon_max, lat_max)
+            @param max_cells: the maximum number of cells
+
+            @returns: list of cell keys, or None if more than max_cells
+        """
+
+        import math
+
+        floor = math.floor
+        size = cls.CELL
+        x0 = int(floor(b[0] / size))
+        y0 = int(floor(b[1] / size))
+        x1 = int(floor(b[2] / size))
+        y1 = int(floor(b[3] / size))
+        if x1 < x0 or y1 < y0 or (x1 - x0 + 1) * (y1 - y0 + 1) > max_cells:
+            return None
+        return [(x, y) for x in xrange(x0, x1 + 1)
+                       for y in xrange(y0, y1 + 1)]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def add(cls, location_id, b, bounds, cells, large):
+        """ Add a location to the index """
+
+        bounds[location_id] = b
+        keys = cls.keys(b, cls.MAX_CELLS)
+        if keys is None:
+            large[location_id] = b
+        else:
+            for key in keys:
+                cell = cells.get(key)
+                if cell is None:
+                    cells[key] = [location_id]
+                else:
+                    cell.append(location_id)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def remove(cls, location_id):
+        """ Remove a location from the index (lock must be acquired) """
+
+        b = cls.bounds.pop(location_id, None)
+        if b is None:
+            return
+        if cls.large.pop(location_id, None) is None:
+            cells = cls.cells
+            for key in cls.keys(b, cls.MAX_CELLS) or ():
+                cell = cells.get(key)
+                if cell and location_id in cell:
+                    cell.remove(location_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def path():
+        """ Path of the file cache """
+
+        return os.path.join(current.request.folder,
+                            "uploads", "gis_cache", "spatial_index")
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def read(cls, signature):
+        """
+            Read the index data from the file cache, if up to date
+
+            @returns: array of (id, lon_min, lat_min, lon_max, lat_max),
+                      or None
+        """
+
+        from array import array
+
+        path = cls.path()
+        try:
+            f = open("%s.json" % path, "rb")
+            try:
+                header = json.load(f)
+            finally:
+                f.close()
+            if header.get("signature") != signature:
+                return None
+            data = array("d")
+            f = open(path, "rb")
+            try:
+                data.fromfile(f, header["length"])
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, KeyError):
+            return None
+        return data
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def write(cls, signature, data):
+        """ Write the index data to the file cache """
+
+        path = cls.path()
+        try:
+            folder = os.path.dirname(path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            f = open(path, "wb")
+            try:
+                data.tofile(f)
+            finally:
+                f.close()
+            f = open("%s.json" % path, "wb")
+            try:
+                json.dump({"signature": signature, "length": len(data)}, f)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            s3_debug("GIS: Spatial index cannot be cached: %s" % e)
+
 # -----------------------------------------------------------------------------
 class GIS(object):
     """
         GeoSpatial functions
     """
 
+    # Maximum number of candidates from the spatial index to filter by ID
+    MAX_BBOX_IDS = 5000
+
+    # Tolerances (in degrees) of the simplified geometries cache,
+    # from coarse to fine (0.001 = the default of simplify())
+    SIMPLIFY_TOLERANCES = (0.01, 0.001, 0.0001)
+
     def __init__(self):
         messages = current.messages
         #messages.centroid_error = str(A("Shapely", _href="http://pypi.python.org/pypi/Shapely/", _target="_blank")) + " library not found, so can't find centroid!"
@@ -686,26 +1225,30 @@ class GIS(object):
     def get_children(id, level=None):
         """
             Return a list of IDs of all GIS Features which are children of
-            the requested feature, using Materialized path for retrieving
-            the children
-
-            @author: Aravind Venkatesan and Ajay Kumar Sreenivasan from NCSU
-
-            This has been chosen over Modified Preorder Tree Traversal for
-            greater efficiency:
-            http://eden.sahanafoundation.org/wiki/HaitiGISToDo#HierarchicalTrees
+            the requested feature, using the gis_location_ancestor closure
+            table (maintained by update_location_tree) for retrieving
+            the children, or Materialized path if the closure table has
+            no entries for this feature (not yet built)
 
             @param: level - optionally filter by level
         """
 
         db = current.db
-        table = db.gis_location
+        s3db = current.s3db
+        table = s3db.gis_location
+        atable = s3db.gis_location_ancestor
         query = (table.deleted == False)
         if level:
             query = query & (table.level == level)
-        term = str(id)
-        query = query & ((table.path.like(term + "/%")) | \
-                         (table.path.like("%/" + term + "/%")))
+        if db(atable.ancestor_id == id).select(atable.id,
+                                               limitby=(0, 1)).first():
+            query = query & (atable.ancestor_id == id) & \
+                            (table.id == atable.location_id)
+        else:
+            # Closure not (yet) built for this feature
+            term = str(id)
+            query = query & ((table.path.like(term + "/%")) | \
+                             (table.path.like("%/" + term + "/%")))
         children = db(query).select(table.id,
                                     table.name)
         return children
@@ -756,18 +1299,32 @@ class GIS(object):
             if ids_only:
                 return reverse_path
 
-            # Retrieve parents - order in which they're returned is arbitrary.
+            # Retrieve parents from the closure table, nearest first
+            db = current.db
             s3db = current.s3db
             table = s3db.gis_location
-            query = (table.id.belongs(reverse_path))
+            atable = s3db.gis_location_ancestor
             fields = [table.id, table.name, table.level, table.lat, table.lon]
-            unordered_parents = current.db(query).select(cache=s3db.cache,
-                                                         *fields)
+            location_id = feature_id or feature.id
+            if location_id:
+                query = (atable.location_id == location_id) & \
+                        (table.id == atable.ancestor_id)
+                parents = db(query).select(orderby=atable.depth,
+                                           cache=s3db.cache,
+                                           *fields)
+                if len(parents) == len(reverse_path):
+                    return [row for row in parents]
+
+            # Closure not (yet) up to date - order in which they're
+            # returned is arbitrary
+            query = (table.id.belongs(reverse_path))
+            unordered_parents = db(query).select(cache=s3db.cache,
+                                                 *fields)
 
             # Reorder parents in order of reversed path.
-            unordered_ids = [row.id for row in unordered_parents]
-            parents = [unordered_parents[unordered_ids.index(path_id)]
-                       for path_id in reverse_path if path_id in unordered_ids]
+            rows = dict((row.id, row) for row in unordered_parents)
+            parents = [rows[path_id]
+                       for path_id in reverse_path if path_id in rows]
 
             return parents
 
@@ -1531,6 +2088,10 @@ class GIS(object):
         query = (table.location_id == locations.id)
         if "deleted" in table.fields:
             query = query & (table.deleted == False)
+        # Shortlist from the spatial index
+        shortlist = self.get_location_shortlist(*polygon.bounds)
+        if shortlist is not None:
+            query = query & shortlist
         # @ToDo: Check AAA (do this as a resource filter?)
 
         features = db(query).select(locations.wkt,
@@ -1735,6 +2296,11 @@ class GIS(object):
             locations = db.gis_location
 
             query = (locations.lat > minLat) & (locations.lat < maxLat) & (locations.lon > minLon) & (locations.lon < maxLon)
+            shortlist = self.get_location_shortlist(minLon, minLat,
+                                                    maxLon, maxLat)
+            if shortlist is not None:
+                # Shortlist from the spatial index
+                query = shortlist & query
             deleted = (locations.deleted == False)
             empty = (locations.lat != None) & (locations.lon != None)
             query = deleted & empty & query
@@ -1944,54 +2510,9 @@ class GIS(object):
             # Build the Popup Tooltips now so that representations can be
             # looked-up in bulk rather than as a separate lookup per record
             label_off = request.vars.get("label_off", None)
-            if popup_label and not label_off:
-                _tooltip = "(%s)" % current.T(popup_label)
-            else:
-                _tooltip = ""
-
-            if popup_fields:
-                popup_fields = popup_fields.split("/")
-
-            if popup_fields:
-                represents = {}
-                for fieldname in popup_fields:
-                    if fieldname in table:
-                        field = table[fieldname]
-                        _represents = GIS.get_representation(field, resource)
-                        represents[fieldname] = _represents
-                    else:
-                        # Assume a virtual field
-                        represents[fieldname] = None
-
-            for record in resource:
-                tooltip = _tooltip
-                if popup_fields:
-                    first = True
-                    for fieldname in popup_fields:
-                        try:
-                            value = record[fieldname]
-                        except KeyError:
-                            continue
-                        if not value:
-                            continue
-                        field_reps = represents[fieldname]
-                        if field_reps:
-                            try:
-                                represent = field_reps[value]
-                            except:
-                                # list:string
-                                represent = field_reps[str(value)]
-                        else:
-                            # Virtual Field
-                            represent = value
-                        if first:
-                            tooltip = "%s %s" % (represent, tooltip)
-                            first = False
-                        elif value:
-                            tooltip = "%s<br />%s" % (tooltip, represent)
-
-                tooltips[record.id] = tooltip
-
+            if label_off:
+                popup_label = ""
+            tooltips = GIS.get_popups(resource, popup_label, popup_fields)
             tooltips[tablename] = tooltips
 
             if DEBUG:
@@ -2022,12 +2543,13 @@ class GIS(object):
                 pass
             else:
                 _latlons = tracker.get_location(_fields=[gtable.lat,
-                                                         gtable.lon])
-                index = 0
-                for id in ids:
-                    _location = _latlons[index]
-                    latlons[id] = (_location.lat, _location.lon)
-                    index += 1
+                                                         gtable.lon],
+                                                as_rows=True)
+                pkey = table._id.name
+                for record, _location in zip(tracker.records, _latlons):
+                    record_id = record.get(pkey, None)
+                    if record_id is not None:
+                        latlons[record_id] = (_location.lat, _location.lon)
 
         if not latlons:
             if "location_id" in table.fields:
@@ -2043,36 +2565,43 @@ class GIS(object):
                 return None
 
             if polygons:
+                # Simplify the polygons to reduce download size (as far
+                # as the zoom level of the map allows)
+                # & also to work around the recursion limit in libxslt
+                # http://blog.gmane.org/gmane.comp.python.lxml.devel/day=20120309
+                tolerance = gis.get_simplify_tolerance()
                 if current.deployment_settings.get_gis_spatialdb():
                     if format == "geojson":
                         # Do the Simplify & GeoJSON direct from the DB
                         rows = db(query).select(table.id,
-                                                gtable.the_geom.st_simplify(0.001).st_asgeojson(precision=4).with_alias("geojson"))
+                                                gtable.the_geom.st_simplify(tolerance).st_asgeojson(precision=4).with_alias("geojson"))
                         for row in rows:
                             geojsons[row[tablename].id] = row["gis_location"].geojson
                     else:
                         # Do the Simplify direct from the DB
                         rows = db(query).select(table.id,
-                                                gtable.the_geom.st_simplify(0.001).st_astext().with_alias("wkt"))
+                                                gtable.the_geom.st_simplify(tolerance).st_astext().with_alias("wkt"))
                         for row in rows:
                             wkts[row[tablename].id] = row["gis_location"].wkt
                 else:
+                    # Use the pre-simplified geometries
                     rows = db(query).select(table.id,
-                                            gtable.wkt)
+                                            gtable.id)
+                    location_ids = dict((row[tablename].id,
+                                         row["gis_location"].id)
+                                        for row in rows)
                     if format == "geojson":
-                        for row in rows:
-                            # Simplify the polygon to reduce download size
-                            geojson = gis.simplify(row["gis_location"].wkt, output="geojson")
-                            if geojson:
-                                geojsons[row[tablename].id] = geojson
+                        output = "geojson"
+                        geometries = geojsons
                     else:
-                        for row in rows:
-                            # Simplify the polygon to reduce download size
-                            # & also to work around the recursion limit in libxslt
-                            # http://blog.gmane.org/gmane.comp.python.lxml.devel/day=20120309
-                            wkt = gis.simplify(row["gis_location"].wkt)
-                            if wkt:
-                                wkts[row[tablename].id] = wkt
+                        output = "wkt"
+                        geometries = wkts
+                    simplified = gis.get_simplified(location_ids.values(),
+                                                    tolerance=tolerance,
+                                                    output=output)
+                    for id, location_id in location_ids.items():
+                        if location_id in simplified:
+                            geometries[id] = simplified[location_id]
 
             else:
                 # Points
@@ -2105,6 +2634,407 @@ class GIS(object):
                     tooltips = tooltips,
                     )
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_popups(resource, popup_label=None, popup_fields=None):
+        """
+            Build the Popup Tooltips for all records of a resource, with
+            the representations looked-up in bulk
+
+            @param resource: the S3Resource
+            @param popup_label: the label to append to the tooltips
+            @param popup_fields: the fields to show, as "field1/field2/..."
+
+            @returns: dict {record_id: tooltip}
+        """
+
+        table = resource.table
+        tooltips = {}
+
+        if popup_label:
+            _tooltip = "(%s)" % current.T(popup_label)
+        else:
+            _tooltip = ""
+
+        if popup_fields:
+            popup_fields = popup_fields.split("/")
+
+        if popup_fields:
+            represents = {}
+            for fieldname in popup_fields:
+                if fieldname in table:
+                    field = table[fieldname]
+                    _represents = GIS.get_representation(field, resource)
+                    represents[fieldname] = _represents
+                else:
+                    # Assume a virtual field
+                    represents[fieldname] = None
+
+        for record in resource:
+            tooltip = _tooltip
+            if popup_fields:
+                first = True
+                for fieldname in popup_fields:
+                    try:
+                        value = record[fieldname]
+                    except KeyError:
+                        continue
+                    if not value:
+                        continue
+                    field_reps = represents[fieldname]
+                    if field_reps:
+                        try:
+                            represent = field_reps[value]
+                        except:
+                            # list:string
+                            represent = field_reps[str(value)]
+                    else:
+                        # Virtual Field
+                        represent = value
+                    if first:
+                        tooltip = "%s %s" % (represent, tooltip)
+                        first = False
+                    elif value:
+                        tooltip = "%s<br />%s" % (tooltip, represent)
+
+            tooltips[record.id] = tooltip
+
+        return tooltips
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def tile_bounds(z, x, y):
+        """
+            Bounds of a tile in the (Spherical Mercator) XYZ tiling scheme
+
+            @param z: the zoom level
+            @param x: the tile column (from 180W eastwards)
+            @param y: the tile row (from 85N southwards)
+
+            @returns: tuple (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        import math
+
+        n = 2.0 ** z
+        def lat(row):
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+        return (x / n * 360.0 - 180.0,
+                lat(y + 1),
+                (x + 1) / n * 360.0 - 180.0,
+                lat(y))
+
+    # -------------------------------------------------------------------------
+    def get_feature_tile(self, layer_id, z, x, y):
+        """
+            Get a tile of the features of a Feature Layer as GeoJSON
+
+            The features are pre-filtered by the bounds of their
+            locations, polygons are simplified for the zoom level and
+            clipped to the tile, and coordinates are rounded to the
+            resolution of the tile. Tiles are cached on disk, per
+            accessible query, until records in the tile are added,
+            modified or removed.
+
+            @param layer_id: the gis_layer_feature record ID
+            @param z: the zoom level
+            @param x: the tile column
+            @param y: the tile row
+
+            @returns: the GeoJSON FeatureCollection (str), or None if the
+                      layer doesn't exist or can't be shown on a map
+        """
+
+        import hashlib
+        import math
+
+        db = current.db
+        s3db = current.s3db
+
+        ftable = s3db.gis_layer_feature
+        query = (ftable.id == layer_id) & \
+                (ftable.deleted != True)
+        layer = db(query).select(ftable.controller,
+                                 ftable.function,
+                                 ftable.module,
+                                 ftable.resource,
+                                 ftable.filter,
+                                 ftable.popup_label,
+                                 ftable.popup_fields,
+                                 ftable.polygons,
+                                 limitby=(0, 1)).first()
+        if not layer:
+            return None
+        prefix = layer.controller or layer.module # Backwards-compatibility
+        name = layer.function or layer.resource   # Backwards-compatibility
+        if not prefix or not name or \
+           not s3db.table("%s_%s" % (prefix, name)):
+            return None
+
+        vars = {}
+        if layer.filter:
+            from urlparse import parse_qs
+            for k, v in parse_qs(layer.filter).items():
+                vars[k] = len(v) == 1 and v[0] or v
+        resource = current.manager.define_resource(prefix, name, vars=vars)
+        table = resource.table
+
+        gtable = s3db.gis_location
+        if "location_id" in table.fields:
+            join = (table.location_id == gtable.id)
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            join = (table.site_id == stable.site_id) & \
+                   (stable.location_id == gtable.id)
+        else:
+            # Can't display this resource on the Map
+            return None
+
+        # Pre-filter by the bounds of the locations
+        lon_min, lat_min, lon_max, lat_max = self.tile_bounds(z, x, y)
+        query = resource.get_query() & join & \
+                (gtable.lat_max >= lat_min) & \
+                (gtable.lat_min <= lat_max) & \
+                (gtable.lon_max >= lon_min) & \
+                (gtable.lon_min <= lon_max)
+        left = resource.rfilter.get_left_joins()
+
+        # Cache signature: the query (incl. the accessible query) and
+        # the number and last modification of the records in the tile
+        count = table.id.count()
+        mtime = table.modified_on.max()
+        gmtime = gtable.modified_on.max()
+        row = db(query).select(count, mtime, gmtime, left=left).first()
+        key = hashlib.md5(str(query)).hexdigest()
+        signature = hashlib.md5("%s|%s|%s" % (row[count],
+                                              row[mtime],
+                                              row[gmtime])).hexdigest()
+        path = os.path.join(current.request.folder, "uploads", "gis_cache",
+                            "tiles", str(layer_id), str(z), str(x), str(y))
+        filename = os.path.join(path, "%s-%s.json" % (key, signature))
+        if os.path.exists(filename):
+            f = open(filename, "rb")
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+        # Round coordinates to the resolution of the tile (256px)
+        resolution = (lon_max - lon_min) / 256
+        precision = max(0, int(math.ceil(-math.log10(resolution))))
+
+        rows = db(query).select(table.id,
+                                gtable.id,
+                                gtable.lat,
+                                gtable.lon,
+                                gtable.gis_feature_type,
+                                left=left)
+        ids = []
+        points = {}
+        shapes = {}
+        for row in rows:
+            record_id = row[table._tablename].id
+            location = row["gis_location"]
+            ids.append(record_id)
+            if layer.polygons and location.gis_feature_type not in (None, 1):
+                shapes[record_id] = location.id
+            elif location.lat is not None and location.lon is not None:
+                points[record_id] = [round(location.lon, precision),
+                                     round(location.lat, precision)]
+
+        geometries = {}
+        if shapes:
+            from shapely.geometry import box, mapping
+            from shapely.wkt import loads as wkt_loads
+            tolerance = self.get_simplify_tolerance({"zoom": z})
+            simplified = self.get_simplified(shapes.values(),
+                                             tolerance=tolerance)
+            # Clip with a margin of 1 pixel to avoid seams
+            bounds = box(lon_min - resolution, lat_min - resolution,
+                         lon_max + resolution, lat_max + resolution)
+            def quantise(coords):
+                if coords and isinstance(coords[0], (int, long, float)):
+                    return [round(c, precision) for c in coords]
+                return [quantise(c) for c in coords]
+            for record_id, location_id in shapes.items():
+                wkt = simplified.get(location_id)
+                if not wkt:
+                    continue
+                try:
+                    shape = wkt_loads(wkt).intersection(bounds)
+                except:
+                    continue
+                if shape.is_empty:
+                    continue
+                geometry = mapping(shape)
+                if "coordinates" in geometry:
+                    geometry = dict(geometry)
+                    geometry["coordinates"] = quantise(geometry["coordinates"])
+                geometries[record_id] = geometry
+
+        tooltips = {}
+        if ids:
+            resource = current.manager.define_resource(prefix, name, id=ids)
+            tooltips = self.get_popups(resource,
+                                       layer.popup_label,
+                                       layer.popup_fields)
+
+        features = []
+        for record_id in ids:
+            if record_id in geometries:
+                geometry = geometries[record_id]
+            elif record_id in points:
+                geometry = {"type": "Point",
+                            "coordinates": points[record_id]}
+            else:
+                continue
+            features.append({"type": "Feature",
+                             "id": record_id,
+                             "geometry": geometry,
+                             "properties": {"id": record_id,
+                                            "popup": s3_unicode(tooltips.get(record_id, "")),
+                                            },
+                             })
+        output = json.dumps({"type": "FeatureCollection",
+                             "features": features},
+                            separators=(",", ":"))
+
+        # Replace outdated versions of the tile
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            for old in os.listdir(path):
+                if old.startswith("%s-" % key):
+                    os.remove(os.path.join(path, old))
+            f = open(filename, "wb")
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            s3_debug("GIS: Feature tiles cannot be cached: %s" % e)
+        return output
+
+    # -------------------------------------------------------------------------
+    def get_clusters(self, resource, zoom, bounds=None, layer_id=None):
+        """
+            Cluster the features of a resource on the server, for dense
+            point layers: returns the centroids and sizes of the clusters
+            within the bounds, and individual features where a cluster
+            has only one member
+
+            The points are aggregated into a cached grid index (see
+            S3ClusterIndex), so that panning doesn't re-scan the table.
+
+            @param resource: the S3Resource
+            @param zoom: the zoom level of the map
+            @param bounds: the viewport, tuple (lon_min, lat_min, lon_max,
+                           lat_max), or None for all clusters
+            @param layer_id: the gis_layer_feature record ID (for popups)
+
+            @returns: the GeoJSON FeatureCollection (str), or None if
+                      the features should not be clustered
+        """
+
+        import hashlib
+
+        if zoom > S3ClusterIndex.MAX_ZOOM:
+            # Show individual features
+            return None
+
+        db = current.db
+        s3db = current.s3db
+        table = resource.table
+        tablename = resource.tablename
+
+        gtable = s3db.gis_location
+        if "location_id" in table.fields:
+            join = (table.location_id == gtable.id)
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            join = (table.site_id == stable.site_id) & \
+                   (stable.location_id == gtable.id)
+        else:
+            # Can't display this resource on the Map
+            return None
+
+        query = resource.get_query() & join
+        left = resource.rfilter.get_left_joins()
+
+        count = table.id.count()
+        mtime = table.modified_on.max()
+        gmtime = gtable.modified_on.max()
+        row = db(query).select(count, mtime, gmtime, left=left).first()
+        signature = (row[count], row[mtime], row[gmtime])
+        key = hashlib.md5(str(query)).hexdigest()
+
+        def points():
+            rows = db(query).select(table.id,
+                                    gtable.lon,
+                                    gtable.lat,
+                                    left=left)
+            return [(row[tablename].id,
+                     row["gis_location"].lon,
+                     row["gis_location"].lat) for row in rows]
+
+        grid = S3ClusterIndex.get(key, signature, points)
+        cells = S3ClusterIndex.cells(grid, zoom).values()
+
+        clusters = []
+        singles = []
+        for size, lon, lat, record_id in cells:
+            lon = lon / size
+            lat = lat / size
+            if bounds:
+                lon_min, lat_min, lon_max, lat_max = bounds
+                if not (lon_min <= lon <= lon_max and \
+                        lat_min <= lat <= lat_max):
+                    continue
+            if size == 1:
+                singles.append((record_id, lon, lat))
+            else:
+                clusters.append((size, lon, lat))
+
+        features = []
+        for size, lon, lat in clusters:
+            features.append({"type": "Feature",
+                             "geometry": {"type": "Point",
+                                          "coordinates": [round(lon, 6),
+                                                          round(lat, 6)]},
+                             "properties": {"count": size},
+                             })
+        if singles:
+            popup_label = popup_fields = None
+            if layer_id:
+                ftable = s3db.gis_layer_feature
+                layer = db(ftable.id == layer_id).select(ftable.popup_label,
+                                                         ftable.popup_fields,
+                                                         limitby=(0, 1)).first()
+                if layer:
+                    popup_label = layer.popup_label
+                    popup_fields = layer.popup_fields
+            ids = [single[0] for single in singles]
+            _resource = current.manager.define_resource(resource.prefix,
+                                                        resource.name,
+                                                        id=ids)
+            tooltips = self.get_popups(_resource, popup_label, popup_fields)
+            for record_id, lon, lat in singles:
+                features.append({"type": "Feature",
+                                 "id": record_id,
+                                 "geometry": {"type": "Point",
+                                              "coordinates": [round(lon, 6),
+                                                              round(lat, 6)]},
+                                 "properties": {"id": record_id,
+                                                "count": 1,
+                                                "popup": s3_unicode(tooltips.get(record_id, "")),
+                                                },
+                                 })
+
+        return json.dumps({"type": "FeatureCollection",
+                           "features": features},
+                          separators=(",", ":"))
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_representation(field,
@@ -2237,21 +3167,26 @@ class GIS(object):
                 (table.location_id == gtable.id)
 
         geojsons = {}
+        gis = current.gis
+        tolerance = gis.get_simplify_tolerance()
         if current.deployment_settings.get_gis_spatialdb():
             # Do the Simplify & GeoJSON direct from the DB
             rows = db(query).select(table.id,
-                                    gtable.the_geom.st_simplify(0.001).st_asgeojson(precision=4).with_alias("geojson"))
+                                    gtable.the_geom.st_simplify(tolerance).st_asgeojson(precision=4).with_alias("geojson"))
             for row in rows:
                 geojsons[row[tablename].id] = row["gis_location"].geojson
         else:
+            # Use the pre-simplified geometries
             rows = db(query).select(table.id,
-                                    gtable.wkt)
-            gis = current.gis
-            for row in rows:
-                # Simplify the polygon to reduce download size
-                geojson = gis.simplify(row["gis_location"].wkt, output="geojson")
-                if geojson:
-                    geojsons[row[tablename].id] = geojson
+                                    gtable.id)
+            location_ids = dict((row[tablename].id, row["gis_location"].id)
+                                for row in rows)
+            simplified = gis.get_simplified(location_ids.values(),
+                                            tolerance=tolerance,
+                                            output="geojson")
+            for id, location_id in location_ids.items():
+                if location_id in simplified:
+                    geojsons[id] = simplified[location_id]
 
             _geojsons = {}
             _geojsons[tablename] = geojsons
@@ -3298,37 +4233,456 @@ class GIS(object):
             Called onaccept for locations (async, where-possible)
         """
 
+        if not feature:
+            # Drop the location name index while rebuilding the tree
+            S3LocationNameIndex.clear()
+
+        path = self._update_location_tree(feature)
+
+        if feature:
+            location_id = feature.get("id")
+            # Update the ancestors and the location name index
+            self.update_location_ancestors(location_id, path=path)
+            S3LocationNameIndex.update(location_id)
+            # Pre-simplify the geometry, unless already cached
+            if location_id:
+                self.update_simplified(location_id, refresh=False)
+        else:
+            self.rebuild_location_ancestors()
+            S3LocationNameIndex.clear()
+            # Bounds have been updated in bulk
+            S3SpatialIndex.clear()
+        return path
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_location_ancestors(location_id, path=None):
+        """
+            Update the gis_location_ancestor entries of a location, and
+            of its descendants if it has been moved in the hierarchy
+
+            @param location_id: the location record ID
+            @param path: the (updated) path of the location
+        """
+
+        if not location_id:
+            return
+        location_id = int(location_id)
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location
+        atable = s3db.gis_location_ancestor
+
+        if path is None:
+            row = db(table.id == location_id).select(table.path,
+                                                     limitby=(0, 1)).first()
+            if not row:
+                return
+            path = row.path
+        if path:
+            ancestors = [int(i) for i in str(path).split("/")[:-1] if i]
+            ancestors.reverse()
+        else:
+            ancestors = []
+
+        # Check whether anything has changed
+        query = (atable.location_id == location_id)
+        rows = db(query).select(atable.ancestor_id,
+                                atable.depth,
+                                orderby=atable.depth)
+        if [row.ancestor_id for row in rows] == ancestors:
+            return
+
+        if ancestors:
+            query = (table.id.belongs(ancestors))
+            levels = dict((row.id, row.level)
+                          for row in db(query).select(table.id, table.level))
+        else:
+            levels = {}
+
+        # Replace the ancestors of the location
+        db(atable.location_id == location_id).delete()
+        bulk_insert = atable.bulk_insert
+        bulk_insert([dict(location_id=location_id,
+                          ancestor_id=ancestor_id,
+                          level=levels.get(ancestor_id),
+                          depth=depth)
+                     for depth, ancestor_id in enumerate(ancestors, 1)])
+
+        # Replace the ancestors above this location for all descendants
+        query = (atable.ancestor_id == location_id)
+        rows = db(query).select(atable.location_id,
+                                atable.depth)
+        descendants = {}
+        for row in rows:
+            descendants.setdefault(row.depth, []).append(row.location_id)
+        for depth, ids in descendants.items():
+            query = (atable.location_id.belongs(ids)) & \
+                    (atable.depth > depth)
+            db(query).delete()
+            bulk_insert([dict(location_id=descendant_id,
+                              ancestor_id=ancestor_id,
+                              level=levels.get(ancestor_id),
+                              depth=depth + i)
+                         for descendant_id in ids
+                         for i, ancestor_id in enumerate(ancestors, 1)])
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def rebuild_location_ancestors():
+        """
+            Rebuild the gis_location_ancestor table from the location paths
+        """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location
+        atable = s3db.gis_location_ancestor
+
+        db(atable.id > 0).delete()
+        rows = db(table.id > 0).select(table.id,
+                                       table.level,
+                                       table.path)
+        levels = dict((row.id, row.level) for row in rows)
+
+        entries = []
+        append = entries.append
+        bulk_insert = atable.bulk_insert
+        for row in rows:
+            if not row.path:
+                continue
+            ancestors = [int(i) for i in row.path.split("/")[:-1] if i]
+            ancestors.reverse()
+            for depth, ancestor_id in enumerate(ancestors, 1):
+                append(dict(location_id=row.id,
+                            ancestor_id=ancestor_id,
+                            level=levels.get(ancestor_id),
+                            depth=depth))
+            if len(entries) >= 1000:
+                bulk_insert(entries)
+                del entries[:]
+        if entries:
+            bulk_insert(entries)
+        return
+
+    # -------------------------------------------------------------------------
+    def rebuild_location_tree(self, processes=None, chunk_size=1000, run=None):
+        """
+            Bulk rebuild of the whole location tree: compute the bounds
+            and centroids of all WKT geometries (in a worker pool), then
+            the paths, Lx names and inherited Lat/Lon of all locations in
+            a single breadth-first pass over the hierarchy in memory, and
+            write back the changes in batches
+
+            Progress is saved per run after each batch, so that an
+            interrupted rebuild can be resumed by calling again with
+            the same run identifier.
+
+            @param processes: number of worker processes for the geometry
+                              computations (default: number of CPUs,
+                              1 = no worker pool)
+            @param chunk_size: number of records per batch
+            @param run: identifier of an interrupted run to resume,
+                        None to start a new run
+
+            @returns: Storage with the run identifier, the number of
+                      records processed and updated, and the duration
+                      in seconds
+        """
+
+        import time
+        import uuid
+
+        db = current.db
+        table = current.s3db.gis_location
+        pkey = table._id.name
+
+        start = time.time()
+        if run is None:
+            run = uuid.uuid4().hex
+            progress = {}
+        else:
+            progress = self._rebuild_progress(run)
+        stage = progress.get("stage")
+        processed = 0
+        updated = 0
+
+        # Geometries ----------------------------------------------------------
+        #
+        if stage in (None, "geometry"):
+            if stage:
+                last = progress.get("last", 0)
+            else:
+                last = 0
+            if processes is None:
+                try:
+                    import multiprocessing
+                    processes = multiprocessing.cpu_count()
+                except (ImportError, NotImplementedError):
+                    processes = 1
+            if processes > 1:
+                import multiprocessing
+                pool = multiprocessing.Pool(processes)
+                imap = lambda items: pool.imap(_wkt_bounds, items, 50)
+            else:
+                pool = None
+                imap = lambda items: map(_wkt_bounds, items)
+
+            fields = ("gis_feature_type", "lat", "lon",
+                      "lat_min", "lat_max", "lon_min", "lon_max")
+            base = (table.wkt != None) & (table.wkt != "")
+            try:
+                while True:
+                    query = base & (table._id > last)
+                    rows = db(query).select(table._id,
+                                            table.wkt,
+                                            orderby=table._id,
+                                            limitby=(0, chunk_size))
+                    if not rows:
+                        break
+                    items = [(row[pkey], row.wkt) for row in rows]
+                    last = items[-1][0]
+                    results = [r for r in imap(items) if r is not None]
+                    self._bulk_update(table, fields, results)
+                    processed += len(items)
+                    updated += len(results)
+                    self._rebuild_progress(run, stage="geometry", last=last)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            progress = self._rebuild_progress(run, stage="hierarchy", last=0)
+
+        # Hierarchy -----------------------------------------------------------
+        #
+        # Load the skeleton of the tree
+        last = progress.get("last", 0)
+        keys = self.hierarchy_level_keys
+        fields = [table._id, table.parent, table.level, table.name,
+                  table.inherited, table.lat, table.lon, table.path] + \
+                 [table[key] for key in keys]
+        sql = db(table._id > 0)._select(*fields)
+        records = {}
+        children = {}
+        for record in db.executesql(sql):
+            record = list(record)
+            records[record[0]] = record
+            children.setdefault(record[1], []).append(record[0])
+        # Locations with their own geometry never inherit Lat/Lon
+        sql = db((table.wkt != None) & (table.wkt != ""))._select(table._id)
+        geometries = set(row[0] for row in db.executesql(sql))
+
+        # Breadth-first, starting at the roots
+        queue = [i for i in records
+                 if not records[i][1] or records[i][1] not in records]
+        updates = []
+        inherit = []
+        own = []
+        while queue:
+            level_queue = []
+            for location_id in queue:
+                record = records[location_id]
+                location_id, parent, level, name, inherited, lat, lon, path = \
+                                                                    record[:8]
+                lx = record[8:]
+                parent = records.get(parent)
+                if parent:
+                    _path = "%s/%s" % (parent[7], location_id)
+                    _lx = list(parent[8:])
+                    parent_lat = parent[5]
+                    parent_lon = parent[6]
+                else:
+                    _path = str(location_id)
+                    _lx = [None] * len(keys)
+                    parent_lat = parent_lon = None
+                if level in keys:
+                    # Set the names of this and higher levels only
+                    index = keys.index(level)
+                    _lx[index] = name
+                    _lx[index + 1:] = lx[index + 1:]
+                    level_lx = list(_lx)
+                    # Children inherit the names of the levels above
+                    _lx[index + 1:] = [None] * (len(keys) - index - 1)
+                else:
+                    level_lx = list(_lx)
+                if level != "L0" and location_id not in geometries and \
+                   (inherited or lat is None or lon is None):
+                    if not inherited:
+                        inherit.append(location_id)
+                    inherited = True
+                    _lat = parent_lat
+                    _lon = parent_lon
+                else:
+                    if inherited and location_id in geometries:
+                        own.append(location_id)
+                        inherited = False
+                    _lat = lat
+                    _lon = lon
+                if _path != path or level_lx != lx or \
+                   _lat != lat or _lon != lon:
+                    updates.append([_path] + level_lx +
+                                   [_lat, _lon, location_id])
+                # Remember the results for the children
+                record[4:8] = [inherited, _lat, _lon, _path]
+                record[8:] = _lx
+                level_queue.extend(children.get(location_id, []))
+            queue = level_queue
+        processed += len(records)
+
+        # Write back in batches (in order of IDs, to be able to resume)
+        updates.sort(key=lambda u: u[-1])
+        inherit.sort()
+        fields = ["path"] + keys + ["lat", "lon"]
+        for i in xrange(0, len(updates), chunk_size):
+            batch = [u for u in updates[i:i + chunk_size] if u[-1] > last]
+            if not batch:
+                continue
+            self._bulk_update(table, fields, batch)
+            last = batch[-1][-1]
+            ids = [j for j in inherit if j <= last]
+            if ids:
+                db(table._id.belongs(ids)).update(inherited=True)
+                inherit = inherit[len(ids):]
+            updated += len(batch)
+            self._rebuild_progress(run, stage="hierarchy", last=last)
+        if inherit:
+            db(table._id.belongs(inherit)).update(inherited=True)
+        if own:
+            db(table._id.belongs(own)).update(inherited=False)
+
+        # Point geometries ----------------------------------------------------
+        #
+        query = ((table.wkt == None) | (table.wkt == "")) & \
+                (table.lat != None) & (table.lon != None) & \
+                (table.inherited != True)
+        rows = db(query).select(table._id, table.lat, table.lon)
+        points = [("POINT(%s %s)" % (row.lon, row.lat), 1,
+                   row.lat, row.lat, row.lon, row.lon, row[pkey])
+                  for row in rows]
+        fields = ("wkt", "gis_feature_type",
+                  "lat_min", "lat_max", "lon_min", "lon_max")
+        for i in xrange(0, len(points), chunk_size):
+            self._bulk_update(table, fields, points[i:i + chunk_size])
+        updated += len(points)
+
+        self._rebuild_progress(run, stage=None)
+        duration = time.time() - start
+        rate = duration and processed / duration or processed
+        s3_debug("Location tree rebuilt: %s records processed, %s updated "
+                 "in %.1f seconds (%.0f records/s)" % \
+                 (processed, updated, duration, rate))
+        return Storage(run=run,
+                       processed=processed,
+                       updated=updated,
+                       duration=duration)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _rebuild_progress(run, **progress):
+        """
+            Read or save the progress of a run of rebuild_location_tree,
+            so that an interrupted rebuild can be resumed
+
+            @param run: the run identifier
+            @param progress: the progress to save (stage=None to clear),
+                             nothing to read the saved progress
+            @returns: the progress as dict
+        """
+
+        path = os.path.join(current.request.folder, "private",
+                            "location_tree_rebuild-%s.json" % run)
+        db = current.db
+        if not progress:
+            try:
+                f = open(path, "r")
+                try:
+                    return json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                return {}
+        # Commit the batch before recording it as done
+        db.commit()
+        if progress.get("stage") is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            f = open(path, "w")
+            try:
+                json.dump(progress, f)
+            finally:
+                f.close()
+        return progress
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bulk_update(table, fields, rows):
+        """
+            Update multiple records with a single executemany, setting
+            modified_on and journaling the changes like a DAL update
+
+            @param table: the table
+            @param fields: the names of the fields to update
+            @param rows: list of tuples of the field values, with the
+                         record ID appended
+        """
+
+        if not rows:
+            return
+
+        db = current.db
+        adapter = db._adapter
+        driver = getattr(adapter, "driver", None)
+        paramstyle = getattr(driver, "paramstyle", None)
+        if paramstyle not in ("qmark", "format", "pyformat"):
+            # Fall back to one update per record
+            pkey = table._id
+            for row in rows:
+                values = dict(zip(fields, row[:-1]))
+                db(pkey == row[-1]).update(**values)
+            return
+
+        # Journal the changes for sync (DAL callbacks are bypassed)
+        from s3sync import S3SyncJournal
+        ids = [row[-1] for row in rows]
+        S3SyncJournal.write_set(table, db(table._id.belongs(ids)), "update")
+
+        fields = list(fields)
+        if "modified_on" in table.fields:
+            # Mark the records as modified (e.g. for sync and caches)
+            fields.append("modified_on")
+            now = current.request.utcnow
+            rows = [list(row[:-1]) + [now, row[-1]] for row in rows]
+        if paramstyle == "qmark":
+            placeholder = "?"
+            # sqlite3 expects unicode for non-ASCII strings
+            rows = [[isinstance(v, str) and v.decode("utf-8") or v
+                     for v in row] for row in rows]
+        else:
+            placeholder = "%s"
+        sql = "UPDATE %s SET %s WHERE %s=%s;" % \
+              (table._tablename,
+               ", ".join(["%s=%s" % (f, placeholder) for f in fields]),
+               table._id.name,
+               placeholder)
+        adapter.cursor.executemany(sql, rows)
+        return
+
+    # -------------------------------------------------------------------------
+    def _update_location_tree(self, feature=None):
+        """
+            Update GIS Locations' Materialized path, Lx locations & Lat/Lon
+            (without updating the location name index)
+
+            @param feature: a feature dict to update the tree for
+            - if not provided then update the whole tree
+        """
+
         if not feature:
             # Do the whole database
-            # Do in chunks to save memory and also do in correct order
-            db = current.db
-            table = db.gis_location
-            fields = [table.id, table.name, table.gis_feature_type,
-                      table.L0, table.L1, table.L2, table.L3, table.L4,
-                      table.lat, table.lon, table.wkt, table.inherited,
-                      table.path, table.parent]
-            update_location_tree = self.update_location_tree
-            wkt_centroid = self.wkt_centroid
-            for level in ["L0", "L1", "L2", "L3", "L4", "L5", None]:
-                features = db(table.level == level).select(*fields)
-                for feature in features:
-                    feature["level"] = level
-                    update_location_tree(feature)
-                    # Also do the Bounds/Centroid/WKT
-                    form = Storage()
-                    form.vars = feature
-                    form.errors = Storage()
-                    wkt_centroid(form)
-                    _vars = form.vars
-                    if "lat_max" in _vars:
-                        db(table.id == feature.id).update(gis_feature_type = _vars.gis_feature_type,
-                                                          lat = _vars.lat,
-                                                          lon = _vars.lon,
-                                                          wkt = _vars.wkt,
-                                                          lat_max = _vars.lat_max,
-                                                          lat_min = _vars.lat_min,
-                                                          lon_min = _vars.lon_min,
-                                                          lon_max = _vars.lon_max)
+            self.rebuild_location_tree()
             return
 
         id = "id" in feature and str(feature["id"])
@@ -4168,6 +5522,28 @@ class GIS(object):
 
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_location_shortlist(lon_min, lat_min, lon_max, lat_max):
+        """
+            Shortlist the Locations whose bounds may intersect a bounding
+            box, using the in-memory spatial index (non-spatial databases
+            only). The shortlist does not replace the bbox conditions.
+
+            @returns: a Query, or None if the index should not be used
+                      (spatial database, or too many candidates to filter
+                      by ID)
+        """
+
+        if current.deployment_settings.get_gis_spatialdb():
+            return None
+        try:
+            return S3SpatialIndex.query(float(lon_min), float(lat_min),
+                                        float(lon_max), float(lat_max),
+                                        max_ids=GIS.MAX_BBOX_IDS)
+        except (ValueError, TypeError):
+            return None
+
     # -------------------------------------------------------------------------
     @staticmethod
     def query_features_by_bbox(lon_min, lat_min, lon_max, lat_max):
@@ -4180,6 +5556,10 @@ class GIS(object):
                 (table.lat_max >= lat_min) & \
                 (table.lon_min <= lon_max) & \
                 (table.lon_max >= lon_min)
+        shortlist = GIS.get_location_shortlist(lon_min, lat_min,
+                                               lon_max, lat_max)
+        if shortlist is not None:
+            query = shortlist & query
         return query
 
     # -------------------------------------------------------------------------
@@ -4336,6 +5716,210 @@ class GIS(object):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get_simplify_tolerance(cls, vars=None):
+        """
+            Choose the tolerance for simplified geometries from the map
+            zoom level or bounding box of the request: the coarsest tier
+            which is still below the size of a pixel
+
+            @param vars: the request vars (default: current.request.get_vars),
+                         zoom=<level> or bbox=<minLon>,<minLat>,<maxLon>,<maxLat>
+        """
+
+        if vars is None:
+            vars = current.request.get_vars
+
+        resolution = None
+        zoom = vars.get("zoom", None)
+        if zoom is not None:
+            try:
+                # Degrees per pixel of 256px tiles
+                resolution = 360.0 / (256 * 2 ** int(zoom))
+            except (ValueError, TypeError, OverflowError):
+                pass
+        if resolution is None:
+            for k in vars:
+                if k[:4] == "bbox":
+                    try:
+                        minLon, minLat, maxLon, maxLat = \
+                            [float(v) for v in vars[k].split(",")]
+                    except ValueError:
+                        continue
+                    # Assume a map about 1000px wide
+                    resolution = abs(maxLon - minLon) / 1000.0
+                    break
+        if resolution is None:
+            return 0.001
+
+        tolerances = cls.SIMPLIFY_TOLERANCES
+        for tolerance in tolerances:
+            if tolerance <= resolution:
+                return tolerance
+        return tolerances[-1]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get_simplified(cls, location_ids, tolerance=0.001, output="wkt"):
+        """
+            Get the simplified geometries of locations from the cache;
+            Lines & Polygons which are not cached yet are simplified on
+            the fly, and left to the async task to cache (nothing is
+            written to the cache here)
+
+            @param location_ids: list of gis_location IDs
+            @param tolerance: the tolerance, one of SIMPLIFY_TOLERANCES
+            @param output: "wkt" or "geojson"
+
+            @returns: dict {location_id: geometry}
+        """
+
+        db = current.db
+        s3db = current.s3db
+        gtable = s3db.gis_location
+        table = s3db.gis_location_simplified
+
+        geometries = {}
+        if not location_ids:
+            return geometries
+
+        tolerances = cls.SIMPLIFY_TOLERANCES
+        if tolerance in tolerances:
+            tier = tolerances.index(tolerance)
+            left = table.on((table.location_id == gtable.id) & \
+                            (table.tier == tier))
+            cached = table[output]
+        else:
+            tier = left = cached = None
+        fields = [gtable.id, gtable.gis_feature_type, gtable.lat, gtable.lon]
+        if cached:
+            fields.append(cached)
+        rows = db(gtable.id.belongs(location_ids)).select(left=left, *fields)
+
+        simplify = cls.simplify
+        missing = []
+        for row in rows:
+            if cached:
+                location = row[gtable._tablename]
+                geometry = row[table._tablename][output]
+            else:
+                location = row
+                geometry = None
+            if location.gis_feature_type in (None, 0, 1):
+                # Points: from Lat/Lon, no need to simplify or cache
+                if location.lat is not None and location.lon is not None:
+                    wkt = "POINT(%s %s)" % (location.lon, location.lat)
+                    geometries[location.id] = simplify(wkt, output=output)
+            elif geometry is None:
+                missing.append(location.id)
+            elif geometry:
+                geometries[location.id] = geometry
+            # else: cached as having no valid geometry
+
+        # Lines & Polygons which are not cached (yet)
+        if missing:
+            rows = db(gtable.id.belongs(missing)).select(gtable.id, gtable.wkt)
+            for row in rows:
+                geometry = simplify(row.wkt,
+                                    tolerance=tolerance,
+                                    output=output)
+                if geometry:
+                    geometries[row.id] = geometry
+            if tier is not None:
+                # Fill the cache in the background (only if a worker
+                # is alive, otherwise the task would run right here)
+                s3task = current.s3task
+                if s3task._is_alive():
+                    s3task.async("gis_update_simplified",
+                                 args=[json.dumps(missing)])
+        return geometries
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update_simplified(cls, location_id, wkt=None, refresh=True):
+        """
+            Simplify the geometry of a location at all SIMPLIFY_TOLERANCES
+            and store the results in the cache
+
+            @param location_id: the gis_location ID
+            @param wkt: the WKT of the location (looked up if not given)
+            @param refresh: replace existing cache entries (otherwise skip
+                            the location if it has cache entries already)
+
+            @returns: list of {"wkt": wkt, "geojson": geojson} per tier of
+                      SIMPLIFY_TOLERANCES, or None if the location has no
+                      valid Line/Polygon geometry or was skipped
+        """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location_simplified
+
+        query = (table.location_id == location_id)
+        if db(query).select(table.id, limitby=(0, 1)).first():
+            if not refresh:
+                return None
+            db(query).delete()
+
+        if wkt is None:
+            gtable = s3db.gis_location
+            location = db(gtable.id == location_id).select(gtable.wkt,
+                                                           limitby=(0, 1)
+                                                           ).first()
+            if location:
+                wkt = location.wkt
+        if wkt and wkt.lstrip()[:5].upper() == "POINT":
+            return None
+
+        shape = None
+        if wkt:
+            from shapely.wkt import loads as wkt_loads
+            try:
+                shape = wkt_loads(wkt)
+            except:
+                pass
+
+        simplified = []
+        items = []
+        if shape is None:
+            # Cache as having no valid geometry, so that it is not
+            # looked up again with every request
+            for tier in xrange(len(cls.SIMPLIFY_TOLERANCES)):
+                items.append(dict(location_id=location_id,
+                                  tier=tier,
+                                  wkt="",
+                                  geojson=""))
+            simplified = None
+        else:
+            from ..geojson import dumps
+            for tier, tolerance in enumerate(cls.SIMPLIFY_TOLERANCES):
+                _shape = shape.simplify(tolerance, True)
+                wkt = _shape.to_wkt()
+                # Compact Encoding
+                geojson = dumps(_shape, separators=(",", ":"))
+                simplified.append({"wkt": wkt, "geojson": geojson})
+                items.append(dict(location_id=location_id,
+                                  tier=tier,
+                                  wkt=wkt,
+                                  geojson=geojson))
+        table.bulk_insert(items)
+        return simplified
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def delete_simplified(location_id):
+        """
+            Drop the simplified geometries of a location from the cache,
+            e.g. when its WKT has been changed
+
+            @param location_id: the gis_location ID
+        """
+
+        table = current.s3db.gis_location_simplified
+        current.db(table.location_id == location_id).delete()
+        return
+
     # -------------------------------------------------------------------------
     def show_map( self,
                   height = None,
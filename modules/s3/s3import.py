@@ -62,6 +62,7 @@ from gluon.tools import callback
 
 from s3utils import SQLTABLES3
 from s3crud import S3CRUD
+from s3index import S3TextIndex
 from s3xml import S3XML
 from s3utils import s3_mark_required, s3_has_foreign_key, s3_get_foreign_key
 
@@ -1872,7 +1873,7 @@ class S3ImportItem(object):
         self.tablename = table._tablename
 
         if original is None:
-            original = manager.original(table, element)
+            original = self.job.original(table, element)
         data = xml.record(table, element,
                           files=files,
                           original=original,
@@ -1918,7 +1919,7 @@ class S3ImportItem(object):
         if self.original is not None:
             original = self.original
         else:
-            original = current.manager.original(table, self.data)
+            original = self.job.original(table, self.data)
 
         if original is not None:
             self.original = original
@@ -2245,6 +2246,8 @@ class S3ImportItem(object):
                 if success:
                     self.id = success
                     self.committed = True
+                    # UID exists from now on
+                    self.job.forget_original(self.tablename, self.uid)
 
             else:
                 # Nothing to create
@@ -2309,6 +2312,7 @@ class S3ImportItem(object):
                        s3db.get_config(tablename, "onaccept"))
             if onaccept:
                 callback(onaccept, form, tablename=self.tablename)
+            S3TextIndex(table).update(self.id)
 
         # Update referencing items
         if self.update and self.id:
@@ -2592,7 +2596,8 @@ class S3ImportJob():
                  update_policy=None,
                  conflict_policy=None,
                  last_sync=None,
-                 onconflict=None):
+                 onconflict=None,
+                 directory=None):
         """
             Constructor
 
@@ -2605,6 +2610,8 @@ class S3ImportJob():
             @param conflict_policy: the conflict resolution policy
             @param last_sync: the last synchronization time stamp (datetime)
             @param onconflict: custom conflict resolver function
+            @param directory: directory of elements imported by previous
+                              jobs (to resolve references across chunks)
         """
 
         self.error = None # the last error
@@ -2613,12 +2620,17 @@ class S3ImportJob():
         self.table = table
         self.tree = tree
         self.files = files
-        self.directory = Storage()
+        if directory is None:
+            directory = Storage()
+        self.directory = directory
 
         self.elements = Storage()
         self.items = Storage()
         self.references = []
 
+        # Original records by UID {tablename: {uid: row or None}}
+        self.originals = Storage()
+
         self.job_table = None
         self.item_table = None
 
@@ -3005,29 +3017,136 @@ class S3ImportJob():
         return item_id
 
     # -------------------------------------------------------------------------
-    def resolve(self, item_id, import_list):
+    def resolve(self, item_id, import_list, resolved=None):
         """
             Resolve the reference list of an item
 
             @param item_id: the import item UID
             @param import_list: the ordered list of items (UIDs) to import
+            @param resolved: the set of items (UIDs) in import_list (to
+                             avoid scanning the list for every reference)
         """
 
+        if resolved is None:
+            resolved = set(import_list)
+
         item = self.items[item_id]
         if item.lock or item.accepted is False:
             return False
         references = []
         for reference in item.references:
             ritem_id = reference.entry.item_id
-            if ritem_id and ritem_id not in import_list:
+            if ritem_id and ritem_id not in resolved:
                 references.append(ritem_id)
         for ritem_id in references:
             item.lock = True
-            if self.resolve(ritem_id, import_list):
+            if self.resolve(ritem_id, import_list, resolved=resolved) and \
+               ritem_id not in resolved:
                 import_list.append(ritem_id)
+                resolved.add(ritem_id)
             item.lock = False
         return True
 
+    # -------------------------------------------------------------------------
+    def original(self, table, record):
+        """
+            Find the original DB record for an import element or record,
+            same as S3RequestManager.original, but looks up the UIDs of
+            all elements of the same table in the import tree at once
+            (with one query per chunk of UIDs instead of one query per
+            element)
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+        """
+
+        manager = current.manager
+        xml = current.xml
+        UID = xml.UID
+
+        tablename = table._tablename
+        originals = self.originals.get(tablename)
+        if originals is None:
+            originals = self.originals[tablename] = \
+                        self.__load_originals(table)
+        if not originals:
+            return manager.original(table, record)
+
+        uid = xml.import_uid(record.get(UID, None))
+        if not uid:
+            # No unique keys (other unique keys are handled by
+            # __load_originals) => no original
+            return None
+        if uid in originals:
+            return originals[uid]
+        return manager.original(table, record)
+
+    # -------------------------------------------------------------------------
+    def forget_original(self, tablename, uid):
+        """
+            Remove a UID from the lookup of original records (once a record
+            with this UID has been created)
+
+            @param tablename: the table name
+            @param uid: the UID
+        """
+
+        originals = self.originals.get(tablename)
+        if originals and uid:
+            originals.pop(uid, None)
+        return
+
+    # -------------------------------------------------------------------------
+    def __load_originals(self, table, chunk_size=500):
+        """
+            Look up the original DB records for all UIDs of the table
+            in the import tree
+
+            @param table: the table
+            @param chunk_size: maximum number of UIDs per query
+
+            @returns: dict {uid: row or None}, empty dict if the table
+                      can not be handled this way (no tree, no UID
+                      field, or other unique fields)
+        """
+
+        xml = current.xml
+        UID = xml.UID
+
+        originals = {}
+        tree = self.tree
+        if tree is None or UID not in table.fields:
+            return originals
+        pkeys = [f for f in table.fields if table[f].unique and f != UID]
+        if pkeys:
+            # Matches by other unique keys take precedence
+            return originals
+
+        tablename = table._tablename
+        expr = "//%s[@%s='%s']" % (xml.TAG.resource,
+                                   xml.ATTRIBUTE.name,
+                                   tablename)
+        import_uid = xml.import_uid
+        uids = set()
+        for element in tree.xpath(expr):
+            uid = import_uid(element.get(UID, None))
+            if uid:
+                uids.add(uid)
+        if not uids:
+            return originals
+
+        db = current.db
+        uids = list(uids)
+        for uid in uids:
+            originals[uid] = None
+        for i in xrange(0, len(uids), chunk_size):
+            chunk = uids[i:i + chunk_size]
+            query = (table[UID].belongs(chunk))
+            rows = db(query).select(table.ALL)
+            for row in rows:
+                originals[row[UID]] = row
+        return originals
+
     # -------------------------------------------------------------------------
     def commit(self, ignore_errors=False):
         """
@@ -3041,12 +3160,28 @@ class S3ImportJob():
 
         # Resolve references
         import_list = []
+        resolved = set()
         for item_id in self.items:
-            self.resolve(item_id, import_list)
-            if item_id not in import_list:
+            self.resolve(item_id, import_list, resolved=resolved)
+            if item_id not in resolved:
                 import_list.append(item_id)
+                resolved.add(item_id)
         # Commit the items
         items = self.items
+
+        # Prefetch the ownership of existing records for authorization
+        permission = current.auth.permission
+        prefetched = Storage()
+        if permission.use_cacls:
+            for item_id in import_list:
+                item = items[item_id]
+                if item.id and item.table:
+                    tn = item.tablename
+                    if tn not in prefetched:
+                        prefetched[tn] = Storage(table=item.table, ids=[])
+                    prefetched[tn].ids.append(item.id)
+            for tn in prefetched:
+                permission.prefetch(prefetched[tn].table, prefetched[tn].ids)
         count = 0
         mtime = None
         created = []
@@ -3067,6 +3202,8 @@ class S3ImportJob():
                         element.set(ATTRIBUTE.error, str(self.error))
                     self.error_tree.append(deepcopy(element))
                 if not ignore_errors:
+                    for tn in prefetched:
+                        permission.forget(tn)
                     return False
             elif item.tablename == tablename:
                 count += 1
@@ -3079,6 +3216,8 @@ class S3ImportJob():
                         updated.append(item.id)
                     elif item.method == item.METHOD.DELETE:
                         deleted.append(item.id)
+        for tn in prefetched:
+            permission.forget(tn)
         self.count = count
         self.mtime = mtime
         self.created = created
@@ -3086,6 +3225,53 @@ class S3ImportJob():
         self.deleted = deleted
         return True
 
+    # -------------------------------------------------------------------------
+    def update_directory(self):
+        """
+            Replace the import items in the directory by the IDs of the
+            committed records, and add all committed items with a UID or
+            tuid, so that subsequent jobs sharing this directory (e.g.
+            for the next chunk of a CSV import) can resolve references
+            to them without the elements of this job
+        """
+
+        xml = current.xml
+        UID = xml.UID
+        TUID = xml.ATTRIBUTE.tuid
+        DELETE = S3ImportItem.METHOD.DELETE
+
+        directory = self.directory
+        items = self.items
+
+        def entry(tablename, uid, record_id):
+            return Storage(tablename=tablename,
+                           element=None,
+                           uid=uid,
+                           id=record_id,
+                           item_id=None)
+
+        for key in directory.keys():
+            e = directory[key]
+            if e.element is None:
+                continue
+            item = e.item_id and items[e.item_id] or None
+            if item and item.id and item.method != DELETE:
+                directory[key] = entry(e.tablename, e.uid, item.id)
+            else:
+                del directory[key]
+
+        for item in items.values():
+            element = item.element
+            if element is None or not item.id or item.method == DELETE:
+                continue
+            tablename = item.tablename
+            for attr in (UID, TUID):
+                uid = element.get(attr, None)
+                if uid:
+                    directory[(tablename, attr, uid)] = \
+                        entry(tablename, uid, item.id)
+        return
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
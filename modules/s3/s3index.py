@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+
+""" S3 Full-Text Search Index
+
+    @copyright: 2012 (c) Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ["S3TextIndex"]
+
+import re
+
+from gluon import current
+from gluon.dal import Field
+
+# =============================================================================
+class S3TextIndex(object):
+    """
+        Word-prefix text index for the search fields of a table, to
+        replace substring (LIKE) scans in simple searches, datatable
+        filters and autocompletes.
+
+        Tables declare their indexed fields in the model, e.g.:
+
+            s3db.configure("pr_person",
+                           text_index=["first_name",
+                                       "middle_name",
+                                       "last_name"])
+
+        ...and the index is activated with the deployment setting
+        search.text_index. Two backends are available:
+
+            - "postgres": matches to_tsvector() of the fields against a
+                          prefix tsquery (no maintenance needed, use
+                          create_indexes() to add the GIN indexes)
+            - "table":    maintains an inverted token table (s3_text_index)
+                          which is updated whenever records are created,
+                          updated or deleted through the framework
+    """
+
+    TABLENAME = "s3_text_index"
+    CONFIG = "simple"   # PostgreSQL text search configuration
+    MAX_LENGTH = 64     # max length of a token
+
+    WORDS = re.compile(r"\w+", re.UNICODE)
+
+    # -------------------------------------------------------------------------
+    def __init__(self, table):
+        """
+            Constructor
+
+            @param table: the Table
+        """
+
+        self.table = table
+        self.tablename = tablename = table._tablename
+
+        backend = self.get_backend()
+        if backend:
+            fields = current.s3db.get_config(tablename, "text_index")
+        else:
+            fields = None
+        if fields:
+            self.fields = [f for f in fields if f in table.fields]
+        else:
+            self.fields = []
+        self.backend = backend
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_backend():
+        """
+            The active backend for the current database, as configured
+            in deployment settings (None if disabled)
+        """
+
+        backend = current.deployment_settings.get_search_text_index()
+        if backend is True:
+            if current.db._dbname == "postgres":
+                backend = "postgres"
+            else:
+                backend = "table"
+        elif backend not in ("postgres", "table"):
+            backend = None
+        return backend
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def define_index_table(cls):
+        """ Define the inverted token table """
+
+        db = current.db
+        if cls.TABLENAME not in db:
+            index_table = db.define_table(cls.TABLENAME,
+                                          Field("tablename", length=128),
+                                          Field("fieldname", length=128),
+                                          Field("record_id", "integer"),
+                                          Field("token",
+                                                length=cls.MAX_LENGTH * 4))
+        else:
+            index_table = db[cls.TABLENAME]
+        return index_table
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tokens(cls, text):
+        """
+            Split a text into its (lowercase, utf-8 encoded) word tokens
+
+            @param text: the text
+            @returns: list of unique tokens, in order of appearance
+        """
+
+        if not text:
+            return []
+        if not isinstance(text, unicode):
+            text = unicode(str(text), "utf-8", "ignore")
+        tokens = []
+        for word in cls.WORDS.findall(text.lower()):
+            token = word[:cls.MAX_LENGTH].encode("utf-8")
+            if token not in tokens:
+                tokens.append(token)
+        return tokens
+
+    # -------------------------------------------------------------------------
+    def indexed(self, fields=None):
+        """
+            Check whether the given fields can be searched with this index
+
+            @param fields: list of field names, None for all indexed fields
+        """
+
+        if not self.fields:
+            return False
+        if fields is None:
+            return True
+        for f in fields:
+            if f not in self.fields:
+                return False
+        return True
+
+    # -------------------------------------------------------------------------
+    # Index maintenance
+    # -------------------------------------------------------------------------
+    def update(self, record_id):
+        """
+            Update the index entries for a record (after create/update)
+
+            @param record_id: the record ID
+        """
+
+        if self.backend != "table" or not self.fields or not record_id:
+            return
+
+        db = current.db
+        table = self.table
+        fields = self.fields
+
+        query = (table._id == record_id)
+        if "deleted" in table.fields:
+            query &= (table.deleted != True)
+        record = db(query).select(limitby=(0, 1),
+                                  *[table[f] for f in fields]).first()
+        self.delete(record_id)
+        if record:
+            entries = self._entries(record_id, record)
+            if entries:
+                self.define_index_table().bulk_insert(entries)
+        return
+
+    # -------------------------------------------------------------------------
+    def delete(self, record_id):
+        """
+            Remove the index entries for a record (after delete)
+
+            @param record_id: the record ID
+        """
+
+        if self.backend != "table" or not self.fields:
+            return
+
+        itable = self.define_index_table()
+        query = (itable.tablename == self.tablename) & \
+                (itable.record_id == record_id)
+        current.db(query).delete()
+        return
+
+    # -------------------------------------------------------------------------
+    def rebuild(self):
+        """
+            Rebuild the index for all records in the table, e.g. after
+            enabling the index or changing the indexed fields
+
+            @returns: the number of indexed records
+        """
+
+        if self.backend != "table" or not self.fields:
+            return 0
+
+        db = current.db
+        table = self.table
+        itable = self.define_index_table()
+        db(itable.tablename == self.tablename).delete()
+
+        query = (table._id > 0)
+        if "deleted" in table.fields:
+            query &= (table.deleted != True)
+        rows = db(query).select(table._id, *[table[f] for f in self.fields])
+        pkey = table._id.name
+        entries = []
+        for row in rows:
+            entries.extend(self._entries(row[pkey], row))
+        if entries:
+            itable.bulk_insert(entries)
+        return len(rows)
+
+    # -------------------------------------------------------------------------
+    def _entries(self, record_id, record):
+        """
+            Generate the index entries for a record
+
+            @param record_id: the record ID
+            @param record: the record (must contain all indexed fields)
+        """
+
+        tablename = self.tablename
+        tokens = self.tokens
+        entries = []
+        for fieldname in self.fields:
+            for token in tokens(record[fieldname]):
+                entries.append(dict(tablename=tablename,
+                                    fieldname=fieldname,
+                                    record_id=record_id,
+                                    token=token))
+        return entries
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def create_indexes(cls):
+        """
+            Create the database indexes for the active backend (to be
+            run once after the tables have been created)
+        """
+
+        backend = cls.get_backend()
+        if not backend:
+            return
+
+        db = current.db
+        s3db = current.s3db
+        if backend == "table":
+            cls.define_index_table()
+            sql = "CREATE INDEX %(tn)s_%(name)s__idx on %(tn)s(%(fields)s);"
+            for name, fields in (("token", "tablename,token"),
+                                 ("record", "tablename,record_id")):
+                try:
+                    db.executesql(sql % dict(tn=cls.TABLENAME,
+                                             name=name,
+                                             fields=fields))
+                except:
+                    # Index already present
+                    pass
+        else:
+            sql = "CREATE INDEX %(tn)s_%(fn)s__tsidx on %(tn)s " \
+                  "USING gin(to_tsvector('%(config)s', coalesce(%(fn)s, '')));"
+            for tablename, config in current.model.config.items():
+                fields = config.get("text_index")
+                if not fields or tablename not in db:
+                    continue
+                for fieldname in fields:
+                    try:
+                        db.executesql(sql % dict(tn=tablename,
+                                                 fn=fieldname,
+                                                 config=cls.CONFIG))
+                    except:
+                        # Index already present
+                        pass
+        db.commit()
+        return
+
+    # -------------------------------------------------------------------------
+    # Search
+    # -------------------------------------------------------------------------
+    def query(self, text, fields=None):
+        """
+            Build a query for all records where each word in the text
+            is a prefix of a word in any of the fields
+
+            @param text: the search text
+            @param fields: list of field names to search in (default:
+                           all indexed fields)
+            @returns: a DAL Query for the table, or None if the text
+                      contains no words or the fields are not indexed
+        """
+
+        if not self.indexed(fields):
+            return None
+        if fields is None:
+            fields = self.fields
+
+        words = self.tokens(text)
+        if not words:
+            return None
+
+        table = self.table
+        query = None
+        for word in words:
+            if self.backend == "postgres":
+                q = table._id.belongs(self._tsselect(word, fields))
+            else:
+                q = table._id.belongs(self._select(word, fields))
+            if query is None:
+                query = q
+            else:
+                query &= q
+        return query
+
+    # -------------------------------------------------------------------------
+    def search(self, text, fields=None, limit=None):
+        """
+            Search for records matching the text (as in query()), and
+            rank them by the number of words matching a whole word in
+            any of the fields
+
+            @param text: the search text
+            @param fields: list of field names to search in
+            @param limit: maximum number of record IDs to return
+            @returns: list of record IDs, best match first, or None if
+                      the text can not be searched with this index
+        """
+
+        query = self.query(text, fields)
+        if query is None:
+            return None
+        if fields is None:
+            fields = self.fields
+
+        db = current.db
+        table = self.table
+        if "deleted" in table.fields:
+            query &= (table.deleted != True)
+        hits = db(query)._select(table._id)
+        words = self.tokens(text)
+
+        # Best matches
+        if self.backend == "postgres":
+            sql = self._tsselect(words, fields, exact=True)
+            sql = "%s AND %s IN (%s) ORDER BY rank DESC, %s" % \
+                  (sql[:-1], table._id, hits[:-1], table._id)
+            if limit:
+                sql = "%s LIMIT %s" % (sql, int(limit))
+            ranked = [row[0] for row in db.executesql(sql)]
+        else:
+            itable = self.define_index_table()
+            q = (itable.tablename == self.tablename) & \
+                (itable.fieldname.belongs(fields)) & \
+                (itable.token.belongs(words)) & \
+                (itable.record_id.belongs(hits))
+            rank = itable.token.count()
+            rows = db(q).select(itable.record_id,
+                                rank,
+                                groupby=itable.record_id,
+                                orderby=~rank|itable.record_id,
+                                limitby=(0, limit) if limit else None)
+            ranked = [row[itable.record_id] for row in rows]
+
+        # Other matches
+        if limit:
+            limit -= len(ranked)
+            if limit <= 0:
+                return ranked
+        if ranked:
+            query &= (~(table._id.belongs(ranked)))
+        rows = db(query).select(table._id,
+                                orderby=table._id,
+                                limitby=(0, limit) if limit else None)
+        pkey = table._id.name
+        return ranked + [row[pkey] for row in rows]
+
+    # -------------------------------------------------------------------------
+    def _select(self, word, fields):
+        """
+            Nested SELECT of the IDs of all records with a word starting
+            with the given prefix in any of the fields (token table)
+
+            @param word: the prefix (a token)
+            @param fields: the field names
+        """
+
+        itable = self.define_index_table()
+
+        # Range rather than LIKE, so that the DB can use the index
+        # (the last byte of a utf-8 string is never \xff)
+        upper = word[:-1] + chr(ord(word[-1]) + 1)
+        query = (itable.tablename == self.tablename) & \
+                (itable.fieldname.belongs(fields)) & \
+                (itable.token >= word) & \
+                (itable.token < upper)
+        return current.db(query)._select(itable.record_id)
+
+    # -------------------------------------------------------------------------
+    def _tsselect(self, words, fields, exact=False):
+        """
+            SELECT of the IDs of all records with a word starting with
+            the given prefix in any of the fields (PostgreSQL)
+
+            @param words: the prefix, or a list of words if exact
+            @param fields: the field names
+            @param exact: select records matching any of the words
+                          exactly, and a rank column
+        """
+
+        table = self.table
+        represent = current.db._adapter.represent
+        config = self.CONFIG
+
+        if exact:
+            tsquery = " | ".join(words)
+        else:
+            tsquery = "%s:*" % words
+        tsquery = "to_tsquery('%s', %s)" % (config,
+                                           represent(tsquery, "string"))
+        vectors = ["to_tsvector('%s', coalesce(%s, ''))" % (config, table[f])
+                   for f in fields]
+        where = " OR ".join(["%s @@ %s" % (v, tsquery) for v in vectors])
+        if exact:
+            rank = " + ".join(["ts_rank(%s, %s)" % (v, tsquery)
+                               for v in vectors])
+            return "SELECT %s, %s AS rank FROM %s WHERE (%s);" % \
+                   (table._id, rank, self.tablename, where)
+        else:
+            return "SELECT %s FROM %s WHERE %s;" % \
+                   (table._id, self.tablename, where)
+
+# END =========================================================================
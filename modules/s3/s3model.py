@@ -329,6 +329,9 @@ class S3Model(object):
             table = db[tablename]
         else:
             table = db.define_table(tablename, *fields, **args)
+            # Journal the changes for incremental synchronization
+            from s3sync import S3SyncJournal
+            S3SyncJournal.attach(table)
         return table
 
     # -------------------------------------------------------------------------
@@ -29,10 +29,11 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3Cube", "S3Report", "S3ContingencyTable"]
+__all__ = ["S3Cube", "S3Report", "S3ReportCache", "S3ContingencyTable"]
 
 import sys
 import datetime
+import threading
 
 try:
     import json # try stdlib (Python 2.6)
@@ -49,6 +50,7 @@ from gluon.storage import Storage
 
 from s3resource import S3TypeConverter
 from s3crud import S3CRUD
+from s3fields import S3Represent
 from s3search import S3Search
 from s3utils import s3_truncate, s3_has_foreign_key, s3_unicode
 from s3validators import IS_INT_AMOUNT, IS_FLOAT_AMOUNT, IS_NUMBER, IS_IN_SET
@@ -292,6 +294,11 @@ class S3Cube(S3CRUD):
                 s3.actions = []
                 output.update(sortby=[[0,'asc']])
 
+            elif representation == "json":
+                current.response.headers["Content-Type"] = \
+                                                "application/json"
+                return report.json()
+
             else:
                 # @todo: support other formats
                 r.error(501, current.manager.ERROR.BAD_FORMAT)
@@ -645,6 +652,18 @@ class S3Report:
                                  row_column_fields)
         self._get_fields(fields=fields)
 
+        # Look up the report cache --------------------------------------------
+        #
+        cache_size = current.deployment_settings.get_ui_report_cache_size()
+        if cache_size:
+            cache = S3ReportCache
+            key, stamp = cache.key(self)
+            if key is not None:
+                data = cache.get(key, stamp)
+                if data is not None:
+                    self.__dict__.update(data)
+                    return
+
         # Retrieve the records --------------------------------------------------
         #
         records = resource.sqltable(self.rfields,
@@ -663,60 +682,108 @@ class S3Report:
                 raise KeyError("Could not retrieve primary key values of %s" %
                                resource.tablename)
 
-            # Generate the data frame -----------------------------------------
+            # Group the items -------------------------------------------------
             #
-            from pyvttbl import DataFrame
-            df = DataFrame()
-            insert = df.insert
-
-            item_list = []
-            seen = item_list.append
+            rows = self.rows
+            cols = self.cols
 
             flatten = self._flatten
             expand = self._expand
 
+            # Single pass over the expanded items: hash each item into
+            # its (row value, column value) bucket, de-duplicate the
+            # record IDs per bucket
+            buckets = {}
+            rvalues = set()
+            cvalues = set()
             for row in records:
-                item = expand(flatten(row))
-                for i in item:
-                    if i not in item_list:
-                        seen(i)
-                        insert(i)
-
-            # Group the items -------------------------------------------------
-            #
-            rows = self.rows and [self.rows] or []
-            cols = self.cols and [self.cols] or []
-            pt = df.pivot(pkey, rows, cols, aggregate="tolist")
+                for i in expand(flatten(row)):
+                    if rows:
+                        rvalue = i[rows]
+                    else:
+                        rvalue = None
+                    if cols:
+                        cvalue = i[cols]
+                    else:
+                        cvalue = None
+                    bucket = (rvalue, cvalue)
+                    if bucket in buckets:
+                        ids, seen = buckets[bucket]
+                    else:
+                        ids, seen = buckets[bucket] = ([], set())
+                        rvalues.add(rvalue)
+                        cvalues.add(cvalue)
+                    record_id = i[pkey]
+                    if record_id not in seen:
+                        seen.add(record_id)
+                        ids.append(record_id)
 
             # Initialize columns and rows -------------------------------------
             #
-            if cols:
-                self.col = [Storage({"value": v != "__NONE__" and v or None})
-                            for v in [n[0][1] for n in pt.cnames]]
-                self.numcols = len(self.col)
-            else:
-                self.col = [Storage({"value": None})]
-                self.numcols = 1
-
-            if rows:
-                self.row = [Storage({"value": v != "__NONE__" and v or None})
-                            for v in [n[0][1] for n in pt.rnames]]
-                self.numrows = len(self.row)
-            else:
-                self.row = [Storage({"value": None})]
-                self.numrows = 1
+            NONE = "__NONE__"
+            cvalues = sorted(cvalues)
+            self.col = [Storage({"value": v != NONE and v or None})
+                        for v in cvalues]
+            self.numcols = len(self.col)
+
+            rvalues = sorted(rvalues)
+            self.row = [Storage({"value": v != NONE and v or None})
+                        for v in rvalues]
+            self.numrows = len(self.row)
+
+            # Initialize the cells with the record IDs ------------------------
+            #
+            cell_ids = lambda bucket: bucket in buckets and \
+                                      buckets[bucket][0] or []
+            self.cell = [[Storage(records=cell_ids((rv, cv)))
+                          for cv in cvalues]
+                         for rv in rvalues]
 
             # Add the layers --------------------------------------------------
             #
             add_layer = self._add_layer
-            layers = list(self.layers)
             for f, m in self.layers:
-                add_layer(pt, f, m)
+                add_layer(f, m)
         else:
             # No items to report on -------------------------------------------
             #
             self.empty = True
 
+        # Store in the report cache -------------------------------------------
+        #
+        if cache_size and key is not None:
+            cache.store(key, stamp, self, size=cache_size)
+
+    # -------------------------------------------------------------------------
+    def json(self):
+        """
+            Serialize the report data as JSON
+
+            @returns: a JSON string with rows, cols, cells and totals,
+                      layers keyed as "method:fact"
+        """
+
+        layers = self.layers
+        keys = ["%s:%s" % (m, f) for f, m in layers]
+        def values(item):
+            return dict([(keys[i], item.get(layers[i]))
+                         for i in xrange(len(layers))])
+
+        if self.empty:
+            data = dict(rows=[], cols=[], cells=[], totals={})
+        else:
+            data = dict(rows=[dict(value=r.value, totals=values(r))
+                              for r in self.row],
+                        cols=[dict(value=c.value, totals=values(c))
+                              for c in self.col],
+                        cells=[[values(cell) for cell in row]
+                               for row in self.cell],
+                        totals=values(self.totals))
+        data.update(layers=keys,
+                    row_field=self.rows,
+                    col_field=self.cols)
+        return json.dumps(data, default=unicode)
+
     # -------------------------------------------------------------------------
     def _get_fields(self, fields=None):
         """
@@ -845,11 +912,11 @@ class S3Report:
             return results
 
     # -------------------------------------------------------------------------
-    def _add_layer(self, pt, fact, method):
+    def _add_layer(self, fact, method):
         """
-            Compute a new layer from the base layer (pt+items)
+            Compute a new layer from the record IDs in the cells, along
+            with the row, column and overall totals
 
-            @param pt: the pivot table with record IDs
             @param fact: the fact field for the layer
             @param method: the aggregation method of the layer
         """
@@ -857,115 +924,171 @@ class S3Report:
         if method not in self.METHODS:
             raise SyntaxError("Unsupported aggregation method: %s" % method)
 
-        items = self.records
-        lfields = self.lfields
         rows = self.row
         cols = self.col
+        cells = self.cell
         records = self.records
         extract = self._extract
         aggregate = self._aggregate
-        resource = self.resource
-
-        RECORDS = "records"
-        VALUES = "values"
-
-        table = resource.table
-        pkey = table._id.name
+        combine = self._combine
 
         if method is None:
             method = "list"
         layer = (fact, method)
 
-        numcols = len(pt.cnames)
-        numrows = len(pt.rnames)
+        # Without fact, the layer aggregates the record IDs
+        count_records = fact is None
+        if count_records:
+            fact = self.resource.table._id.name
 
-        # Initialize cells
-        if self.cell is None:
-            self.cell = [[Storage()
-                          for i in xrange(numcols)]
-                         for j in xrange(numrows)]
-        cells = self.cell
+        numcols = self.numcols
+        numrows = self.numrows
+
+        # Partial aggregates of the columns and the overall total
+        col_partials = [None] * numcols
+        all_partial = None
 
-        all_values = []
         for r in xrange(numrows):
 
-            # Initialize row header
             row = rows[r]
-            row[RECORDS] = []
-            row[VALUES] = []
-
-            row_records = row[RECORDS]
-            row_values = row[VALUES]
+            row_partial = None
 
             for c in xrange(numcols):
 
-                # Initialize column header
-                col = cols[c]
-                if RECORDS not in col:
-                    col[RECORDS] = []
-                col_records = col[RECORDS]
-                if VALUES not in col:
-                    col[VALUES] = []
-                col_values = col[VALUES]
-
-                # Get the records
                 cell = cells[r][c]
-                if RECORDS in cell and cell[RECORDS] is not None:
-                    ids = cell[RECORDS]
-                else:
-                    data = pt[r][c]
-                    if data:
-                        remove = data.remove
-                        while None in data:
-                            remove(None)
-                        ids = data
-                    else:
-                        ids = []
-                    cell[RECORDS] = ids
-                row_records.extend(ids)
-                col_records.extend(ids)
 
                 # Get the values
-                if fact is None:
-                    fact = pkey
-                    values = ids
-                    row_values = row_records
-                    col_values = row_records
-                    all_values = self.records.keys()
-                else:
-                    values = []
-                    append = values.append
-                    for i in ids:
-                        value = extract(records[i], fact)
-                        if value is None:
-                            continue
+                values = []
+                append = values.append
+                for i in cell.records:
+                    value = extract(records[i], fact)
+                    if value is None:
+                        continue
+                    if type(value) is list:
+                        values.extend(value)
+                    else:
                         append(value)
-                    if len(values) and type(values[0]) is list:
-                        values = reduce(lambda x, y: x.extend(y) or x, values)
-                    if method in ("list", "count"):
-                        values =  list(set(values))
-                    row_values.extend(values)
-                    col_values.extend(values)
-                    all_values.extend(values)
-
-                # Aggregate values
-                value = aggregate(values, method)
-                cell[layer] = value
-
-            # Compute row total
-            row[layer] = aggregate(row_values, method)
-            del row[VALUES]
-
-        # Compute column total
+                if method in ("list", "count"):
+                    values = list(set(values))
+
+                # Aggregate the values, and update the partial totals
+                partial = self._partial(values, method)
+                cell[layer] = aggregate(values, method)
+                row_partial = combine(row_partial, partial, method)
+                col_partials[c] = combine(col_partials[c], partial, method)
+                all_partial = combine(all_partial, partial, method)
+
+            # Row total
+            row[layer] = self._total(row_partial, method)
+
+        # Column totals
         for c in xrange(numcols):
-            col = cols[c]
-            col[layer] = aggregate(col[VALUES], method)
-            del col[VALUES]
+            cols[c][layer] = self._total(col_partials[c], method)
 
-        # Compute overall total
-        self.totals[layer] = aggregate(all_values, method)
+        # Overall total
+        if count_records:
+            # Distinct records rather than the combined cells, as a
+            # record can expand into several cells
+            self.totals[layer] = aggregate(records.keys(), method)
+        else:
+            self.totals[layer] = self._total(all_partial, method)
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _partial(values, method):
+        """
+            Compute a partial aggregate of the values of a cell, which
+            can be combined with those of other cells into totals
+
+            @param values: the values
+            @param method: the aggregation method
+        """
+
+        if method == "list":
+            return list(values)
+        elif method == "count":
+            return len(values)
+        elif method == "avg":
+            try:
+                return (sum(values), len(values))
+            except (TypeError, ValueError):
+                return None
+        elif not values:
+            return None
+        elif method == "min":
+            try:
+                return min(values)
+            except (TypeError, ValueError):
+                return None
+        elif method == "max":
+            try:
+                return max(values)
+            except (TypeError, ValueError):
+                return None
+        elif method == "sum":
+            try:
+                return sum(values)
+            except (TypeError, ValueError):
+                return None
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _combine(a, b, method):
+        """
+            Combine two partial aggregates
+
+            @param a: the first partial aggregate (None if empty)
+            @param b: the second partial aggregate (None if empty)
+            @param method: the aggregation method
+        """
+
+        if a is None:
+            if method == "list" and b is not None:
+                # Copy, as the partial aggregate is combined into
+                # several totals
+                return list(b)
+            return b
+        if b is None:
+            return a
+        if method == "list":
+            a.extend(b)
+            return a
+        elif method in ("count", "sum"):
+            return a + b
+        elif method == "min":
+            return min(a, b)
+        elif method == "max":
+            return max(a, b)
+        elif method == "avg":
+            return (a[0] + b[0], a[1] + b[1])
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _total(partial, method):
+        """
+            Compute a total from a combined partial aggregate
+
+            @param partial: the partial aggregate
+            @param method: the aggregation method
+        """
+
+        if method == "list":
+            return partial or None
+        elif method in ("count", "sum"):
+            return partial or 0
+        elif method == "avg":
+            if partial is None:
+                return None
+            total, count = partial
+            if count:
+                return total / float(count)
+            else:
+                return 0.0
+        return partial
+
     # -------------------------------------------------------------------------
     @staticmethod
     def _aggregate(values, method):
@@ -991,19 +1114,19 @@ class S3Report:
         elif method == "min":
             try:
                 return min(values)
-            except TypeError:
+            except (TypeError, ValueError):
                 return None
 
         elif method == "max":
             try:
                 return max(values)
-            except TypeError, ValueError:
+            except (TypeError, ValueError):
                 return None
 
         elif method == "sum":
             try:
                 return sum(values)
-            except TypeError, ValueError:
+            except (TypeError, ValueError):
                 return None
 
         elif method in ("avg"):
@@ -1012,7 +1135,7 @@ class S3Report:
                     return sum(values) / float(len(values))
                 else:
                     return 0.0
-            except TypeError, ValueError:
+            except (TypeError, ValueError):
                 return None
 
         #elif method == "std":
@@ -1039,6 +1162,244 @@ class S3Report:
 
 # =============================================================================
 
+class S3ReportCache(object):
+    """
+        Process-wide LRU cache for computed reports, keyed by the report
+        parameters, invalidated by the last modification of the tables
+        involved in the report
+    """
+
+    # Maximum total number of records in all cached reports
+    MAX_RECORDS = 200000
+
+    # Report attributes to cache
+    ATTRIBUTES = ("records", "empty",
+                  "row", "col", "cell",
+                  "numrows", "numcols", "totals")
+
+    lock = threading.Lock()
+    reports = {}
+    counter = 0
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def key(cls, report):
+        """
+            Get the cache key and the current stamp for a report
+
+            @param report: the S3Report (with fields resolved)
+
+            @returns: tuple (key, stamp), key is None if the report
+                      can not be cached
+        """
+
+        resource = report.resource
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+
+        # Serialized URL filter, and the effective query (covers filters
+        # which can not be serialized as URL filter)
+        url_vars = rfilter.serialize_url()
+        url_filter = "&".join(["%s=%s" % (k, url_vars[k])
+                               for k in sorted(url_vars.keys())])
+        query = str(rfilter.get_query())
+
+        # User realms
+        auth = current.auth
+        if auth.user:
+            realms = auth.user.realms
+            if realms:
+                realms = sorted([(k, realms[k] and sorted(realms[k]))
+                                 for k in realms])
+        else:
+            realms = None
+
+        import hashlib
+        key = "%s|%s|%s|%s|%s|%s|%s" % (resource.tablename,
+                                        url_filter,
+                                        query,
+                                        report.rows,
+                                        report.cols,
+                                        report.layers,
+                                        realms)
+        key = "%s:%s" % (resource.tablename, hashlib.md5(key).hexdigest())
+
+        # Stamp = last modification and number of records in all tables
+        # involved in the report
+        db = current.db
+        MTIME = current.xml.MTIME
+        tablenames = set([lf.tname for lf in report.lfields.values()])
+        tablenames.add(resource.tablename)
+        stamp = []
+        for tablename in sorted(tablenames):
+            table = current.s3db.table(tablename)
+            if table is None or MTIME not in table.fields:
+                return (None, None)
+            last = table[MTIME].max()
+            count = table._id.count()
+            row = db(table._id > 0).select(last, count).first()
+            stamp.append((tablename, row[last], row[count]))
+        return (key, tuple(stamp))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, key, stamp):
+        """
+            Get the data of a cached report
+
+            @param key: the cache key
+            @param stamp: the current stamp for the report
+
+            @returns: dict of report attributes, or None if the report is
+                      not in the cache or outdated
+        """
+
+        lock = cls.lock
+        reports = cls.reports
+        lock.acquire()
+        try:
+            entry = reports.get(key)
+            if entry is None:
+                return None
+            if entry["stamp"] != stamp:
+                del reports[key]
+                return None
+            cls.counter += 1
+            entry["used"] = cls.counter
+            data = entry["data"]
+        finally:
+            lock.release()
+        return cls._copy(data)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def store(cls, key, stamp, report, size=None):
+        """
+            Store a report in the cache, evict the least recently
+            used reports if the cache is full
+
+            @param key: the cache key
+            @param stamp: the stamp for the report
+            @param report: the S3Report
+            @param size: the maximum number of reports in the cache
+        """
+
+        records = len(report)
+        max_records = cls.MAX_RECORDS
+        if records > max_records:
+            return
+
+        data = cls._copy(dict([(a, getattr(report, a))
+                               for a in cls.ATTRIBUTES]))
+        data["records"] = cls._records(report)
+
+        lock = cls.lock
+        reports = cls.reports
+        lock.acquire()
+        try:
+            cls.counter += 1
+            reports[key] = {"stamp": stamp,
+                            "data": data,
+                            "records": records,
+                            "used": cls.counter}
+            total = sum([e["records"] for e in reports.values()])
+            while reports and \
+                  (size and len(reports) > size or total > max_records):
+                lru = min(reports, key=lambda k: reports[k]["used"])
+                total -= reports[lru]["records"]
+                del reports[lru]
+        finally:
+            lock.release()
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _copy(data):
+        """
+            Copy the report data for the cache or from the cache: the row
+            and column headers, cells and totals are copied (shallow, so
+            the cost is proportional to the number of cells), with the
+            record IDs of the cells as tuples; the records are shared as
+            they are never modified once the report has been computed
+
+            @param data: dict of report attributes
+        """
+
+        data = dict(data)
+        for name in ("row", "col"):
+            items = data[name]
+            if items is not None:
+                data[name] = [Storage(item) for item in items]
+        cells = data["cell"]
+        if cells is not None:
+            copies = []
+            for row in cells:
+                copies.append([Storage(cell, records=tuple(cell.records))
+                               for cell in row])
+            data["cell"] = copies
+        if data["totals"] is not None:
+            data["totals"] = Storage(data["totals"])
+        return data
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _records(report):
+        """
+            Reduce the records of a report to the fields the renderers
+            need (rows, cols and facts), so that the cache does not hold
+            the complete rows
+
+            @param report: the S3Report
+            @returns: Storage {record_id: {tablename: {fieldname: value}}}
+        """
+
+        records = report.records
+        if not records:
+            return records
+
+        lfields = report.lfields
+        selectors = set([report.rows, report.cols] +
+                        [layer[0] for layer in report.layers])
+        fields = [lfields[s] for s in selectors if s in lfields]
+        extract = report._extract
+
+        reduced = Storage()
+        for record_id, record in records.items():
+            item = Storage()
+            for lfield in fields:
+                if lfield.tname not in item:
+                    item[lfield.tname] = Storage()
+                item[lfield.tname][lfield.fname] = extract(record,
+                                                           lfield.selector)
+            reduced[record_id] = item
+        return reduced
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls, tablename=None):
+        """
+            Remove reports from the cache
+
+            @param tablename: remove only the reports for this table
+        """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            if tablename is None:
+                cls.reports.clear()
+            else:
+                prefix = "%s:" % tablename
+                for key in cls.reports.keys():
+                    if key.startswith(prefix):
+                        del cls.reports[key]
+        finally:
+            lock.release()
+        return
+
+# =============================================================================
+
 class S3ContingencyTable(TABLE):
     """ HTML Helper to generate a contingency table """
 
@@ -1067,6 +1428,15 @@ class S3ContingencyTable(TABLE):
         numrows = report.numrows
         lfields = report.lfields
 
+        # Look up the representations of foreign keys in bulk
+        records = report.records
+        if records:
+            records = records.values()
+            selectors = set([rows, cols] + [l[0] for l in layers])
+            for selector in selectors:
+                if selector in lfields:
+                    S3Represent.setup(lfields[selector].field, records)
+
         get_label = self._get_label
         get_total = self._totals
         represent = lambda f, v, d="": \
@@ -1364,7 +1734,7 @@ class S3ContingencyTable(TABLE):
                 ftype = str(f.type)
                 if ftype not in ("string", "text") and \
                    isinstance(value, basestring):
-                    # pyvttbl converts col/row headers into unicode,
+                    # _flatten converts str col/row headers into unicode,
                     # but represent may need the original data type,
                     # hence try to convert it back here:
                     convert = S3TypeConverter.convert
@@ -27,9 +27,12 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import base64
+import decimal
 import re
 import sys
 import datetime
+import threading
 import time
 import HTMLParser
 try:
@@ -63,9 +66,11 @@ from gluon.languages import lazyT
 from gluon.storage import Storage
 from gluon.tools import callback
 
+from s3fields import S3Represent
 from s3utils import SQLTABLES3, s3_has_foreign_key, s3_get_foreign_key
 from s3validators import IS_ONE_OF
 from s3import import S3ImportJob
+from s3index import S3TextIndex
 
 DEBUG = False
 if DEBUG:
@@ -79,6 +84,10 @@ else:
 class S3Resource(object):
     """ API for resources """
 
+    # Formats of temporal values in pagination cursors
+    CURSOR_DATETIME = "%Y-%m-%dT%H:%M:%S.%f"
+    CURSOR_TIME = "%H:%M:%S.%f"
+
     # -------------------------------------------------------------------------
     def __init__(self, prefix, name,
                  id=None,
@@ -162,6 +171,7 @@ class S3Resource(object):
         self._ids = []
         self._uids = []
         self._length = None
+        self._cursor = None
 
         # Request attributes
         self.vars = None # set during build_query
@@ -373,6 +383,11 @@ class S3Resource(object):
         query = rfilter.get_query()
         vfltr = rfilter.get_filter()
 
+        # Keyset pagination
+        seek = attr.pop("seek", None)
+        if seek is not None:
+            query &= seek
+
         distinct = attr.pop("distinct", False) and True or False
         distinct = rfilter.distinct or distinct
         attr["distinct"] = distinct
@@ -406,10 +421,12 @@ class S3Resource(object):
                 start = limit = None
             # @todo: override fields => needed for vfilter
 
-        # Get the rows
-        rows = current.db(query).select(*fields, **attr)
-        if vfltr is not None:
-            rows = rfilter(rows, start=start, limit=limit)
+            # Get the rows, apply the virtual filter batch-wise
+            rows = rfilter.select(query, fields,
+                                  start=start, limit=limit, **attr)
+        else:
+            # Get the rows
+            rows = current.db(query).select(*fields, **attr)
 
         # Audit
         current.manager.audit("list", self.prefix, self.name)
@@ -419,12 +436,21 @@ class S3Resource(object):
         return rows
 
     # -------------------------------------------------------------------------
-    def load(self, start=None, limit=None, orderby=None):
+    def load(self,
+             start=None,
+             limit=None,
+             orderby=None,
+             fields=None,
+             after=None):
         """
             Load records from this resource
 
             @param start: the index of the first record to load
             @param limit: the maximum number of records to load
+            @param orderby: orderby for the query
+            @param fields: names of the fields to load (default: all)
+            @param after: cursor from get_cursor() to load the records
+                          after (keyset pagination, overrides start)
         """
 
         table = self.table
@@ -432,11 +458,26 @@ class S3Resource(object):
         if DEBUG:
             _start = datetime.datetime.now()
 
-        if self.tablename == "gis_location":
-            # Filter out bulky Polygons
-            fields = [f for f in table if f.name not in ("wkt", "the_geom")]
+        # Keyset pagination
+        if after is not None:
+            start = 0
+        keyset, seek, korderby = self.keyset(orderby, after=after)
+        if keyset is not None and (after is not None or limit):
+            if fields is not None and keyset[0].name not in fields:
+                fields = list(fields) + [keyset[0].name]
+        else:
+            keyset = None
+
+        if fields is not None:
+            pkey = table._id.name
+            fields = [table[f] for f in fields
+                      if f in table.fields and f != pkey]
+            fields.insert(0, table._id)
         else:
             fields = [f for f in table]
+        if self.tablename == "gis_location":
+            # Filter out bulky Polygons
+            fields = [f for f in fields if f.name not in ("wkt", "the_geom")]
         fnames = [f.name for f in fields]
 
         if self._rows is not None:
@@ -464,16 +505,25 @@ class S3Resource(object):
                                  start=start,
                                  limit=limit,
                                  orderby=orderby,
+                                 after=after,
                                  as_rows=True)
             if rows is None:
                 rows = []
             if not limitby:
                 self._length = len(rows)
         else:
+            if keyset is not None:
+                orderby = korderby
             rows = self.select(limitby=limitby,
                                orderby=orderby,
+                               seek=seek,
                                *fields)
             self._length = len(rows)
+            self._cursor = None
+            if keyset is not None and limitby:
+                self._cursor = self.cursor(rows,
+                                           keyset,
+                                           limitby[1] - limitby[0])
         id = table._id.name
         self._ids = [row[id] for row in rows]
         uid = current.xml.UID
@@ -505,7 +555,8 @@ class S3Resource(object):
                  as_page=False,
                  as_list=False,
                  as_json=False,
-                 format=None):
+                 format=None,
+                 after=None):
         """
             DRY helper function for SQLTABLEs in REST and CRUD
 
@@ -514,6 +565,8 @@ class S3Resource(object):
             @param limit: maximum number of records
             @param left: left outer joins
             @param orderby: orderby for the query
+            @param after: cursor from get_cursor() to select the records
+                          after (keyset pagination, overrides start)
             @param distinct: distinct for the query
             @param linkto: hook to link record IDs
             @param download_url: the default download URL of the application
@@ -531,6 +584,17 @@ class S3Resource(object):
         vfltr = self.get_filter()
         rfilter = self.rfilter
 
+        # Keyset pagination
+        if after is not None:
+            start = 0
+        keyset, seek, korderby = self.keyset(orderby, after=after)
+        if keyset is not None and (after is not None or limit):
+            orderby = korderby
+            if seek is not None:
+                query &= seek
+        else:
+            keyset = None
+
         # Handle distinct-attribute (must respect rfilter.distinct)
         distinct = self.rfilter.distinct | distinct
 
@@ -539,6 +603,11 @@ class S3Resource(object):
             fields = [f.name for f in self.readable_fields()]
         if table._id.name not in fields and not no_ids:
             fields.insert(0, table._id.name)
+        if keyset is not None:
+            if table._id.name not in fields:
+                fields.insert(0, table._id.name)
+            if keyset[0].name not in fields:
+                fields.append(keyset[0].name)
         ffields = rfilter.get_fields()
         for f in ffields:
             if f not in fields:
@@ -652,13 +721,16 @@ class S3Resource(object):
                         qf.append(str(e))
 
         # Retrieve the rows
-        rows = db(query).select(*qfields, **attributes)
-        if not rows:
-            return None
-
-        # Apply virtual filter
         if vfltr is not None:
-            rows = rfilter(rows, start=start, limit=limit)
+            # Apply the virtual filter batch-wise
+            rows = rfilter.select(query, qfields,
+                                  start=start, limit=limit, **attributes)
+        else:
+            rows = db(query).select(*qfields, **attributes)
+
+        self._cursor = None
+        if keyset is not None and limit:
+            self._cursor = self.cursor(rows, keyset, limit)
 
         if not rows:
             # No records found
@@ -689,6 +761,8 @@ class S3Resource(object):
         rows.colnames = colnames
 
         # Representation
+        for f in lfields:
+            S3Represent.setup(f.field, rows)
         repr_row = current.manager.represent
         def __represent(f, row, columns=columns):
             field = f.field
@@ -748,6 +822,7 @@ class S3Resource(object):
         if record_id:
             record = Storage(fields).update(id=record_id)
             self.audit("create", self.prefix, self.name, form=record)
+            S3TextIndex(self.table).update(record_id)
 
         return record_id
 
@@ -958,6 +1033,8 @@ class S3Resource(object):
                     # On-delete hook
                     if ondelete:
                         callback(ondelete, row)
+                    # Remove from text index
+                    S3TextIndex(table).delete(row[pkey])
                     # Commit after each row to not have it rolled back by
                     # subsequent cascade errors
                     if not cascade:
@@ -989,6 +1066,8 @@ class S3Resource(object):
                     # On-delete hook
                     if ondelete:
                         callback(ondelete, row)
+                    # Remove from text index
+                    S3TextIndex(table).delete(row[pkey])
                     # Commit after each row to not have it rolled back by
                     # subsequent cascade errors
                     if not cascade:
@@ -1028,6 +1107,7 @@ class S3Resource(object):
             if "approved_by" in table.fields:
                 query = (table._id == record_id)
                 success = current.db(query).update(approved_by=user_id)
+                auth.permission.forget(table, record_id)
                 if not success:
                     db.rollback()
                     return False
@@ -1166,6 +1246,9 @@ class S3Resource(object):
                     if ondelete:
                         callback(ondelete, row, tablename=tablename)
 
+                    # Remove from text index
+                    S3TextIndex(table).delete(row[pkey])
+
         else:
             # Hard delete
             for row in rows:
@@ -1197,6 +1280,9 @@ class S3Resource(object):
                     if ondelete:
                         callback(ondelete, row, tablename=tablename)
 
+                    # Remove from text index
+                    S3TextIndex(table).delete(row[pkey])
+
         return True
 
     # -------------------------------------------------------------------------
@@ -1215,17 +1301,23 @@ class S3Resource(object):
                                           main=main)
 
     # -------------------------------------------------------------------------
-    def count(self, left=None, distinct=False):
+    def count(self, left=None, distinct=False, approximate=False):
         """
             Get the total number of available records in this resource
 
             @param left: left outer joins, if required
             @param distinct: only count distinct rows
+            @param approximate: an approximate count is acceptable (e.g.
+                                for pagination), see S3ResourceFilter.count
         """
 
         if self.rfilter is None:
             self.build_query()
         if self._length is None:
+            if approximate:
+                return self.rfilter.count(left=left,
+                                          distinct=distinct,
+                                          approximate=True)
             self._length = self.rfilter.count(left=left,
                                               distinct=distinct)
         return self._length
@@ -1239,6 +1331,7 @@ class S3Resource(object):
         self._rows = None
         self._rowindex = None
         self._length = None
+        self._cursor = None
         self._ids = []
         self._uids = []
         self.files = Storage()
@@ -1508,12 +1601,15 @@ class S3Resource(object):
                    as_tree=False,
                    as_json=False,
                    maxbounds=False,
-                   pretty_print=False, **args):
+                   pretty_print=False,
+                   after=None, **args):
         """
             Export this resource as S3XML
 
             @param start: index of the first record to export (slicing)
             @param limit: maximum number of records to export (slicing)
+            @param after: cursor to export the records after (instead
+                          of start)
             @param msince: export only records which have been modified
                             after this datetime
             @param dereference: include referenced resources
@@ -1549,7 +1645,8 @@ class S3Resource(object):
                                 mcomponents=mcomponents,
                                 rcomponents=rcomponents,
                                 references=references,
-                                maxbounds=maxbounds)
+                                maxbounds=maxbounds,
+                                after=after)
         if DEBUG:
             end = datetime.datetime.now()
             duration = end - _start
@@ -1608,12 +1705,15 @@ class S3Resource(object):
                     mcomponents=None,
                     rcomponents=None,
                     references=None,
-                    maxbounds=False):
+                    maxbounds=False,
+                    after=None):
         """
             Export the resource as element tree
 
             @param start: index of the first record to export
             @param limit: maximum number of records to export
+            @param after: cursor to export the records after (instead
+                          of start), see get_cursor()
             @param msince: minimum modification date of the records
             @param skip: list of fieldnames to skip
             @param show_urls: show record URLs in the export
@@ -1630,6 +1730,147 @@ class S3Resource(object):
         manager = current.manager
         xml = current.xml
 
+        setup = self.__export_setup(start=start,
+                                    limit=limit,
+                                    skip=skip,
+                                    fields=fields,
+                                    msince=msince,
+                                    references=references,
+                                    after=after)
+        results = setup.results
+
+        # Build the tree
+        root = etree.Element(xml.TAG.root)
+        elements = self.__export_elements(setup,
+                                          parent=root,
+                                          skip=skip,
+                                          fields=fields,
+                                          msince=msince,
+                                          dereference=dereference,
+                                          mcomponents=mcomponents,
+                                          rcomponents=rcomponents,
+                                          references=references)
+        for element in elements:
+            if element is None:
+                results -= 1
+
+        # Complete the tree
+        tree = xml.tree(None,
+                        root=root,
+                        domain=manager.domain,
+                        url=setup.base_url,
+                        results=results,
+                        start=start,
+                        limit=limit,
+                        cursor=setup.cursor,
+                        maxbounds=maxbounds)
+        return tree
+
+    # -------------------------------------------------------------------------
+    def export_stream(self,
+                      start=0,
+                      limit=None,
+                      skip=[],
+                      fields=None,
+                      msince=None,
+                      dereference=True,
+                      mcomponents=[],
+                      rcomponents=None,
+                      references=None,
+                      as_json=False,
+                      maxbounds=False,
+                      after=None):
+        """
+            Export this resource as S3XML or S3JSON, writing one <resource>
+            element at a time instead of building the complete element tree
+            in memory (no XSLT transformation possible)
+
+            @param start: index of the first record to export
+            @param limit: maximum number of records to export
+            @param skip: list of fieldnames to skip
+            @param fields: data fields to include (None for all)
+            @param msince: minimum modification date of the records
+            @param dereference: also export referenced records
+            @param mcomponents: components of the master resource to
+                                include (list of tablenames), empty list
+                                for all
+            @param rcomponents: components of referenced resources to
+                                include (list of tablenames), empty list
+                                for all
+            @param references: foreign key fields to include (None for all)
+            @param as_json: export as S3JSON rather than S3XML
+            @param maxbounds: include the maximum Geo-boundaries
+            @param after: cursor to export the records after (instead
+                          of start), see get_cursor()
+
+            @returns: a generator of UTF-8 encoded chunks
+        """
+
+        manager = current.manager
+        xml = current.xml
+
+        setup = self.__export_setup(start=start,
+                                    limit=limit,
+                                    skip=skip,
+                                    fields=fields,
+                                    msince=msince,
+                                    references=references,
+                                    after=after)
+        results = setup.results
+
+        # The root element must be written before any records, so the
+        # results count can not account for records skipped by msince
+        if results:
+            elements = []
+        else:
+            elements = None
+        root = xml.tree(elements,
+                        domain=manager.domain,
+                        url=setup.base_url,
+                        results=results,
+                        start=start,
+                        limit=limit,
+                        cursor=setup.cursor,
+                        maxbounds=maxbounds).getroot()
+        elements = self.__export_elements(setup,
+                                          parent=None,
+                                          skip=skip,
+                                          fields=fields,
+                                          msince=msince,
+                                          dereference=dereference,
+                                          mcomponents=mcomponents,
+                                          rcomponents=rcomponents,
+                                          references=references)
+        elements = (element for element in elements if element is not None)
+        return xml.stream(root, elements, as_json=as_json)
+
+    # -------------------------------------------------------------------------
+    def __export_setup(self,
+                       start=0,
+                       limit=None,
+                       skip=[],
+                       fields=None,
+                       msince=None,
+                       references=None,
+                       after=None):
+        """
+            Load the records and the GIS encoding data for an export
+
+            @param start: index of the first record to export
+            @param limit: maximum number of records to export
+            @param skip: list of fieldnames to skip
+            @param fields: data fields to include (None for all)
+            @param msince: minimum modification date of the records
+            @param references: foreign key fields to include (None for all)
+            @param after: cursor to load the records after (instead of
+                          start)
+
+            @returns: Storage with the export parameters
+        """
+
+        manager = current.manager
+        xml = current.xml
+
         if manager.show_urls:
             base_url = manager.s3.base_url
         else:
@@ -1654,7 +1895,8 @@ class S3Resource(object):
             orderby = "modified_on ASC"
         else:
             orderby = None
-        self.load(start=start, limit=limit, orderby=orderby)
+        self.load(start=start, limit=limit, orderby=orderby, after=after)
+        self.__represent_setup(rfields)
 
         format = current.auth.permission.format
         request = current.request
@@ -1684,10 +1926,82 @@ class S3Resource(object):
                                             request.function)
             locations = None
 
-        # Build the tree
+        return Storage(base_url=base_url,
+                       rfields=rfields,
+                       dfields=dfields,
+                       results=results,
+                       cursor=self.get_cursor(),
+                       marker=marker,
+                       locations=locations)
+
+    # -------------------------------------------------------------------------
+    def __represent_setup(self, fieldnames):
+        """
+            Look up the representations of the foreign keys in the loaded
+            records in bulk rather than per record
+
+            @param fieldnames: names of the foreign key fields
+        """
+
+        rows = self._rows
+        if not rows:
+            return
+        table = self.table
+        for fieldname in fieldnames:
+            S3Represent.setup(table[fieldname], rows)
+        return
+
+    # -------------------------------------------------------------------------
+    def __export_elements(self,
+                          setup,
+                          parent=None,
+                          skip=[],
+                          fields=None,
+                          msince=None,
+                          dereference=True,
+                          mcomponents=None,
+                          rcomponents=None,
+                          references=None):
+        """
+            Generator exporting the loaded records and their references
+            as <resource> elements
+
+            @param setup: the export parameters from __export_setup
+            @param parent: the root element to append the elements to,
+                           None to export detached elements (streaming)
+            @param skip: list of fieldnames to skip
+            @param fields: data fields to include (None for all)
+            @param msince: minimum modification date of the records
+            @param dereference: also export referenced records
+            @param mcomponents: components of the master resource to
+                                include (list of tablenames), empty list
+                                for all
+            @param rcomponents: components of referenced resources to
+                                include (list of tablenames), empty list
+                                for all
+            @param references: foreign key fields to include (None for all)
+
+            @returns: generator of elements, None for each primary
+                      record which has been skipped
+        """
+
+        manager = current.manager
+        xml = current.xml
+
+        base_url = setup.base_url
+        marker = setup.marker
+        locations = setup.locations
+
+        # Detached elements must not be retained through the reference map
+        streaming = parent is None
+        def release(reference_map, index):
+            if streaming:
+                for ref in reference_map[index:]:
+                    ref.element = None
+            return len(reference_map)
+
         if DEBUG:
             _start = datetime.datetime.now()
-        root = etree.Element(xml.TAG.root)
         export_map = Storage()
         reference_map = []
         prefix = self.prefix
@@ -1697,11 +2011,12 @@ class S3Resource(object):
         else:
             url = "/%s/%s" % (prefix, name)
         export_resource = self.__export_resource
+        index = 0
         for record in self._rows:
             element = export_resource(record,
-                                      rfields=rfields,
-                                      dfields=dfields,
-                                      parent=root,
+                                      rfields=setup.rfields,
+                                      dfields=setup.dfields,
+                                      parent=parent,
                                       base_url=url,
                                       reference_map=reference_map,
                                       export_map=export_map,
@@ -1710,8 +2025,8 @@ class S3Resource(object):
                                       msince=msince,
                                       marker=marker,
                                       locations=locations)
-            if element is None:
-                results -= 1
+            index = release(reference_map, index)
+            yield element
         if DEBUG:
             end = datetime.datetime.now()
             duration = end - _start
@@ -1723,6 +2038,7 @@ class S3Resource(object):
         if DEBUG:
             _start = datetime.datetime.now()
         depth = dereference and manager.MAX_DEPTH or 0
+        split_map = {}
         while reference_map and depth:
             depth -= 1
             load_map = dict()
@@ -1734,21 +2050,21 @@ class S3Resource(object):
                     if not isinstance(ids, list):
                         ids = [ids]
                     # Exclude records which are already in the tree
-                    exported = get_exported(tname, [])
+                    exported = get_exported(tname, {})
                     ids = [x for x in ids if x not in exported]
                     if not ids:
                         continue
-                    # Append the new ids to load_map[tname]
+                    # Add the new ids to load_map[tname]
                     if tname in load_map:
-                        ids = [x for x in ids if x not in load_map[tname]]
-                        load_map[tname] += ids
+                        load_map[tname].update(ids)
                     else:
-                        load_map[tname] = ids
+                        load_map[tname] = set(ids)
 
             reference_map = []
+            index = 0
             REF = xml.ATTRIBUTE.ref
             for tablename in load_map:
-                load_list = load_map[tablename]
+                load_list = list(load_map[tablename])
                 prefix, name = tablename.split("_", 1)
                 rresource = manager.define_resource(prefix, name,
                                                     id=load_list,
@@ -1758,16 +2074,29 @@ class S3Resource(object):
                     url = "%s/%s/%s" % (manager.s3.base_url, prefix, name)
                 else:
                     url = "/%s/%s" % (prefix, name)
-                rfields, dfields = rresource.split_fields(skip=skip,
-                                                          data=fields,
-                                                          references=references)
-                rresource.load()
+
+                # Split the fields only once per table and export
+                if tablename in split_map:
+                    rfields, dfields, lfields = split_map[tablename]
+                    rresource.rfields = rfields
+                    rresource.dfields = dfields
+                else:
+                    rfields, dfields = rresource.split_fields(skip=skip,
+                                                              data=fields,
+                                                              references=references)
+                    lfields = self.__export_fields(rresource, rfields, dfields)
+                    split_map[tablename] = (rfields, dfields, lfields)
+
+                # Bulk-load all referenced records of this table at once,
+                # with only the fields needed for the export
+                rresource.load(fields=lfields)
+                rresource.__represent_setup(rfields)
                 export_resource = rresource.__export_resource
                 for record in rresource:
                     element = export_resource(record,
                                               rfields=rfields,
                                               dfields=dfields,
-                                              parent=root,
+                                              parent=parent,
                                               base_url=url,
                                               reference_map=reference_map,
                                               export_map=export_map,
@@ -1775,10 +2104,12 @@ class S3Resource(object):
                                               skip=skip,
                                               marker=marker,
                                               locations=locations)
+                    index = release(reference_map, index)
 
                     # Mark as referenced element (for XSLT)
                     if element is not None:
                         element.set(REF, "True")
+                        yield element
         if DEBUG:
             end = datetime.datetime.now()
             duration = end - _start
@@ -1786,16 +2117,33 @@ class S3Resource(object):
             _debug("export_resource of referenced resources and their components completed in %s seconds" % \
                 duration)
 
-        # Complete the tree
-        tree = xml.tree(None,
-                        root=root,
-                        domain=manager.domain,
-                        url=base_url,
-                        results=results,
-                        start=start,
-                        limit=limit,
-                        maxbounds=maxbounds)
-        return tree
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __export_fields(resource, rfields, dfields):
+        """
+            Get the names of the fields to load from a referenced resource
+            for the export
+
+            @param resource: the referenced resource
+            @param rfields: list of reference fields to export
+            @param dfields: list of data fields to export
+
+            @returns: list of field names, or None for all fields
+        """
+
+        tablename = resource.tablename
+        if current.s3db.get_config(tablename, "onexport", None):
+            # The postprocess hook may need any field
+            return None
+
+        xml = current.xml
+        fields = [resource.table._id.name,
+                  xml.UID, xml.MTIME, xml.DELETED, xml.MCI]
+        append = fields.append
+        for f in rfields + dfields:
+            if f not in fields:
+                append(f)
+        return fields
 
     # -------------------------------------------------------------------------
     def __export_resource(self,
@@ -1838,6 +2186,12 @@ class S3Resource(object):
         action = "read"
         representation = "xml"
 
+        # Index the elements only if they are kept in a tree
+        if parent is not None:
+            index = lambda e: e
+        else:
+            index = lambda e: None
+
         # Construct the record URL
         if base_url:
             record_url = "%s/%s" % (base_url, record[pkey])
@@ -1919,11 +2273,13 @@ class S3Resource(object):
                     if celement is not None:
                         add = True # keep the parent record
                         map_record(crecord, crmap,
-                                   reference_map, export_map)
+                                   reference_map, export_map,
+                                   element=index(celement))
 
         # Update reference_map and export_map
         if add:
-            self.__map_record(record, rmap, reference_map, export_map)
+            self.__map_record(record, rmap, reference_map, export_map,
+                              element=index(element))
         elif parent is not None and element is not None:
             idx = parent.index(element)
             if idx:
@@ -2019,7 +2375,8 @@ class S3Resource(object):
         return (element, rmap)
 
     # -------------------------------------------------------------------------
-    def __map_record(self, record, rmap, reference_map, export_map):
+    def __map_record(self, record, rmap, reference_map, export_map,
+                     element=None):
         """
             Add the record to the export map, and update the
             reference map with the record's references
@@ -2027,7 +2384,9 @@ class S3Resource(object):
             @param record: the record
             @param rmap: the reference map of the record
             @param reference_map: the reference map of the request
-            @param export_map: the export map of the request
+            @param export_map: the export map of the request,
+                               {tablename: {record_id: element}}
+            @param element: the <resource> element of the record
         """
 
         tablename = self.tablename
@@ -2036,9 +2395,9 @@ class S3Resource(object):
         if rmap:
             reference_map.extend(rmap)
         if tablename in export_map:
-            export_map[tablename].append(record_id)
+            export_map[tablename][record_id] = element
         else:
-            export_map[tablename] = [record_id]
+            export_map[tablename] = {record_id: element}
         return
 
     # -------------------------------------------------------------------------
@@ -2059,6 +2418,7 @@ class S3Resource(object):
                    conflict_policy=None,
                    last_sync=None,
                    onconflict=None,
+                   chunk_size=None,
                    **args):
         """
             XML Importer
@@ -2080,6 +2440,9 @@ class S3Resource(object):
             @param conflict_policy: policy for conflict resolution (sync)
             @param last_sync: last synchronization datetime (sync)
             @param onconflict: callback hook for conflict resolution (sync)
+            @param chunk_size: for CSV imports, import the source in chunks
+                               of this number of rows, each transformed and
+                               committed separately (to limit memory use)
             @param args: parameters to pass to the transformation stylesheet
         """
 
@@ -2114,62 +2477,71 @@ class S3Resource(object):
                         name=name,
                         utcnow=utcnow)
 
-            # Build import tree
-            if not isinstance(source, (list, tuple)):
-                source = [source]
-            for item in source:
-                if isinstance(item, (list, tuple)):
-                    resourcename, s = item[:2]
-                else:
-                    resourcename, s = None, item
-                if isinstance(s, etree._ElementTree):
-                    t = s
-                elif format == "json":
-                    if isinstance(s, basestring):
-                        source = StringIO(s)
-                        t = xml.json2tree(s)
-                    else:
-                        t = xml.json2tree(s)
-                elif format == "csv":
-                    t = xml.csv2tree(s,
-                                     resourcename=resourcename,
-                                     extra_data=extra_data)
-                else:
-                    t = xml.parse(s)
-                if not t:
-                    if xml.error:
-                        raise SyntaxError(xml.error)
-                    else:
-                        raise SyntaxError("Invalid source")
-
-                if stylesheet is not None:
-                    t = xml.transform(t, stylesheet, **args)
-                    _debug(t)
-                    if not t:
-                        raise SyntaxError(xml.error)
-
-                if not tree:
-                    tree = t.getroot()
-                else:
-                    tree.extend(list(t.getroot()))
-
             if files is not None and isinstance(files, dict):
                 self.files = Storage(files)
 
+            # Build the import trees
+            trees = self.__import_trees(source,
+                                        format=format,
+                                        stylesheet=stylesheet,
+                                        extra_data=extra_data,
+                                        chunk_size=chunk_size,
+                                        **args)
+
+            if format == "csv" and chunk_size and commit_job:
+                # Import chunk by chunk, sharing the directory of imported
+                # elements to resolve references across chunks
+                directory = Storage()
+                error = None
+                error_tree = None
+                for tree in trees:
+                    success = self.import_tree(id, tree,
+                                               ignore_errors=ignore_errors,
+                                               strategy=strategy,
+                                               update_policy=update_policy,
+                                               conflict_policy=conflict_policy,
+                                               last_sync=last_sync,
+                                               onconflict=onconflict,
+                                               directory=directory)
+                    if self.error:
+                        error = self.error
+                    if self.error_tree is not None:
+                        if error_tree is None:
+                            error_tree = self.error_tree
+                        else:
+                            error_tree.extend(list(self.error_tree))
+                    if not success:
+                        break
+                self.error = error
+                self.error_tree = error_tree
+            else:
+                tree = None
+                for t in trees:
+                    if tree is None:
+                        tree = t
+                    else:
+                        tree.extend(list(t))
+                success = self.import_tree(id, tree,
+                                           ignore_errors=ignore_errors,
+                                           commit_job=commit_job,
+                                           strategy=strategy,
+                                           update_policy=update_policy,
+                                           conflict_policy=conflict_policy,
+                                           last_sync=last_sync,
+                                           onconflict=onconflict)
+
         else:
             # job ID given
-            pass
-
-        success = self.import_tree(id, tree,
-                                   ignore_errors=ignore_errors,
-                                   job_id=job_id,
-                                   commit_job=commit_job,
-                                   delete_job=delete_job,
-                                   strategy=strategy,
-                                   update_policy=update_policy,
-                                   conflict_policy=conflict_policy,
-                                   last_sync=last_sync,
-                                   onconflict=onconflict)
+            success = self.import_tree(id, None,
+                                       ignore_errors=ignore_errors,
+                                       job_id=job_id,
+                                       commit_job=commit_job,
+                                       delete_job=delete_job,
+                                       strategy=strategy,
+                                       update_policy=update_policy,
+                                       conflict_policy=conflict_policy,
+                                       last_sync=last_sync,
+                                       onconflict=onconflict)
 
         self.files = Storage()
 
@@ -2203,6 +2575,63 @@ class S3Resource(object):
             return xml.json_message(False, 400,
                                     message=self.error, tree=tree)
 
+    # -------------------------------------------------------------------------
+    def __import_trees(self, source,
+                       format="xml",
+                       stylesheet=None,
+                       extra_data=None,
+                       chunk_size=None,
+                       **args):
+        """
+            Parse and transform the sources for import_xml
+
+            @param source: the data source(s), see import_xml
+            @param format: type of source = "xml", "json" or "csv"
+            @param stylesheet: stylesheet to use for transformation
+            @param extra_data: for CSV imports, dict of extra cols to add
+                               to each row
+            @param chunk_size: for CSV imports, the maximum number of rows
+                               per tree
+            @param args: parameters to pass to the transformation stylesheet
+
+            @returns: a generator of element tree roots
+        """
+
+        xml = current.xml
+
+        if not isinstance(source, (list, tuple)):
+            source = [source]
+        for item in source:
+            if isinstance(item, (list, tuple)):
+                resourcename, s = item[:2]
+            else:
+                resourcename, s = None, item
+            if isinstance(s, etree._ElementTree):
+                trees = [s]
+            elif format == "json":
+                trees = [xml.json2tree(s)]
+            elif format == "csv":
+                trees = xml.csv2trees(s,
+                                      resourcename=resourcename,
+                                      extra_data=extra_data,
+                                      chunk_size=chunk_size)
+            else:
+                trees = [xml.parse(s)]
+            for t in trees:
+                if not t:
+                    if xml.error:
+                        raise SyntaxError(xml.error)
+                    else:
+                        raise SyntaxError("Invalid source")
+
+                if stylesheet is not None:
+                    t = xml.transform(t, stylesheet, **args)
+                    _debug(t)
+                    if not t:
+                        raise SyntaxError(xml.error)
+
+                yield t.getroot()
+
     # -------------------------------------------------------------------------
     def import_tree(self, id, tree,
                     job_id=None,
@@ -2213,13 +2642,17 @@ class S3Resource(object):
                     update_policy=None,
                     conflict_policy=None,
                     last_sync=None,
-                    onconflict=None):
+                    onconflict=None,
+                    directory=None):
         """
             Import data from an S3XML element tree.
 
             @param id: record ID or list of record IDs to update
             @param tree: the element tree
             @param ignore_errors: continue at errors (=skip invalid elements)
+            @param directory: directory of previously imported elements to
+                              resolve references (updated after commit),
+                              for imports in multiple chunks
 
             @param job_id: restore a job from the job table (ID or UID)
             @param delete_job: delete the import job from the job table
@@ -2360,7 +2793,8 @@ class S3Resource(object):
                                      update_policy=update_policy,
                                      conflict_policy=conflict_policy,
                                      last_sync=last_sync,
-                                     onconflict=onconflict)
+                                     onconflict=onconflict,
+                                     directory=directory)
             add_item = import_job.add_item
             for element in elements:
                 success = add_item(element=element,
@@ -2373,6 +2807,8 @@ class S3Resource(object):
 
         # Commit the import job
         import_job.commit(ignore_errors=ignore_errors)
+        if directory is not None:
+            import_job.update_directory()
         self.error = import_job.error
         self.import_count += import_job.count
         self.import_created += import_job.created
@@ -2972,6 +3408,182 @@ class S3Resource(object):
 
         return (start, start + limit)
 
+    # -------------------------------------------------------------------------
+    # Keyset pagination
+    # -------------------------------------------------------------------------
+    def keyset(self, orderby, after=None):
+        """
+            Get the keyset for cursor-based pagination with an orderby:
+            a single field of the master table, with the record ID as
+            tie-breaker
+
+            @param orderby: the orderby (Field, ~Field, "[table.]field
+                            [ASC|DESC]" or a list with one of these),
+                            None to order by record ID
+            @param after: cursor to seek the records after
+
+            @returns: tuple (keyset, seek, orderby) with keyset = (Field,
+                      ascending) or None if the orderby is not supported,
+                      seek = query for the records after the cursor, and
+                      orderby = the orderby including the tie-breaker
+
+            @raises SyntaxError: for an invalid cursor, or if the orderby
+                                 does not support cursors
+        """
+
+        table = self.table
+        pkey = table._id
+
+        if isinstance(orderby, (list, tuple)) and len(orderby) == 1:
+            orderby = orderby[0]
+        field = None
+        ascending = True
+        if orderby is None:
+            field = pkey
+        elif isinstance(orderby, Field):
+            field = orderby
+        elif isinstance(orderby, str):
+            spec = orderby.strip().split()
+            if len(spec) in (1, 2) and "," not in orderby:
+                fn = spec[0].split(".", 1)
+                if len(fn) == 1 or fn[0] == table._tablename:
+                    fname = fn[-1]
+                    if fname in table.fields:
+                        field = table[fname]
+                if len(spec) == 2:
+                    direction = spec[1].upper()
+                    if direction == "DESC":
+                        ascending = False
+                    elif direction != "ASC":
+                        field = None
+        elif getattr(orderby, "op", None) == current.db._adapter.INVERT and \
+             isinstance(orderby.first, Field):
+            field = orderby.first
+            ascending = False
+
+        if field is None or field.name not in table.fields or \
+           str(field) != str(table[field.name]):
+            if after is not None:
+                raise SyntaxError("Cursor not supported for this orderby")
+            return (None, None, orderby)
+
+        if field.name == pkey.name:
+            field = pkey
+            orderby = ascending and pkey or ~pkey
+        elif ascending:
+            orderby = field | pkey
+        else:
+            orderby = ~field | ~pkey
+        keyset = (field, ascending)
+
+        seek = None
+        if after is not None:
+            seek = self.seek(keyset, after)
+        return (keyset, seek, orderby)
+
+    # -------------------------------------------------------------------------
+    def seek(self, keyset, after):
+        """
+            Get the query for the records after a cursor
+
+            @param keyset: the keyset, tuple (Field, ascending)
+            @param after: the cursor
+
+            @raises SyntaxError: for an invalid cursor
+        """
+
+        field, ascending = keyset
+        pkey = self.table._id
+
+        try:
+            data = after.encode("ascii")
+            data = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+            fname, asc, value, record_id = json.loads(data)
+            if fname != field.name or bool(asc) != ascending:
+                raise ValueError
+            record_id = long(record_id)
+            if value is not None:
+                ftype = str(field.type)
+                if ftype == "datetime":
+                    value = datetime.datetime.strptime(value, self.CURSOR_DATETIME)
+                elif ftype == "date":
+                    value = datetime.datetime.strptime(value, "%Y-%m-%d").date()
+                elif ftype == "time":
+                    value = datetime.datetime.strptime(value, self.CURSOR_TIME).time()
+                elif ftype[:7] == "decimal":
+                    value = decimal.Decimal(value)
+        except (AttributeError, TypeError, ValueError, UnicodeError,
+                decimal.InvalidOperation):
+            raise SyntaxError("Invalid cursor: %s" % after)
+
+        if ascending:
+            after_id = pkey > record_id
+        else:
+            after_id = pkey < record_id
+        if field is pkey:
+            return after_id
+
+        # Where NULLs come in the order depends on the database
+        nulls_high = current.db._dbname in ("postgres", "oracle")
+        nulls_last = nulls_high == ascending
+        if value is None:
+            query = (field == None) & after_id
+            if not nulls_last:
+                query |= (field != None)
+        else:
+            if ascending:
+                query = (field > value)
+            else:
+                query = (field < value)
+            query |= (field == value) & after_id
+            if nulls_last:
+                query |= (field == None)
+        return query
+
+    # -------------------------------------------------------------------------
+    def cursor(self, rows, keyset, limit):
+        """
+            Get the cursor for the records after the last of rows
+
+            @param rows: the rows (ordered by the keyset)
+            @param keyset: the keyset, tuple (Field, ascending)
+            @param limit: the page size (no cursor if less rows)
+
+            @returns: the cursor (str) or None if there are no more rows
+        """
+
+        if not rows or len(rows) < limit:
+            return None
+
+        field, ascending = keyset
+        row = rows.last()
+        record_id = row[self.table._id]
+        value = row[field]
+        if value is not None:
+            ftype = str(field.type)
+            if ftype == "datetime":
+                value = value.strftime(self.CURSOR_DATETIME)
+            elif ftype == "date":
+                value = value.isoformat()
+            elif ftype == "time":
+                value = value.strftime(self.CURSOR_TIME)
+            elif ftype[:7] == "decimal":
+                value = str(value)
+        data = json.dumps([field.name, ascending and 1 or 0, value, record_id])
+        return base64.urlsafe_b64encode(data).rstrip("=")
+
+    # -------------------------------------------------------------------------
+    def get_cursor(self):
+        """
+            Get the cursor for the next page after load() or sqltable()
+            with a limit, to pass as "after" to the next call
+
+            @returns: the cursor, or None if there are no more records
+                      (or the orderby does not support cursors)
+        """
+
+        return self._cursor
+
     # -------------------------------------------------------------------------
     def get_join(self):
         """ Get join for this component """
@@ -3184,10 +3796,119 @@ class S3Resource(object):
             return 1
         return 0
 
+# =============================================================================
+class S3CountCache(object):
+    """
+        Process-wide cache for approximate numbers of records matching
+        a resource filter, invalidated by writes to any of the tables
+        involved (as audited by S3Audit), and after TTL seconds (writes
+        in other processes or outside of S3 are not seen)
+    """
+
+    # Time-to-live of cached counts (seconds)
+    TTL = 300
+
+    # Maximum number of cached counts
+    MAX_SIZE = 1000
+
+    lock = threading.Lock()
+    counts = {}
+    versions = {}
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, key, tablenames):
+        """
+            Get a cached count
+
+            @param key: the cache key
+            @param tablenames: the names of the tables involved
+
+            @returns: the count, or None if not cached or outdated
+        """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            entry = cls.counts.get(key)
+            if entry is None:
+                return None
+            count, stamp, expires = entry
+            if expires < time.time() or stamp != cls._stamp(tablenames):
+                del cls.counts[key]
+                return None
+            return count
+        finally:
+            lock.release()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def store(cls, key, tablenames, count):
+        """
+            Store a count in the cache
+
+            @param key: the cache key
+            @param tablenames: the names of the tables involved
+            @param count: the count
+        """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            counts = cls.counts
+            now = time.time()
+            if len(counts) >= cls.MAX_SIZE:
+                # Drop outdated counts, or all if none is outdated
+                expired = [k for k in counts if counts[k][2] < now]
+                if expired:
+                    for k in expired:
+                        del counts[k]
+                else:
+                    counts.clear()
+            counts[key] = (count, cls._stamp(tablenames), now + cls.TTL)
+        finally:
+            lock.release()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls, tablename):
+        """
+            Invalidate all cached counts involving a table (to be called
+            after writing to the table)
+
+            @param tablename: the table name
+        """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            versions = cls.versions
+            versions[tablename] = versions.get(tablename, 0) + 1
+        finally:
+            lock.release()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _stamp(cls, tablenames):
+        """
+            The current write versions of the tables (call with lock)
+
+            @param tablenames: the table names
+        """
+
+        versions = cls.versions
+        return tuple([(tn, versions.get(tn, 0)) for tn in sorted(tablenames)])
+
 # =============================================================================
 class S3ResourceFilter:
     """ Class representing a resource filter """
 
+    # Number of rows to retrieve per batch when applying a virtual filter
+    VBATCH = 500
+
+    # Minimum planner estimate to use instead of an exact count
+    ESTIMATE_MIN = 10000
+
     def __init__(self, resource, id=None, uid=None, filter=None, vars=None):
         """
             Constructor
@@ -3365,11 +4086,13 @@ class S3ResourceFilter:
 
         if isinstance(f, S3ResourceQuery):
 
-            q = f.query(self.resource)
+            # Push down all conjuncts with real fields to SQL, apply
+            # only the virtual remainder after the select
+            q, vf = f.split(self.resource)
             if q is not None:
                 self._add_query(q, component=component, master=master)
-            else:
-                self._add_vfltr(f, component=component, master=master)
+            if vf is not None:
+                self._add_vfltr(vf, component=component, master=master)
 
             skip_master = False
             alias = self.resource.alias
@@ -3693,6 +4416,15 @@ class S3ResourceFilter:
                                           (gtable.lon < float(maxLon)) & \
                                           (gtable.lat > float(minLat)) & \
                                           (gtable.lat < float(maxLat))
+                            if gtable._tablename == "gis_location":
+                                # Shortlist from the spatial index
+                                gis = current.gis
+                                shortlist = gis.get_location_shortlist(minLon,
+                                                                       minLat,
+                                                                       maxLon,
+                                                                       maxLat)
+                                if shortlist is not None:
+                                    bbox_filter = shortlist & bbox_filter
                         if fname is not None:
                             # Need a join
                             join = (gtable.id == table[fname])
@@ -3786,20 +4518,88 @@ class S3ResourceFilter:
                     colnames=rows.colnames, compact=False)
 
     # -------------------------------------------------------------------------
-    def count(self, left=None, distinct=False):
+    def select(self, query, fields, start=None, limit=None, **attributes):
+        """
+            Select the rows matching query and the effective virtual
+            filter, retrieving the rows in batches of VBATCH and stopping
+            as soon as start+limit matching rows have been found
+
+            @param query: the DAL query
+            @param fields: the fields to select
+            @param start: index of the first matching record to select
+            @param limit: maximum number of records to select
+            @param attributes: further select attributes (limitby
+                               will be ignored)
+        """
+
+        db = current.db
+        vfltr = self.vfltr
+        if vfltr is None:
+            if start is not None or limit is not None:
+                limitby = self.resource.limitby(start=start, limit=limit)
+                if limitby is not None:
+                    attributes["limitby"] = limitby
+            return db(query).select(*fields, **attributes)
+
+        resource = self.resource
+        if start is None or start < 0:
+            start = 0
+        if limit is not None:
+            last = start + max(limit, 0)
+        else:
+            last = None
+
+        # Batches must be retrieved in a stable order
+        if not attributes.get("orderby"):
+            table_id = resource.table._id
+            if not attributes.get("distinct") or \
+               str(table_id) in [str(f) for f in fields]:
+                attributes["orderby"] = table_id
+        attributes.pop("limitby", None)
+
+        batch = self.VBATCH
+        offset = 0
+        matches = 0
+        result = []
+        append = result.append
+        colnames = None
+        dbset = db(query)
+        while True:
+            attributes["limitby"] = (offset, offset + batch)
+            rows = dbset.select(*fields, **attributes)
+            if colnames is None:
+                colnames = rows.colnames
+            for row in rows:
+                success = vfltr(resource, row, virtual=True)
+                if success or success is None:
+                    if matches >= start:
+                        append(row)
+                    matches += 1
+                    if last is not None and matches >= last:
+                        break
+            if last is not None and matches >= last or len(rows) < batch:
+                break
+            offset += batch
+
+        return Rows(db, result, colnames=colnames, compact=False)
+
+    # -------------------------------------------------------------------------
+    def count(self, left=None, distinct=False, approximate=False):
         """
             Get the total number of matching records
 
             @param left: left outer joins
             @param distinct: count only distinct rows
+            @param approximate: an approximate count is acceptable, i.e.
+                                the query planner's estimate for large
+                                results (PostgreSQL) or a cached count,
+                                requires settings.ui.approximate_counts
         """
 
         resource = self.resource
         distinct |= self.distinct
         if resource is None:
             return 0
-        table = resource.table
-        tablename = resource.tablename
 
         # Left joins
         left_joins = left
@@ -3807,6 +4607,8 @@ class S3ResourceFilter:
             left_joins = []
         elif not isinstance(left, list):
             left_joins = [left_joins]
+        else:
+            left_joins = list(left_joins)
         joined_tables = [str(join.first) for join in left_joins]
 
         # Add the left joins from the filter
@@ -3825,30 +4627,209 @@ class S3ResourceFilter:
         else:
             left = None
 
-        if self.vfltr is None:
-            if distinct:
-                rows = current.db(self.query).select(table._id,
-                                                     left=left,
-                                                     distinct=distinct)
+        if not approximate or \
+           not current.deployment_settings.get_ui_approximate_counts():
+            return self._count(left=left, distinct=distinct)
+
+        key, tablenames = self._count_key(left=left, distinct=distinct)
+        count = S3CountCache.get(key, tablenames)
+        if count is None:
+            if self.vfltr is None and not distinct:
+                count = self._estimate(left=left)
+            if count is None:
+                count = self._count(left=left, distinct=distinct)
+            S3CountCache.store(key, tablenames, count)
+        return count
+
+    # -------------------------------------------------------------------------
+    def _count(self, left=None, distinct=False):
+        """
+            Count the matching records: COUNT in SQL, and the virtual
+            filter (if any) applied to a minimal projection
+
+            @param left: left outer joins
+            @param distinct: count only distinct rows
+        """
+
+        if self.vfltr is not None:
+            return self._count_virtual(left=left, distinct=distinct)
+
+        db = current.db
+        table = self.resource.table
+        if distinct:
+            try:
+                cnt = table._id.count(distinct=True)
+            except TypeError:
+                # No COUNT(DISTINCT) in this DAL version
+                rows = db(self.query).select(table._id,
+                                             left=left,
+                                             distinct=distinct)
                 return len(rows)
-            else:
-                cnt = table[table._id.name].count()
-                row = current.db(self.query).select(cnt, left=left).first()
-                if row:
-                    return(row[cnt])
-                else:
-                    return 0
         else:
-            list_fields = current.s3db.get_config(tablename,
-                                                  "list_fields")
-            sqltable = resource.sqltable
-            rows = sqltable(fields=list_fields,
-                            left=left,
-                            distinct=distinct,
-                            as_list=True)
-        if rows is None:
+            cnt = table._id.count()
+        row = db(self.query).select(cnt, left=left).first()
+        if row:
+            return row[cnt]
+        else:
             return 0
-        return len(rows)
+
+    # -------------------------------------------------------------------------
+    def _count_virtual(self, left=None, distinct=False):
+        """
+            Count the records matching the query and the virtual filter,
+            retrieving only the primary key and the fields the virtual
+            filter needs, in batches of VBATCH rows which are discarded
+            after filtering
+
+            @param left: left outer joins
+            @param distinct: count only distinct records
+        """
+
+        db = current.db
+        resource = self.resource
+        table = resource.table
+        pkey = table._id
+        vfltr = self.vfltr
+
+        selectors = [pkey.name]
+        for selector in self.get_fields():
+            if selector not in selectors:
+                selectors.append(selector)
+        lfields, joins, ljoins, d = resource.resolve_selectors(selectors)
+
+        # Joins
+        query = self.query
+        for join in joins.values():
+            if str(join) not in str(query):
+                query &= join
+        left_joins = left and list(left) or []
+        joined_tables = [str(join.first) for join in left_joins]
+        for tablename in ljoins:
+            for join in ljoins[tablename]:
+                tn = str(join.first)
+                if tn not in joined_tables:
+                    joined_tables.append(tn)
+                    left_joins.append(join)
+        if left_joins:
+            try:
+                left_joins.sort(resource.sortleft)
+            except:
+                pass
+        else:
+            left_joins = None
+
+        # Fields (virtual fields can only be computed from complete rows)
+        load = current.s3db.table
+        fields = []
+        colnames = set()
+        def add(field):
+            colname = str(field)
+            if colname not in colnames:
+                colnames.add(colname)
+                fields.append(field)
+        add(pkey)
+        for lf in lfields:
+            if lf.field is not None:
+                add(lf.field)
+            else:
+                qtable = load(lf.tname)
+                if qtable is not None:
+                    for field in qtable:
+                        add(field)
+
+        batch = self.VBATCH
+        offset = 0
+        count = 0
+        ids = set()
+        dbset = db(query)
+        while True:
+            rows = dbset.select(limitby=(offset, offset + batch),
+                                orderby=pkey,
+                                left=left_joins,
+                                *fields)
+            for row in rows:
+                success = vfltr(resource, row, virtual=True)
+                if success or success is None:
+                    if distinct:
+                        ids.add(row[pkey])
+                    else:
+                        count += 1
+            if len(rows) < batch:
+                break
+            offset += batch
+
+        if distinct:
+            return len(ids)
+        return count
+
+    # -------------------------------------------------------------------------
+    def _estimate(self, left=None):
+        """
+            Get the query planner's estimate of the number of matching
+            records (PostgreSQL only)
+
+            @param left: left outer joins
+
+            @returns: the estimate, or None if not available or less
+                      than ESTIMATE_MIN (small estimates are unreliable,
+                      and exact counts cheap enough)
+        """
+
+        db = current.db
+        if db._dbname != "postgres":
+            return None
+        table = self.resource.table
+        sql = db(self.query)._select(table._id, left=left)
+        try:
+            plan = db.executesql("EXPLAIN %s" % sql.rstrip(";"))
+        except:
+            return None
+        if not plan:
+            return None
+        match = re.search(r"rows=(\d+)", plan[0][0])
+        if not match:
+            return None
+        estimate = int(match.group(1))
+        if estimate < self.ESTIMATE_MIN:
+            return None
+        return estimate
+
+    # -------------------------------------------------------------------------
+    def _count_key(self, left=None, distinct=False):
+        """
+            Get the cache key for the number of matching records, and the
+            names of the tables involved in the query
+
+            @param left: left outer joins
+            @param distinct: count only distinct rows
+
+            @returns: tuple (key, tablenames)
+        """
+
+        resource = self.resource
+        tablename = resource.tablename
+
+        tablenames = set([tablename])
+        try:
+            tablenames.update(current.db._adapter.tables(self.query))
+        except:
+            pass
+        if left:
+            tablenames.update([join.first._tablename for join in left])
+            left = [str(join) for join in left]
+
+        vfltr = self.vfltr
+        if vfltr is not None:
+            vfltr = vfltr.represent(resource)
+
+        import hashlib
+        key = "%s|%s|%s|%s|%s" % (tablename,
+                                  self.query,
+                                  vfltr,
+                                  left,
+                                  distinct)
+        key = "%s:%s" % (tablename, hashlib.md5(key).hexdigest())
+        return (key, tablenames)
 
     # -------------------------------------------------------------------------
     def __nonzero__(self):
@@ -4267,6 +5248,54 @@ class S3ResourceQuery:
             query = ~(query)
         return query
 
+    # -------------------------------------------------------------------------
+    def split(self, resource):
+        """
+            Split this query into a DAL query for all conjuncts which can
+            be resolved into real fields, and a virtual remainder which
+            must be applied to the rows after the select
+
+            @param resource: the resource to resolve the query against
+
+            @returns: tuple (query, vfltr), either of them can be None
+        """
+
+        if self.op == self.AND:
+            lq, lf = self.left.split(resource)
+            rq, rf = self.right.split(resource)
+            if lq is None:
+                query = rq
+            elif rq is None:
+                query = lq
+            else:
+                query = lq & rq
+            if lf is None:
+                vfltr = rf
+            elif rf is None:
+                vfltr = lf
+            else:
+                vfltr = lf & rf
+            return (query, vfltr)
+
+        # OR and NOT can only be pushed down as a whole
+        query = self.query(resource)
+        if query is None:
+            return (None, self)
+        else:
+            return (query, None)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _nested_select(r):
+        """
+            Check whether the right operand of BELONGS is a nested select
+            (SQL string as returned by Set._select) rather than a value
+
+            @param r: the right operand
+        """
+
+        return isinstance(r, basestring) and r[:7].upper() == "SELECT "
+
     # -------------------------------------------------------------------------
     def _query_bare(self, op, l, r):
         """
@@ -4282,6 +5311,8 @@ class S3ResourceQuery:
         elif op == self.ANYOF:
             q = l.contains(r, all=False)
         elif op == self.BELONGS:
+            if self._nested_select(r):
+                return l.belongs(r)
             if type(r) is not list:
                 r = [r]
             if None in r:
@@ -4436,7 +5467,9 @@ class S3ResourceQuery:
                     return True
             return False
         elif op == self.BELONGS:
-            if not isinstance(r, (list, tuple)):
+            if self._nested_select(r):
+                r = [row[0] for row in current.db.executesql(r)]
+            elif not isinstance(r, (list, tuple)):
                 r = [r]
             r = convert(l, r)
             result = contains(r, l)
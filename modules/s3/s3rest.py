@@ -62,6 +62,7 @@ from gluon.tools import callback
 
 from s3xml import S3XML
 from s3export import S3Exporter
+from s3fields import S3Represent
 from s3method import S3Method
 from s3sync import S3Sync
 from s3resource import S3Resource, S3MarkupStripper
@@ -402,7 +403,15 @@ class S3RequestManager(object):
                     val = text = vals
 
         # Get text representation
-        if field.represent:
+        represent = field.represent
+        if isinstance(represent, S3Represent):
+            # Has its own cache (filled in bulk)
+            text = represent(val)
+            if isinstance(text, DIV):
+                text = str(text)
+            elif not isinstance(text, basestring):
+                text = unicode(text)
+        elif represent:
             try:
                 key = "%s_repr_%s" % (field, val)
                 unicode(key)
@@ -1227,6 +1236,10 @@ class S3Request(object):
             except ValueError:
                 limit = None
 
+        # Keyset pagination (cursor from the "next" attribute of the
+        # previous page)
+        after = _vars.get("after", None)
+
         # msince
         msince = _vars.get("msince", None)
         if msince is not None:
@@ -1304,6 +1317,14 @@ class S3Request(object):
         else:
             fields = None # all
 
+        # Server-side clustering of map features
+        if r.representation == "geojson" and "cluster" in _vars and \
+           str(_vars["cluster"]).lower() not in ("0", "false"):
+            output = S3Request.get_clusters(r)
+            if output is not None:
+                current.response.headers["Content-Type"] = "application/json"
+                return output
+
         # Find XSLT stylesheet
         stylesheet = r.stylesheet()
 
@@ -1328,24 +1349,121 @@ class S3Request(object):
         headers["Content-Type"] = manager.content_type.get(representation, default)
 
         # Export the resource
-        output = r.resource.export_xml(start=start,
-                                       limit=limit,
-                                       msince=msince,
-                                       fields=fields,
-                                       dereference=True,
-                                       references=references,
-                                       mcomponents=mcomponents,
-                                       rcomponents=rcomponents,
-                                       stylesheet=stylesheet,
-                                       as_json=as_json,
-                                       maxbounds=maxbounds,
-                                       **args)
+        if stylesheet is None:
+            # Native format => export incrementally
+            try:
+                output = r.resource.export_stream(start=start,
+                                                  limit=limit,
+                                                  msince=msince,
+                                                  fields=fields,
+                                                  dereference=True,
+                                                  references=references,
+                                                  mcomponents=mcomponents,
+                                                  rcomponents=rcomponents,
+                                                  as_json=as_json,
+                                                  maxbounds=maxbounds,
+                                                  after=after)
+            except SyntaxError, e:
+                r.error(400, str(e))
+            return r.spool(output)
+
+        # Map formats with the default stylesheet => encode natively
+        if representation in ("geojson", "kml", "gpx") and \
+           after is None and \
+           isinstance(stylesheet, basestring) and \
+           "transform" not in r.vars and \
+           "xsltmode" not in _vars and \
+           not r.component:
+            from s3codec import S3Codec
+            codec = S3Codec.get_codec(representation)
+            output = codec.encode(r.resource,
+                                  start=start,
+                                  limit=limit,
+                                  msince=msince,
+                                  fields=fields,
+                                  references=references,
+                                  mcomponents=mcomponents,
+                                  rcomponents=rcomponents)
+            if output is not None:
+                return r.spool(output)
+
+        try:
+            output = r.resource.export_xml(start=start,
+                                           limit=limit,
+                                           msince=msince,
+                                           fields=fields,
+                                           dereference=True,
+                                           references=references,
+                                           mcomponents=mcomponents,
+                                           rcomponents=rcomponents,
+                                           stylesheet=stylesheet,
+                                           as_json=as_json,
+                                           maxbounds=maxbounds,
+                                           after=after,
+                                           **args)
+        except SyntaxError, e:
+            r.error(400, str(e))
         # Transformation error?
         if not output:
             r.error(400, "XSLT Transformation Error: %s " % current.xml.error)
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_clusters(r):
+        """
+            Clustered GeoJSON export for map layers
+
+            URL vars: cluster=1, zoom=<zoom level>,
+                      bounds=<lon_min>,<lat_min>,<lon_max>,<lat_max>
+
+            @param r: the S3Request instance
+
+            @returns: the GeoJSON (str), or None to export the individual
+                      features instead (above the clustering zoom level)
+        """
+
+        _vars = r.get_vars
+        try:
+            zoom = int(_vars["zoom"])
+        except (KeyError, ValueError, TypeError):
+            return None
+        bounds = _vars.get("bounds", None)
+        if bounds is not None:
+            try:
+                bounds = [float(v) for v in bounds.split(",")]
+            except ValueError:
+                bounds = None
+            else:
+                if len(bounds) != 4:
+                    bounds = None
+        return current.gis.get_clusters(r.resource,
+                                        zoom,
+                                        bounds=bounds,
+                                        layer_id=_vars.get("layer", None))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def spool(chunks, chunk_size=65536):
+        """
+            Write an incrementally generated output into a temporary file
+            and stream it to the client. The generator can not be returned
+            as response body itself, because the DB connection it needs is
+            released before the response body is sent.
+
+            @param chunks: iterable of output chunks (strings)
+            @param chunk_size: chunk size for the response stream
+        """
+
+        import tempfile
+        output = tempfile.TemporaryFile()
+        write = output.write
+        for chunk in chunks:
+            write(chunk)
+        output.seek(0)
+        return current.response.stream(output, chunk_size=chunk_size)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def put_tree(r, **attr):
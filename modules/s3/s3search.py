@@ -30,6 +30,9 @@
 """
 
 import re
+import threading
+import time
+from bisect import bisect_left, insort
 
 try:
     import json # try stdlib (Python 2.6)
@@ -44,8 +47,10 @@ from gluon.serializers import json as jsons
 from gluon.storage import Storage
 
 from s3crud import S3CRUD
+from s3fields import S3Represent
+from s3index import S3TextIndex
 from s3navigation import s3_search_tabs
-from s3utils import s3_debug, S3DateTime, s3_get_foreign_key
+from s3utils import s3_debug, S3DateTime, s3_get_foreign_key, s3_unicode
 from s3validators import *
 from s3widgets import S3OrganisationHierarchyWidget, s3_grouped_checkboxes_widget
 
@@ -60,6 +65,7 @@ __all__ = ["S3SearchWidget",
            "S3SearchOrgHierarchyWidget",
            "S3Search",
            "S3LocationSearch",
+           "S3LocationNameIndex",
            "S3OrganisationSearch",
            "S3PersonSearch",
            "S3HRSearch",
@@ -286,15 +292,34 @@ class S3SearchSimpleWidget(S3SearchWidget):
         if value and isinstance(value, str):
             values = value.split()
 
+            # Use the text index for the fields it covers, unless the
+            # user has given explicit wildcards
+            text_index = S3TextIndex(resource.table)
+            if "%" in value:
+                indexed = []
+            else:
+                indexed = [f for f in self.field if text_index.indexed([f])]
+            self.indexed = indexed
+
             final_query = None
 
             # Create a set of queries for each value
             for value in values:
                 field_queries = None
 
+                # Match against the indexed fields
+                if indexed:
+                    query = text_index.query(value, fields=indexed)
+                    if query is not None:
+                        table = resource.table
+                        matches = current.db(query)._select(table._id)
+                        field_queries = S3FieldSelector("id").belongs(matches)
+
                 # Create a set of queries that test the current
                 # value against each field
                 for field in self.field:
+                    if field in indexed:
+                        continue
                     s = S3FieldSelector(field).lower()
                     field_query = s.like("%%%s%%" % value.lower())
 
@@ -304,6 +329,9 @@ class S3SearchSimpleWidget(S3SearchWidget):
                     else:
                         field_queries = field_query
 
+                if field_queries is None:
+                    continue
+
                 # We want all values to be matched
                 if final_query:
                     final_query = field_queries & final_query
@@ -627,7 +655,18 @@ class S3SearchOptionsWidget(S3SearchWidget):
             if not represent or field_type[:9] != "reference":
                 represent = field.represent
 
-            if callable(represent):
+            if isinstance(represent, S3Represent):
+                # Look up all options at once
+                try:
+                    represent.bulk(opt_values, show_link=False)
+                    opt_list = [(opt_value, represent(opt_value, show_link=False))
+                                for opt_value in opt_values]
+                except TypeError:
+                    # Represent function without show_link
+                    represent.bulk(opt_values)
+                    opt_list = [(opt_value, represent(opt_value))
+                                for opt_value in opt_values]
+            elif callable(represent):
                 # Execute, if callable
                 if "show_link" in represent.func_code.co_varnames:
                     opt_list = [(opt_value, represent(opt_value, show_link=False)) for opt_value
@@ -824,10 +863,22 @@ class S3SearchLocationWidget(S3SearchWidget):
             Returns a sub-query for this search option
 
             @param resource: the resource to search in
-            @param value: the value returned from the widget: WKT format
-        """
-
-        if value:
+            @param value: the value returned from the widget: WKT format,
+                          or a location ID to find all records located
+                          within that location
+        """
+
+        if value and str(value).isdigit():
+            # Locations within the given location
+            location_id = int(value)
+            atable = current.s3db.gis_location_ancestor
+            query = (atable.ancestor_id == location_id)
+            descendants = current.db(query)._select(atable.location_id)
+            selector = S3FieldSelector("location_id")
+            return (selector == location_id) | \
+                   (selector.belongs(descendants))
+
+        elif value:
             # @ToDo:
             # if current.deployment_settings.get_gis_spatialdb():
             #     # Use PostGIS-optimised routine
@@ -1356,7 +1407,7 @@ class S3Search(S3CRUD):
         if items:
             if not s3.no_sspag:
                 # Pre-populate SSPag cache (avoids the 1st Ajax request)
-                totalrows = resource.count(distinct=True)
+                totalrows = resource.count(distinct=True, approximate=True)
                 if totalrows:
                     if s3.dataTable_iDisplayLength:
                         limit = 2 * s3.dataTable_iDisplayLength
@@ -1981,12 +2032,32 @@ class S3Search(S3CRUD):
         else:
             represent = field.represent
 
-        attributes = dict(orderby=field,
-                          limitby=resource.limitby(start=0, limit=11),
-                          distinct=True)
+        # Rank the matches of an indexed simple search
+        ranked = None
+        if not errors and get_fieldname == "id" and \
+           self.simple and request.vars.simple_form:
+            name, widget = self.simple[0]
+            indexed = getattr(widget, "indexed", None)
+            value = request.vars.get(name)
+            if indexed and value:
+                ranked = S3TextIndex(resource.table).search(value,
+                                                            fields=indexed,
+                                                            limit=MAX_SEARCH_RESULTS)
+
+        if ranked:
+            # Best matches first
+            resource.add_filter(S3FieldSelector("id").belongs(ranked))
+            rows = resource.select(field, distinct=True)
+            rank = dict((record_id, i) for i, record_id in enumerate(ranked))
+            rows = sorted(rows, key=lambda row: rank.get(row[get_fieldname]))
+            rows = rows[:11]
+        else:
+            attributes = dict(orderby=field,
+                              limitby=resource.limitby(start=0, limit=11),
+                              distinct=True)
 
-        # Get the rows
-        rows = resource.select(field, **attributes)
+            # Get the rows
+            rows = resource.select(field, **attributes)
 
         if not errors:
             output = [{ "id"   : row[get_fieldname],
@@ -2136,14 +2207,30 @@ class S3LocationSearch(S3Search):
             if filter == "~":
                 if children:
                     # New LocationSelector
-                    children = current.gis.get_children(children, level=level)
-                    children = children.find(lambda row: \
-                                             row.name and value in str.lower(row.name))
-                    output = children.json()
+                    children = S3LocationNameIndex.search(value,
+                                                          level=level,
+                                                          parent=children,
+                                                          descendants=True,
+                                                          prefix=False)
+                    output = jsons([dict(id=i, name=n) for i, n in children])
                     response.headers["Content-Type"] = "application/json"
                     return output
 
-                if exclude_field and exclude_value:
+                if fieldname == "name" and not field2 and \
+                   not exclude_field and (level or parent):
+                    # Name prefix search within a level and/or parent
+                    matches = S3LocationNameIndex.search(value,
+                                                         level=level,
+                                                         parent=parent,
+                                                         limit=MAX_SEARCH_RESULTS + 1)
+                    ids = [i for i, n in matches]
+                    if ids:
+                        query = (table.id.belongs(ids))
+                    else:
+                        query = (table.id == None)
+                    level = parent = None
+
+                elif exclude_field and exclude_value:
                     # Old LocationSelector
                     # Filter out poor-quality data, such as from Ushahidi
                     query = (field.lower().like(value + "%")) & \
@@ -2237,6 +2324,270 @@ class S3LocationSearch(S3Search):
         response.headers["Content-Type"] = "application/json"
         return output
 
+# =============================================================================
+class S3LocationNameIndex(object):
+    """
+        Process-wide in-memory index of location names for the location
+        autocomplete: sorted arrays of (normalised name, id, name) for
+        the locations of a level under a parent (or ancestor), built on
+        demand, and an LRU of recent search results.
+
+        Updated incrementally by GIS.update_location_tree in this process,
+        changes in other processes become visible after TTL seconds.
+    """
+
+    TTL = 60                # max age of the index entries (seconds)
+    MAX_BUCKETS = 200       # max number of cached (level, parent) arrays
+    MAX_RESULTS = 1000      # max number of cached search results
+
+    lock = threading.Lock()
+    buckets = {}
+    results = {}
+    names = {}
+    version = 0
+    counter = 0
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def normalise(name):
+        """
+            Normalise a name for case-insensitive prefix matching
+
+            @param name: the name
+        """
+
+        return s3_unicode(name).lower().encode("utf-8")
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def search(cls,
+               value,
+               level=None,
+               parent=None,
+               descendants=False,
+               prefix=True,
+               limit=None):
+        """
+            Find locations by name
+
+            @param value: the search string
+            @param level: the level (or list of levels, "NULLNONE" for
+                          locations without level, None for all levels)
+            @param parent: the parent location ID
+            @param descendants: search all descendants of parent rather
+                                than only its direct children
+            @param prefix: match only names starting with the search
+                           string (otherwise names containing it)
+            @param limit: maximum number of results
+
+            @returns: list of tuples (id, name), ordered by name
+        """
+
+        value = cls.normalise(value)
+        if isinstance(level, (list, tuple)):
+            levels = tuple(level)
+        else:
+            levels = (level,)
+
+        key = (value, levels, parent, descendants, prefix, limit)
+        lock = cls.lock
+        lock.acquire()
+        try:
+            now = time.time()
+            entry = cls.results.get(key)
+            if entry is not None:
+                if entry["version"] == cls.version and \
+                   now - entry["created"] < cls.TTL:
+                    cls.counter += 1
+                    entry["used"] = cls.counter
+                    return entry["result"]
+                del cls.results[key]
+
+            matches = []
+            for level in levels:
+                entries = cls._bucket((level, parent, descendants), now)
+                if prefix:
+                    i = bisect_left(entries, (value,))
+                    for entry in entries[i:]:
+                        if not entry[0].startswith(value):
+                            break
+                        matches.append(entry)
+                        if limit and len(matches) >= limit:
+                            break
+                else:
+                    for entry in entries:
+                        if value in entry[0]:
+                            matches.append(entry)
+            if len(levels) > 1:
+                matches.sort()
+            if limit:
+                matches = matches[:limit]
+            result = [(entry[1], entry[2]) for entry in matches]
+
+            cls.counter += 1
+            cls._evict(cls.results, cls.MAX_RESULTS - 1)
+            cls.results[key] = {"version": cls.version,
+                                "created": now,
+                                "used": cls.counter,
+                                "result": result}
+        finally:
+            lock.release()
+        return result
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update(cls, location_id):
+        """
+            Update the index entries of a location, called after the
+            location has been updated in the database
+
+            @param location_id: the location record ID
+        """
+
+        if not cls.buckets or not location_id:
+            return
+        location_id = int(location_id)
+
+        table = current.s3db.gis_location
+        row = current.db(table.id == location_id).select(table.name,
+                                                         table.level,
+                                                         table.parent,
+                                                         table.path,
+                                                         table.deleted,
+                                                         limitby=(0, 1)
+                                                         ).first()
+        if row and row.path:
+            ancestors = [int(i) for i in row.path.split("/")[:-1] if i]
+        else:
+            ancestors = []
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            names = cls.names
+            old = names.get(location_id)
+            if row and row.name and not row.deleted:
+                new = (cls.normalise(row.name), location_id, row.name)
+            else:
+                new = None
+            for key, bucket in cls.buckets.items():
+                entries = bucket["entries"]
+                if old is not None:
+                    i = bisect_left(entries, (old, location_id))
+                    if i < len(entries) and entries[i][1] == location_id:
+                        del entries[i]
+                if new is None:
+                    continue
+                level, parent, descendants = key
+                if level == "NULLNONE":
+                    if row.level is not None:
+                        continue
+                elif level and row.level != level:
+                    continue
+                if parent:
+                    if descendants:
+                        if parent not in ancestors:
+                            continue
+                    elif row.parent != parent:
+                        continue
+                insort(entries, new)
+            if new is None:
+                names.pop(location_id, None)
+            else:
+                names[location_id] = new[0]
+            cls.version += 1
+        finally:
+            lock.release()
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """ Clear the index, e.g. after rebuilding the location tree """
+
+        lock = cls.lock
+        lock.acquire()
+        try:
+            cls.buckets.clear()
+            cls.results.clear()
+            cls.names.clear()
+            cls.version += 1
+        finally:
+            lock.release()
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _bucket(cls, key, now):
+        """
+            Get the sorted entries for a (level, parent, descendants)
+            key, (re-)build them if not present or expired; to be
+            called with the lock held
+
+            @param key: the key
+            @param now: the current time
+        """
+
+        buckets = cls.buckets
+        bucket = buckets.get(key)
+        if bucket is not None and now - bucket["created"] < cls.TTL:
+            cls.counter += 1
+            bucket["used"] = cls.counter
+            return bucket["entries"]
+
+        level, parent, descendants = key
+        table = current.s3db.gis_location
+        query = (table.deleted != True)
+        if level == "NULLNONE":
+            query &= (table.level == None)
+        elif level:
+            query &= (table.level == level)
+        if parent:
+            if descendants:
+                term = str(parent)
+                query &= ((table.path.like(term + "/%")) | \
+                          (table.path.like("%/" + term + "/%")))
+            else:
+                query &= (table.parent == parent)
+        rows = current.db(query).select(table.id, table.name)
+
+        normalise = cls.normalise
+        names = cls.names
+        entries = []
+        append = entries.append
+        for row in rows:
+            name = row.name
+            if not name:
+                continue
+            normalised = normalise(name)
+            names[row.id] = normalised
+            append((normalised, row.id, name))
+        entries.sort()
+
+        cls.counter += 1
+        cls._evict(buckets, cls.MAX_BUCKETS - 1)
+        buckets[key] = {"created": now,
+                        "used": cls.counter,
+                        "entries": entries}
+        # Building a bucket does not change any data, so cached results
+        # remain valid (they expire after TTL like the buckets)
+        return entries
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _evict(cache, size):
+        """
+            Remove the least recently used items from a cache
+
+            @param cache: the cache (dict)
+            @param size: the maximum number of items to keep
+        """
+
+        while cache and len(cache) > size:
+            lru = min(cache, key=lambda k: cache[k]["used"])
+            del cache[lru]
+        return
+
 # =============================================================================
 class S3OrganisationSearch(S3Search):
     """
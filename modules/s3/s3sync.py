@@ -29,12 +29,19 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3Sync", "S3SyncLog"]
+__all__ = ["S3Sync", "S3SyncLog", "S3SyncJournal"]
 
 import sys
 import urllib2
 import datetime
 import time
+import zlib
+from uuid import uuid4
+
+try:
+    from cStringIO import StringIO    # Faster, where available
+except:
+    from StringIO import StringIO
 
 try:
     from lxml import etree
@@ -70,6 +77,9 @@ else:
 class S3Sync(S3Method):
     """ S3 Synchronization Toolkit """
 
+    # Default number of records per transfer (page)
+    PAGE_SIZE = 500
+
     # -------------------------------------------------------------------------
     def __init__(self):
         """
@@ -182,7 +192,12 @@ class S3Sync(S3Method):
                 (rtable.deleted != True)
         tasks = current.db(query).select()
         for task in tasks:
-            now = datetime.datetime.utcnow()
+            # An interrupted transfer resumes as of its original start
+            now = task.started_on
+            if not now:
+                now = datetime.datetime.utcnow()
+                self.__checkpoint(task, started_on=now)
+            error = None
             if task.mode in (1, 3):
                 error = self.__pull(repository, task)
             if error:
@@ -196,50 +211,66 @@ class S3Sync(S3Method):
                                     (task.resource_name, error))
                 continue
             _debug("S3Sync.synchronize: %s success" % task.resource_name)
-            task.update_record(last_sync=now)
+            self.__checkpoint(task,
+                              last_sync=now,
+                              started_on=None,
+                              pull_cursor=None,
+                              push_cursor=None)
 
         # Success
         return current.xml.json_message()
 
     # -------------------------------------------------------------------------
-    def __pull(self, repository, task):
+    def __checkpoint(self, task, **data):
         """
-            Outgoing pull
+            Commit the progress of a task, so that an interrupted
+            transfer can be resumed from here
 
-            @param repository: the repository (sync_repository row)
             @param task: the task (sync_task row)
+            @param data: the progress fields to update
         """
 
-        ignore_errors = True
-        manager = current.manager
-        xml = current.xml
+        # All progress fields reset on update unless given
+        for fieldname in ("last_sync",
+                          "started_on",
+                          "pull_cursor",
+                          "pull_until",
+                          "push_cursor",
+                          "push_until",
+                          "last_seq",
+                          "remote_seq"):
+            if fieldname not in data:
+                data[fieldname] = task[fieldname]
 
-        resource_name = task.resource_name
-        prefix, name = resource_name.split("_", 1)
+        db = current.db
+        table = current.s3db.sync_task
+        db(table.id == task.id).update(**data)
+        task.update(data)
+        db.commit()
+        return
 
-        _debug("S3Sync.__pull(%s, %s)" % (repository.url, resource_name))
+    # -------------------------------------------------------------------------
+    def __open(self, repository, url, data=None, headers=None):
+        """
+            Send a request to a repository
+
+            @param repository: the repository (sync_repository row)
+            @param url: the URL
+            @param data: the request body (for POST)
+            @param headers: dict of additional request headers
+
+            @returns: the response (file-like object)
+
+            @raises urllib2.HTTPError: if the peer returns an error
+        """
 
-        # Construct the URL
         config = self.__get_config()
         proxy = repository.proxy or config.proxy or None
-        url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
-              (repository.url, resource_name, config.uuid)
 
         username = repository.username
         password = repository.password
-        last_sync = task.last_sync
-
-        # Get the target resource for this task
-        resource = manager.define_resource(prefix, name)
 
-        # Add msince and deleted to the URL
-        if last_sync and task.update_policy not in ("THIS", "OTHER"):
-            url += "&msince=%s" % xml.encode_iso_datetime(last_sync)
-        url += "&include_deleted=True"
-
-        _debug("...pull from URL %s" % url)
-
-        response = None
+        # Find the protocol
         url_split = url.split("://", 1)
         if len(url_split) == 2:
             protocol, path = url_split
@@ -247,8 +278,11 @@ class S3Sync(S3Method):
             protocol, path = "http", None
 
         # Prepare the request
-        import urllib2
-        req = urllib2.Request(url=url)
+        req = urllib2.Request(url=url, data=data)
+        req.add_header("Accept-Encoding", "gzip")
+        if headers:
+            for header in headers:
+                req.add_header(header, headers[header])
         handlers = []
 
         # Proxy handling
@@ -278,124 +312,299 @@ class S3Sync(S3Method):
             opener = urllib2.build_opener(*handlers)
             urllib2.install_opener(opener)
 
-        remote = False
-        output = None
-        response = None
+        return urllib2.urlopen(req)
 
-        # Execute the request
-        try:
-            f = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            result = self.log.ERROR
-            remote = True # Peer error
-            code = e.code
-            message = e.read()
-            try:
-                # Sahana-Eden would send a JSON message,
-                # try to extract the actual error message:
-                message_json = json.loads(message)
-                message = message_json.get("message", message)
-            except:
-                pass
-            # Prefix as peer error and strip XML markup from the message
-            # @todo: better method to do this?
-            message = "<message>%s</message>" % message
-            try:
-                markup = etree.XML(message)
-                message = markup.xpath(".//text()")
-                if message:
-                    message = " ".join(message)
-                else:
-                    message = ""
-            except etree.XMLSyntaxError:
-                pass
-            output = xml.json_message(False, code, message, tree=None)
-        except:
-            result = self.log.FATAL
-            code = 400
-            message = sys.exc_info()[1]
-            output = xml.json_message(False, code, message)
-        else:
-            result = self.log.SUCCESS
-            response = f
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def compress(chunks):
+        """
+            Gzip-compress an output
+
+            @param chunks: iterable of output chunks (strings)
+
+            @returns: generator of compressed chunks
+        """
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decompress(data):
+        """
+            Decompress gzip-compressed data
+
+            @param data: the compressed data (string)
+
+            @raises zlib.error: for invalid data
+        """
+
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    # -------------------------------------------------------------------------
+    def __pull(self, repository, task):
+        """
+            Outgoing pull, page by page: each page is committed together
+            with the cursor of the next page, so that an interrupted pull
+            resumes after the last imported page
+
+            @param repository: the repository (sync_repository row)
+            @param task: the task (sync_task row)
+        """
+
+        ignore_errors = True
+        manager = current.manager
+        xml = current.xml
+        db = current.db
+
+        resource_name = task.resource_name
+        prefix, name = resource_name.split("_", 1)
+
+        _debug("S3Sync.__pull(%s, %s)" % (repository.url, resource_name))
+
+        # Construct the URL
+        config = self.__get_config()
+        url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
+              (repository.url, resource_name, config.uuid)
+
+        last_sync = task.last_sync
+
+        # Get the target resource for this task
+        resource = manager.define_resource(prefix, name)
+
+        # Add msince and deleted to the URL
+        if last_sync and task.update_policy not in ("THIS", "OTHER"):
+            url += "&msince=%s" % xml.encode_iso_datetime(last_sync)
+        url += "&include_deleted=True"
+        page_size = repository.page_size or self.PAGE_SIZE
+        url += "&limit=%s" % page_size
+
+        # Request only the changes journaled since the last pull
+        if task.remote_seq is not None:
+            url += "&seq=%s" % task.remote_seq
 
         # Get import strategy and update policy
         strategy = task.strategy
         update_policy = task.update_policy
         conflict_policy = task.conflict_policy
 
-        # Try to import the response
-        count = 0
-        if response:
-            success = True
-            message = ""
-            try:
-                import_xml = resource.import_xml
-                onconflict = lambda item: \
-                             self.__resolve_conflict(item,
-                                                     repository,
-                                                     resource)
-                success = import_xml(response,
-                                     ignore_errors=ignore_errors,
-                                     strategy=strategy,
-                                     update_policy=update_policy,
-                                     conflict_policy=conflict_policy,
-                                     last_sync=last_sync,
-                                     onconflict=onconflict)
-                count = resource.import_count
-            except IOError, e:
-                result = self.log.FATAL
-                message = "%s" % e
-                output = xml.json_message(False, 400, message)
+        onconflict = lambda item: \
+                     self.__resolve_conflict(item,
+                                             repository,
+                                             resource)
+
+        cursor = task.pull_cursor
+        until = task.pull_until
+        start = None
+        page = 0
+        while True:
+
+            page += 1
+            page_url = url
+            if until is not None:
+                # Same journal range for all pages
+                page_url = "%s&until=%s" % (page_url, until)
+            if cursor:
+                page_url = "%s&after=%s" % (page_url, cursor)
+            elif start:
+                page_url = "%s&start=%s" % (page_url, start)
+
+            _debug("...pull from URL %s" % page_url)
+
+            remote = False
+            output = None
+            tree = None
+            size = None
+            throughput = None
 
-            if resource.error_tree is not None:
-                # Validation error (log in any case)
-                result = self.log.WARNING
-                message = "%s" % resource.error
-                for element in resource.error_tree.findall("resource"):
-                    for field in element.findall("data[@error]"):
-                        error_msg = field.get("error", None)
-                        if error_msg:
-                            msg = "(UID: %s) %s.%s=%s: %s" % \
-                                   (element.get("uuid", None),
-                                    element.get("name", None),
-                                    field.get("field", None),
-                                    field.get("value", field.text),
-                                    field.get("error", None))
-                            message = "%s, %s" % (message, msg)
-
-            if not success:
+            # Execute the request
+            try:
+                start = time.time()
+                f = self.__open(repository, page_url)
+                data = f.read()
+                duration = time.time() - start
+                size = len(data)
+                info = f.info()
+                if info.get("Content-Encoding") == "gzip":
+                    data = self.decompress(data)
+                seq = info.get("X-Sync-Sequence")
+                if seq is not None:
+                    until = int(seq)
+            except urllib2.HTTPError, e:
+                result = self.log.ERROR
+                remote = True # Peer error
+                code = e.code
+                message = e.read()
+                try:
+                    # Sahana-Eden would send a JSON message,
+                    # try to extract the actual error message:
+                    message_json = json.loads(message)
+                    message = message_json.get("message", message)
+                except:
+                    pass
+                # Prefix as peer error and strip XML markup from the message
+                # @todo: better method to do this?
+                message = "<message>%s</message>" % message
+                try:
+                    markup = etree.XML(message)
+                    message = markup.xpath(".//text()")
+                    if message:
+                        message = " ".join(message)
+                    else:
+                        message = ""
+                except etree.XMLSyntaxError:
+                    pass
+                output = xml.json_message(False, code, message, tree=None)
+                if code == 400 and cursor:
+                    # Peer rejected the cursor => start over next time
+                    self.__checkpoint(task, pull_cursor=None, pull_until=None)
+            except:
                 result = self.log.FATAL
-                if not message:
-                    error = manager.error
-                    message = "%s" % error
+                code = 400
+                message = sys.exc_info()[1]
+                output = xml.json_message(False, code, message)
+            else:
+                result = self.log.SUCCESS
+                if duration:
+                    throughput = size / duration
+                tree = xml.parse(StringIO(data))
+
+            # Try to import the response
+            if tree is not None:
+                success = True
+                message = ""
+                count = resource.import_count
+                try:
+                    success = resource.import_xml(tree,
+                                                  ignore_errors=ignore_errors,
+                                                  strategy=strategy,
+                                                  update_policy=update_policy,
+                                                  conflict_policy=conflict_policy,
+                                                  last_sync=last_sync,
+                                                  onconflict=onconflict)
+                    count = resource.import_count - count
+                except IOError, e:
+                    result = self.log.FATAL
+                    message = "%s" % e
+                    output = xml.json_message(False, 400, message)
+
+                if resource.error_tree is not None:
+                    # Validation error (log in any case)
+                    result = self.log.WARNING
+                    message = "%s" % resource.error
+                    for element in resource.error_tree.findall("resource"):
+                        for field in element.findall("data[@error]"):
+                            error_msg = field.get("error", None)
+                            if error_msg:
+                                msg = "(UID: %s) %s.%s=%s: %s" % \
+                                       (element.get("uuid", None),
+                                        element.get("name", None),
+                                        field.get("field", None),
+                                        field.get("value", field.text),
+                                        field.get("error", None))
+                                message = "%s, %s" % (message, msg)
+
+                if not success:
+                    result = self.log.FATAL
+                    if not message:
+                        error = manager.error
+                        message = "%s" % error
+                    output = xml.json_message(False, 400, message)
+
+                elif not message:
+                    message = "data imported successfully (%s records)" % count
+
+            elif result == self.log.SUCCESS:
+                result = self.log.ERROR
+                remote = True
+                message = "no valid data received from peer"
                 output = xml.json_message(False, 400, message)
 
-            elif not message:
-                message = "data imported successfully (%s records)" % count
+            # Commit the page together with the cursor of the next page
+            if output is None:
+                root = tree.getroot()
+                next_cursor = root.get(xml.ATTRIBUTE.next)
+                if next_cursor or cursor:
+                    start = None
+                else:
+                    # Peers which do not send cursors (e.g. older versions
+                    # ignoring "after") are paged by start/limit instead,
+                    # such pages are not checkpointed
+                    start = self.next_start(root, start, page_size)
+                cursor = next_cursor
+                if cursor:
+                    self.__checkpoint(task,
+                                      pull_cursor=cursor,
+                                      pull_until=until)
+                elif start is None:
+                    # Complete => continue from the end of the range
+                    self.__checkpoint(task,
+                                      pull_cursor=None,
+                                      pull_until=None,
+                                      remote_seq=until)
+            elif tree is not None:
+                db.rollback()
+
+            # log the operation
+            self.log.write(repository_id=repository.id,
+                           resource_name=task.resource_name,
+                           transmission=self.log.OUT,
+                           mode=self.log.PULL,
+                           action=None,
+                           remote=remote,
+                           result=result,
+                           message="page %s: %s" % (page, message),
+                           bytes=size,
+                           throughput=throughput)
 
-        elif result == self.log.SUCCESS:
-            result = self.log.ERROR
-            remote = True
-            message = "no data received from peer"
+            _debug("S3Sync.__pull import %s: %s" % (result, message))
 
-        # log the operation
-        self.log.write(repository_id=repository.id,
-                       resource_name=task.resource_name,
-                       transmission=self.log.OUT,
-                       mode=self.log.PULL,
-                       action=None,
-                       remote=remote,
-                       result=result,
-                       message=message)
+            if output is not None or not cursor and start is None:
+                break
 
-        _debug("S3Sync.__pull import %s: %s" % (result, message))
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def next_start(root, start, limit):
+        """
+            Get the start index of the next page for a peer which does not
+            send cursors, by comparing the total number of results with the
+            records requested so far
+
+            @param root: the root element of the received page
+            @param start: the start index of the received page
+            @param limit: the page size
+
+            @returns: the start index of the next page, or None if the page
+                      was the last one (or the peer does not page at all)
+        """
+
+        ATTRIBUTE = current.xml.ATTRIBUTE
+
+        if root.get(ATTRIBUTE.limit) is None:
+            # Peer has ignored the limit => all records received
+            return None
+        try:
+            results = int(root.get(ATTRIBUTE.results))
+        except (TypeError, ValueError):
+            return None
+        start = (start or 0) + limit
+        if start < results:
+            return start
+        else:
+            return None
+
     # -------------------------------------------------------------------------
     def __push(self, repository, task):
         """
-            Outgoing push
+            Outgoing push, page by page: the cursor of the next page is
+            committed after each page has been accepted by the peer, so
+            that an interrupted push resumes after the last accepted page
 
            @param repository: a sync_repository row
            @param task: a sync_task row
@@ -411,13 +620,9 @@ class S3Sync(S3Method):
 
         # Construct the URL
         config = self.__get_config()
-        proxy = repository.proxy or config.proxy or None
         url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
               (repository.url, resource_name, config.uuid)
 
-        username = repository.username
-        password = repository.password
-
         strategy = task.strategy
         if strategy:
             url += "&strategy=%s" % ",".join(strategy)
@@ -435,94 +640,124 @@ class S3Sync(S3Method):
 
         _debug("...push to URL %s" % url)
 
-        # Export the resource as S3XML
-        prefix, name = task.resource_name.split("_", 1)
-        resource = manager.define_resource(prefix, name,
-                                           include_deleted=True)
-        data = resource.export_xml(msince=last_sync)
-        count = resource.count()
-
-        remote = False
+        page_size = repository.page_size or self.PAGE_SIZE
+
+        # Compress only once the peer has advertised that it accepts
+        # gzip-compressed pushes (older peers can not decompress them)
+        compress = False
+
+        # Journal range to send
+        ids = None
+        until = None
+        if S3SyncJournal.active():
+            since = task.last_seq
+            until = task.push_until
+            if until is None:
+                until = S3SyncJournal.last(since=since or 0)
+            if since is not None:
+                resource = manager.define_resource(prefix, name,
+                                                   include_deleted=True)
+                ids = list(S3SyncJournal.changes(resource, since, until))
+
+        cursor = task.push_cursor
+        page = 0
         output = None
-
-        if data:
-            # Find the protocol
-            url_split = url.split("://", 1)
-            if len(url_split) == 2:
-                protocol, path = url_split
-            else:
-                protocol, path = "http", None
-
-            # Generate the request
-            import urllib2
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
-
-            handlers = []
-            if proxy:
-                # Proxy handling
-                _debug("using proxy=%s" % proxy)
-                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-                handlers.append(proxy_handler)
-            if username and password:
-                # Authentication handling:
-                # send auth credentials unsolicitedly
-                import base64
-                base64string = base64.encodestring('%s:%s' %
-                                                   (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
-                # Just in case the peer does not accept that
-                # => add a 401 handler:
-                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passwd_manager.add_password(realm=None,
-                                            uri=url,
-                                            user=username,
-                                            passwd=password)
-                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-                handlers.append(auth_handler)
-            # Install all handlers
-            if handlers:
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-
-            # Execute the request
-            try:
-                f = urllib2.urlopen(req)
-            except urllib2.HTTPError, e:
-                result = self.log.FATAL
-                remote = True # Peer error
-                code = e.code
-                message = e.read()
+        while ids is None or ids:
+
+            # Export the next page as S3XML
+            resource = manager.define_resource(prefix, name,
+                                               include_deleted=True)
+            if ids is not None:
+                resource.add_filter(resource.table._id.belongs(ids))
+            tree = resource.export_xml(limit=page_size,
+                                       msince=last_sync,
+                                       after=cursor,
+                                       as_tree=True)
+            cursor = resource.get_cursor()
+
+            if tree is not None and len(tree.getroot()):
+                page += 1
+                count = len(resource)
+                headers = {"Content-Type": "text/xml"}
+                data = xml.tostring(tree)
+                if compress:
+                    headers["Content-Encoding"] = "gzip"
+                    data = "".join(self.compress([data]))
+                size = len(data)
+                throughput = None
+                remote = False
+
+                # Execute the request
                 try:
-                    # Sahana-Eden would send a JSON message,
-                    # try to extract the actual error message:
-                    message_json = json.loads(message)
-                    message = message_json.get("message", message)
+                    start = time.time()
+                    f = self.__open(repository, url,
+                                    data=data,
+                                    headers=headers)
+                    f.read()
+                    duration = time.time() - start
+                    accept_encoding = f.info().get("Accept-Encoding") or ""
+                    if "gzip" in accept_encoding:
+                        compress = True
+                except urllib2.HTTPError, e:
+                    result = self.log.FATAL
+                    remote = True # Peer error
+                    code = e.code
+                    message = e.read()
+                    try:
+                        # Sahana-Eden would send a JSON message,
+                        # try to extract the actual error message:
+                        message_json = json.loads(message)
+                        message = message_json.get("message", message)
+                    except:
+                        pass
+                    output = xml.json_message(False, code, message)
                 except:
-                    pass
-                output = xml.json_message(False, code, message)
-            except:
-                result = self.log.FATAL
-                code = 400
-                message = sys.exc_info()[1]
-                output = xml.json_message(False, code, message)
-            else:
-                result = self.log.SUCCESS
-                message = "data sent successfully (%s records)" % count
-        else:
+                    result = self.log.FATAL
+                    code = 400
+                    message = sys.exc_info()[1]
+                    output = xml.json_message(False, code, message)
+                else:
+                    result = self.log.SUCCESS
+                    message = "data sent successfully (%s records)" % count
+                    if duration:
+                        throughput = size / duration
+
+                # log the operation
+                self.log.write(repository_id=repository.id,
+                               resource_name=task.resource_name,
+                               transmission=self.log.OUT,
+                               mode=self.log.PUSH,
+                               action=None,
+                               remote=remote,
+                               result=result,
+                               message="page %s: %s" % (page, message),
+                               bytes=size,
+                               throughput=throughput)
+                if output is not None:
+                    break
+
+            # The peer has accepted the page
+            if not cursor:
+                break
+            self.__checkpoint(task, push_cursor=cursor, push_until=until)
+
+        if output is None:
+            # Complete => continue from the end of the range
+            self.__checkpoint(task,
+                              push_cursor=None,
+                              push_until=None,
+                              last_seq=until)
+
+        if not page:
             # No data to send
-            result = self.log.WARNING
-            message = "No data to sent"
-
-        # log the operation
-        self.log.write(repository_id=repository.id,
-                       resource_name=task.resource_name,
-                       transmission=self.log.OUT,
-                       mode=self.log.PUSH,
-                       action=None,
-                       remote=remote,
-                       result=result,
-                       message=message)
+            self.log.write(repository_id=repository.id,
+                           resource_name=task.resource_name,
+                           transmission=self.log.OUT,
+                           mode=self.log.PUSH,
+                           action=None,
+                           remote=False,
+                           result=self.log.WARNING,
+                           message="No data to send")
 
         return output
 
@@ -730,25 +965,72 @@ class S3Sync(S3Method):
                 msince = datetime.datetime(y, m, d, hh, mm, ss)
             except ValueError:
                 msince = None
-
-        # Export the resource
-        resource = r.resource
-        output = resource.export_xml(start=start,
-                                     limit=limit,
-                                     msince=msince)
-        count = len(resource)
+        after = _vars.get("after", None)
 
         # Set content type header
         headers = current.response.headers
         headers["Content-Type"] = "text/xml"
 
+        resource = r.resource
+
+        # Export only the changes journaled within the requested range
+        if S3SyncJournal.active():
+            since = _vars.get("seq", None)
+            if since is not None:
+                try:
+                    since = int(since)
+                except ValueError:
+                    since = None
+            until = _vars.get("until", None)
+            if until is not None:
+                try:
+                    until = int(until)
+                except ValueError:
+                    until = None
+            if until is None:
+                until = S3SyncJournal.last(since=since or 0)
+            if since is not None:
+                ids = S3SyncJournal.changes(resource, since, until)
+                table = resource.table
+                if ids:
+                    resource.add_filter(table._id.belongs(list(ids)))
+                else:
+                    resource.add_filter(table._id == None)
+            headers["X-Sync-Sequence"] = str(until)
+
+        # Export the resource
+        try:
+            output = resource.export_stream(start=start,
+                                            limit=limit,
+                                            msince=msince,
+                                            after=after)
+        except SyntaxError:
+            e = sys.exc_info()[1]
+            r.error(400, e)
+
+        # Compress the output if the peer accepts it
+        accept_encoding = r.env.get("http_accept_encoding", None) or ""
+        if "gzip" in accept_encoding:
+            headers["Content-Encoding"] = "gzip"
+            output = self.compress(output)
+
+        # Write the output (this performs the actual export)
+        size = [0]
+        def measure(chunks):
+            for chunk in chunks:
+                size[0] += len(chunk)
+                yield chunk
+        output = r.spool(measure(output))
+        count = len(resource)
+
         # Log the operation
         self.log.write(repository_id=repository.id,
                        resource_name=r.resource.tablename,
                        transmission=self.log.IN,
                        mode=self.log.PULL,
                        result=self.log.SUCCESS,
-                       message="data sent to peer (%s records)" % count)
+                       message="data sent to peer (%s records)" % count,
+                       bytes=size[0])
 
         return output
 
@@ -830,8 +1112,22 @@ class S3Sync(S3Method):
         # Other parameters
         ignore_errors = True
 
+        # Advertise that compressed pushes are accepted
+        current.response.headers["Accept-Encoding"] = "gzip"
+
         # Get the source
-        source = r.read_body()
+        size = None
+        if r.env.get("http_content_encoding", None) == "gzip":
+            body = r.body
+            body.seek(0)
+            data = body.read()
+            size = len(data)
+            try:
+                source = StringIO(self.decompress(data))
+            except zlib.error:
+                r.error(400, "Invalid compressed data")
+        else:
+            source = r.read_body()
 
         # Import resource
         resource = r.resource
@@ -878,7 +1174,8 @@ class S3Sync(S3Method):
                        transmission=self.log.IN,
                        mode=self.log.PUSH,
                        result=result,
-                       message=message)
+                       message=message,
+                       bytes=size)
 
         return output
 
@@ -1021,7 +1318,9 @@ class S3SyncLog(S3Method):
               action=None,
               result=None,
               remote=False,
-              message=None):
+              message=None,
+              bytes=None,
+              throughput=None):
         """
             Writes a new entry to the log
 
@@ -1034,6 +1333,8 @@ class S3SyncLog(S3Method):
                            (SUCCESS, WARNING, ERROR or FATAL)
             @param remote: boolean, True if this is a remote error
             @param message: clear text message
+            @param bytes: number of bytes transferred
+            @param throughput: transfer rate (bytes/second)
         """
 
         if result not in (self.SUCCESS,
@@ -1060,7 +1361,9 @@ class S3SyncLog(S3Method):
                         action=action,
                         result=result,
                         remote=remote,
-                        message=message)
+                        message=message,
+                        bytes=bytes,
+                        throughput=throughput)
 
         table = current.s3db[self.TABLENAME]
 
@@ -1078,4 +1381,333 @@ class S3SyncLog(S3Method):
         else:
             return None
 
+# =============================================================================
+class S3SyncJournal(object):
+    """
+        Append-only journal of record changes for incremental
+        synchronization.
+
+        Every insert, update and delete of a record through the DAL
+        appends an entry to the journal, with the entry ID as sequence
+        number. Sync tasks keep the sequence number up to which they
+        have synchronized, and only export the records journaled after
+        it - which costs work proportional to the changes rather than
+        to the table size.
+
+        Activated with the deployment setting sync.journal.
+    """
+
+    TABLENAME = "s3_sync_journal"
+
+    # Seconds by which each range of the journal is re-read before its
+    # start: entries of transactions which were still pending when the
+    # previous range was read have lower sequence numbers than its end,
+    # but have been written at most this long before it
+    OVERLAP = 300
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def active():
+        """ Whether the journal is active """
+
+        return current.deployment_settings.get_sync_journal()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def define_table(cls):
+        """ Define the journal table """
+
+        db = current.db
+        if cls.TABLENAME not in db:
+            table = db.define_table(cls.TABLENAME,
+                                    Field("timestmp", "datetime"),
+                                    Field("tablename", length=128),
+                                    Field("record_id", "integer"),
+                                    Field("uuid", length=128),
+                                    Field("operation", length=16),
+                                    # Foreign keys of deleted records
+                                    Field("fkeys", "text"))
+        else:
+            table = db[cls.TABLENAME]
+        return table
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def attach(cls, table):
+        """
+            Journal all changes of a table at the DAL level, so that
+            changes by plain DAL updates (e.g. in onaccept callbacks)
+            are synchronized as well (called by S3Model.define_table)
+
+            @param table: the table
+        """
+
+        if "uuid" not in table.fields or \
+           not hasattr(table, "_after_insert"):
+            # Not synchronizable, or DAL without commit callbacks
+            return
+
+        tablename = table._tablename
+        write = cls.write
+
+        def before_insert(fields):
+            # The DAL passes the insert fields to after_insert without
+            # defaults, and the default UUID is only generated by the
+            # field encoder => generate it here
+            if not fields.get("uuid"):
+                default = table.uuid.default
+                if callable(default):
+                    default = default()
+                fields["uuid"] = default or uuid4().urn
+
+        def after_insert(fields, record_id):
+            write(tablename, record_id, "create", uuid=fields.get("uuid"))
+
+        def before_update(dbset, fields):
+            if fields.get("deleted"):
+                operation = "delete"
+            else:
+                operation = "update"
+            cls.write_set(table, dbset, operation)
+
+        def before_delete(dbset):
+            cls.write_set(table, dbset, "delete")
+
+        # NB callbacks must not return True, which would abort the write
+        table._before_insert.append(before_insert)
+        table._after_insert.append(after_insert)
+        table._before_update.append(before_update)
+        table._before_delete.append(before_delete)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def write(cls, tablename, record_id, operation, uuid=None):
+        """
+            Journal a change
+
+            @param tablename: the table name
+            @param record_id: the record ID
+            @param operation: the operation ("create", "update"
+                              or "delete")
+            @param uuid: the record UUID (looked up if not given)
+        """
+
+        if not record_id or not cls.active():
+            return
+
+        if uuid is None:
+            table = current.s3db.table(tablename)
+            if table is not None and "uuid" in table.fields:
+                row = current.db(table._id == record_id).select(table.uuid,
+                                                                limitby=(0, 1)
+                                                                ).first()
+                if row:
+                    uuid = row.uuid
+
+        cls.define_table().insert(timestmp=datetime.datetime.utcnow(),
+                                  tablename=tablename,
+                                  record_id=record_id,
+                                  uuid=uuid,
+                                  operation=operation)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def write_set(cls, table, dbset, operation):
+        """
+            Journal a change of all records in a set, before the change;
+            deletions are journaled with the foreign keys of the records,
+            so that they can still be mapped to their master records
+
+            @param table: the table
+            @param dbset: the DAL Set of records to be changed
+            @param operation: the operation ("update" or "delete")
+        """
+
+        if not cls.active():
+            return
+
+        fields = [table._id, table.uuid]
+        if operation == "delete":
+            fkeys = [f for f in table if str(f.type)[:9] == "reference"]
+            fields.extend(fkeys)
+        else:
+            fkeys = []
+        rows = dbset.select(*fields)
+        if not rows:
+            return
+
+        tablename = table._tablename
+        pkey = table._id.name
+        now = datetime.datetime.utcnow()
+        entries = []
+        for row in rows:
+            entry = dict(timestmp=now,
+                         tablename=tablename,
+                         record_id=row[pkey],
+                         uuid=row.uuid,
+                         operation=operation)
+            if fkeys:
+                entry["fkeys"] = json.dumps(dict([(f.name, row[f.name])
+                                                  for f in fkeys]))
+            entries.append(entry)
+        cls.define_table().bulk_insert(entries)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def last(cls, since=0):
+        """
+            Get the current sequence number of the journal, i.e. the
+            number of the last entry
+
+            @param since: the last sequence number consumed before
+                          (the sequence never goes back behind it)
+        """
+
+        table = cls.define_table()
+        last = table.id.max()
+        row = current.db(table.id > since).select(last).first()
+        if row and row[last]:
+            return row[last]
+        return since
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def range(cls, since, until=None, overlap=None):
+        """
+            Get the query for a range of the journal, including the
+            entries written within the overlap before its start
+
+            @param since: the last sequence number consumed before
+            @param until: the last sequence number to consume, None
+                          for all
+            @param overlap: seconds to re-read before the start of the
+                            range, defaults to OVERLAP
+        """
+
+        table = cls.define_table()
+
+        query = (table.id > since)
+        if overlap is None:
+            overlap = cls.OVERLAP
+        if since and overlap:
+            # Re-read the entries written shortly before the start, in
+            # case their transactions were not committed when the range
+            # up to since was read (re-sending them is harmless)
+            row = current.db(table.id <= since).select(table.timestmp,
+                                                       orderby=~table.id,
+                                                       limitby=(0, 1)).first()
+            if row and row.timestmp:
+                start = row.timestmp - datetime.timedelta(seconds=overlap)
+                query |= (table.timestmp >= start)
+        if until is not None:
+            query &= (table.id <= until)
+        return query
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def changes(cls, resource, since, until=None, overlap=None):
+        """
+            Get the master records of a resource which have changed,
+            directly or in any of their components, within a range of
+            the journal
+
+            @param resource: the S3Resource
+            @param since: the last sequence number consumed before
+            @param until: the last sequence number to consume, None
+                          for all
+            @param overlap: seconds to re-read before the start of the
+                            range, see range()
+
+            @returns: set of master record IDs
+        """
+
+        db = current.db
+        table = cls.define_table()
+
+        query = cls.range(since, until=until, overlap=overlap)
+
+        master = resource.tablename
+        components = resource.components.values()
+        tablenames = set([master])
+        for component in components:
+            tablenames.add(component.tablename)
+            if component.linktable is not None:
+                tablenames.add(component.linktable._tablename)
+        query &= (table.tablename.belongs(list(tablenames)))
+
+        rows = db(query).select(table.tablename,
+                                table.record_id,
+                                table.fkeys)
+        changed = {}
+        deleted = {}
+        for row in rows:
+            tablename = row.tablename
+            if tablename not in changed:
+                changed[tablename] = set()
+            changed[tablename].add(row.record_id)
+            if row.fkeys:
+                if tablename not in deleted:
+                    deleted[tablename] = {}
+                deleted[tablename][row.record_id] = json.loads(row.fkeys)
+
+        def lookup(qtable, key, values, ids):
+            """ The values of qtable[key] in the records with ids """
+            if key == qtable._id.name:
+                values.update(ids)
+                return
+            # Deleted records may no longer exist (or have their foreign
+            # keys removed) => use the keys journaled with the deletion
+            fkeys = deleted.get(qtable._tablename, {})
+            for record_id in ids:
+                if record_id in fkeys:
+                    value = fkeys[record_id].get(key)
+                    if value is not None:
+                        values.add(value)
+            rows = db(qtable._id.belongs(list(ids))).select(qtable[key],
+                                                            distinct=True)
+            values.update([row[key] for row in rows if row[key] is not None])
+
+        # Component changes => master keys
+        mtable = resource.table
+        keys = {}
+        for component in components:
+            pkey = component.pkey
+            if pkey not in keys:
+                keys[pkey] = set()
+            values = keys[pkey]
+            ctable = component.table
+            linktable = component.linktable
+            if linktable is None:
+                ids = changed.get(ctable._tablename)
+                if ids:
+                    lookup(ctable, component.fkey, values, ids)
+                continue
+            ids = changed.get(linktable._tablename)
+            if ids:
+                lookup(linktable, component.lkey, values, ids)
+            ids = changed.get(ctable._tablename)
+            if ids:
+                rkeys = set()
+                lookup(ctable, component.fkey, rkeys, ids)
+                if rkeys:
+                    rows = db(linktable[component.rkey].belongs(list(rkeys))) \
+                            .select(linktable[component.lkey], distinct=True)
+                    values.update([row[component.lkey] for row in rows])
+
+        # Master keys => master record IDs
+        ids = changed.get(master, set())
+        pkey = mtable._id.name
+        for key, values in keys.items():
+            if not values:
+                continue
+            if key == pkey:
+                ids.update(values)
+            else:
+                rows = db(mtable[key].belongs(list(values))).select(mtable._id)
+                ids.update([row[pkey] for row in rows])
+        return ids
+
 # End =========================================================================
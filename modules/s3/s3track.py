@@ -89,7 +89,15 @@ class S3Trackable(object):
                 else:
                     query = (table[UID] == uid)
             fields = [table[f] for f in fields]
-            rows = db(query).select(*fields)
+            if isinstance(record_id, (list, tuple)) and uid is None:
+                # Keep the order of the record IDs
+                pkey = table._id
+                rows = db(query).select(pkey, *fields)
+                order = dict((v, i) for i, v in enumerate(record_id))
+                rows = sorted(rows,
+                              key=lambda row: order.get(row[pkey.name], 0))
+            else:
+                rows = db(query).select(*fields)
 
         elif isinstance(trackable, Row):
             fields = self.__get_fields(trackable)
@@ -212,71 +220,302 @@ class S3Trackable(object):
             @param exclude: interlocks to break at (avoids circular check-ins)
 
             @returns: a location record, or a list of location records (if multiple)
-        """
-
-        db = current.db
-        s3db = current.s3db
 
-        ptable = s3db[PRESENCE]
-        ltable = s3db[LOCATION]
+            @note: the presences of all instances are resolved together,
+                   one query per level of interlocks rather than per
+                   instance, and the results are in the same order as
+                   self.records
+        """
 
         if timestmp is None:
             timestmp = datetime.utcnow()
 
-        locations = []
-        for r in self.records:
-            location = None
-            if TRACK_ID in r:
-                query = ((ptable.deleted == False) & \
-                         (ptable[TRACK_ID] == r[TRACK_ID]) & \
-                         (ptable.timestmp <= timestmp))
-                presence = db(query).select(orderby=~ptable.timestmp,
-                                            limitby=(0, 1)).first()
-                if presence:
-                    if presence.interlock:
-                        exclude = [r[TRACK_ID]] + exclude
-                        tablename, record = presence.interlock.split(",", 1)
-                        trackable = S3Trackable(tablename, record)
-                        record = trackable.records.first()
-                        if TRACK_ID not in record or \
-                           record[TRACK_ID] not in exclude:
-                            location = trackable.get_location(timestmp=timestmp,
-                                                              exclude=exclude,
-                                                              _fields=_fields)
-                    elif presence.location_id:
-                        query = (ltable.id == presence.location_id)
-                        if _filter is not None:
-                            query = query & _filter
-                        if _fields is None:
-                            location = db(query).select(ltable.ALL,
-                                                        limitby=(0, 1)).first()
-                        else:
-                            location = db(query).select(limitby=(0, 1),
-                                                        *_fields).first()
-
-            if not location:
-                if len(self.records) > 1:
-                    trackable = S3Trackable(r, rtable=self.rtable)
+        records = self.records
+        location_ids = [None] * len(records)
+
+        # Follow the presences (and interlocks) of all instances
+        # level by level: nodes = [(index, record, chain)]
+        exclude = set(exclude)
+        nodes = [(i, r, exclude) for i, r in enumerate(records)]
+        present = []
+        base = []
+        while nodes:
+            track_ids = set(r[TRACK_ID] for i, r, chain in nodes
+                                        if TRACK_ID in r and r[TRACK_ID])
+            presences = self.__get_presences(track_ids, timestmp)
+            interlocks = {}
+            for i, r, chain in nodes:
+                presence = None
+                if TRACK_ID in r:
+                    presence = presences.get(r[TRACK_ID], None)
+                if presence is None:
+                    base.append((i, r))
+                elif presence.interlock:
+                    key = tuple(presence.interlock.split(",", 1))
+                    chain = chain | set([r[TRACK_ID]])
+                    if key in interlocks:
+                        interlocks[key].append((i, r, chain))
+                    else:
+                        interlocks[key] = [(i, r, chain)]
+                elif presence.location_id:
+                    location_ids[i] = presence.location_id
+                    present.append((i, r))
                 else:
-                    trackable = self
-                location = trackable.get_base_location(_fields=_fields)
-
+                    base.append((i, r))
+
+            nodes = []
+            if not interlocks:
+                break
+            instances = self.__get_instances(interlocks.keys())
+            for key, items in interlocks.items():
+                instance = instances.get(key, None)
+                for i, r, chain in items:
+                    if instance is None or \
+                       TRACK_ID in instance and instance[TRACK_ID] in chain:
+                        # Broken or circular interlock
+                        base.append((i, r))
+                    else:
+                        nodes.append((i, instance, chain))
+
+        # Fall back to the base locations
+        base_ids = self.__get_base_location_ids([r for i, r in base])
+        for (i, r), location_id in zip(base, base_ids):
+            location_ids[i] = location_id
+        locations = self.__get_locations(location_ids,
+                                         _fields=_fields,
+                                         _filter=_filter)
+
+        # Presence locations which are not found (or filtered out)
+        # fall back to the base location of the same instance
+        missing = [(i, r) for i, r in present
+                          if location_ids[i] not in locations]
+        if missing:
+            base_ids = self.__get_base_location_ids([r for i, r in missing])
+            for (i, r), location_id in zip(missing, base_ids):
+                location_ids[i] = location_id
+            locations.update(self.__get_locations(base_ids,
+                                                  _fields=_fields,
+                                                  _filter=_filter))
+
+        output = []
+        for location_id in location_ids:
+            location = locations.get(location_id, None)
             if location:
-                locations.append(location)
+                output.append(location)
             else:
                 # Ensure we return an entry so that indexes match
-                locations.append(Row({"lat": None, "lon": None}))
+                output.append(Row({"lat": None, "lon": None}))
 
         if as_rows:
-            return Rows(records=locations, compact=False)
+            return Rows(records=output, compact=False)
 
-        if not locations:
+        if not output:
             return None
-        elif len(locations) == 1:
-            return locations[0]
+        elif len(output) == 1:
+            return output[0]
         else:
-            return locations
+            return output
+
+    # -------------------------------------------------------------------------
+    def __get_presences(self, track_ids, timestmp):
+        """
+            Get the latest presence (at the given time) of trackables,
+            in a single query: a window query on PostgreSQL, the latest
+            timestamp per track joined back to the presences on MySQL
+            and SQLite, otherwise a self-join excluding all earlier
+            entries
+
+            @param track_ids: the track IDs
+            @param timestmp: last datetime for presence
+
+            @returns: dict {track_id: presence Row}
+        """
+
+        if not track_ids:
+            return {}
+
+        db = current.db
+        ptable = current.s3db[PRESENCE]
 
+        query = (ptable.deleted == False) & \
+                (ptable[TRACK_ID].belongs(list(track_ids))) & \
+                (ptable.timestmp <= timestmp)
+        fields = [ptable.id,
+                  ptable[TRACK_ID],
+                  ptable.timestmp,
+                  ptable.location_id,
+                  ptable.interlock]
+
+        dbname = db._dbname
+        if dbname in ("postgres", "mysql", "sqlite"):
+            sql = {"table": ptable._tablename,
+                   "id": str(ptable.id),
+                   "track_id": str(ptable[TRACK_ID]),
+                   "timestmp": str(ptable.timestmp),
+                   "query": str(query)}
+            if dbname == "postgres":
+                # Number the presences per track, latest first
+                latest = "SELECT latest.id FROM " \
+                         "(SELECT %(id)s AS id, ROW_NUMBER() OVER " \
+                         "(PARTITION BY %(track_id)s " \
+                         "ORDER BY %(timestmp)s DESC, %(id)s DESC) AS rn " \
+                         "FROM %(table)s WHERE %(query)s) latest " \
+                         "WHERE latest.rn = 1;" % sql
+            else:
+                # Latest timestamp per track, joined back to the presences
+                # (highest ID if there are several with that timestamp)
+                latest = "SELECT MAX(%(id)s) FROM %(table)s JOIN " \
+                         "(SELECT %(track_id)s AS track_id, " \
+                         "MAX(%(timestmp)s) AS timestmp " \
+                         "FROM %(table)s WHERE %(query)s " \
+                         "GROUP BY %(track_id)s) latest " \
+                         "ON %(track_id)s = latest.track_id " \
+                         "AND %(timestmp)s = latest.timestmp " \
+                         "WHERE %(query)s GROUP BY %(track_id)s;" % sql
+            rows = db(ptable.id.belongs(latest)).select(*fields)
+        else:
+            later = ptable.with_alias("%s_later" % PRESENCE)
+            left = later.on((later[TRACK_ID] == ptable[TRACK_ID]) & \
+                            (later.deleted == False) & \
+                            (later.timestmp <= timestmp) & \
+                            ((later.timestmp > ptable.timestmp) | \
+                             ((later.timestmp == ptable.timestmp) & \
+                              (later.id > ptable.id))))
+            query &= (later.id == None)
+            rows = db(query).select(left=left, *fields)
+        return dict((row[TRACK_ID], row) for row in rows)
+
+    # -------------------------------------------------------------------------
+    def __get_instances(self, keys):
+        """
+            Load the instances which presences are interlocked with,
+            one query per table
+
+            @param keys: list of tuples (tablename, record ID) from
+                         the interlocks
+
+            @returns: dict {(tablename, record ID): Row}
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        ids = {}
+        for tablename, record_id in keys:
+            if tablename in ids:
+                ids[tablename].append(record_id)
+            else:
+                ids[tablename] = [record_id]
+
+        instances = {}
+        for tablename, record_ids in ids.items():
+            table = s3db.table(tablename)
+            if table is None:
+                continue
+            if self.__super_entity(table):
+                # Resolve the instance records one by one
+                for record_id in record_ids:
+                    try:
+                        trackable = S3Trackable(tablename, record_id)
+                    except SyntaxError:
+                        continue
+                    record = trackable.records.first()
+                    if record:
+                        instances[(tablename, record_id)] = record
+                continue
+            fields = self.__get_fields(table)
+            if not fields:
+                continue
+            pkey = table._id
+            fields = [pkey] + [table[f] for f in fields]
+            rows = db(pkey.belongs(record_ids)).select(*fields)
+            for row in rows:
+                instances[(tablename, str(row[pkey.name]))] = row
+        return instances
+
+    # -------------------------------------------------------------------------
+    def __get_base_location_ids(self, records):
+        """
+            Get the base location IDs of records, looking up the instance
+            records of track IDs table-wise
+
+            @param records: list of records
+
+            @returns: list of location IDs (None if not found), in the
+                      same order as records
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        location_ids = [None] * len(records)
+        track_ids = {}
+        for index, r in enumerate(records):
+            if LOCATION_ID in r:
+                location_ids[index] = r[LOCATION_ID]
+            elif TRACK_ID in r and r[TRACK_ID]:
+                track_id = r[TRACK_ID]
+                if track_id in track_ids:
+                    track_ids[track_id].append(index)
+                else:
+                    track_ids[track_id] = [index]
+        if not track_ids:
+            return location_ids
+
+        ttable = self.table
+        rows = db(ttable[TRACK_ID].belongs(track_ids.keys())).select(
+                                                        ttable[TRACK_ID],
+                                                        ttable.instance_type)
+        types = {}
+        for row in rows:
+            instance_type = row.instance_type
+            if instance_type in types:
+                types[instance_type].append(row[TRACK_ID])
+            else:
+                types[instance_type] = [row[TRACK_ID]]
+        for instance_type, ids in types.items():
+            table = s3db.table(instance_type)
+            if table is None or LOCATION_ID not in table.fields:
+                continue
+            rows = db(table[TRACK_ID].belongs(ids)).select(table[TRACK_ID],
+                                                           table[LOCATION_ID])
+            for row in rows:
+                for index in track_ids[row[TRACK_ID]]:
+                    location_ids[index] = row[LOCATION_ID]
+        return location_ids
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __get_locations(location_ids, _fields=None, _filter=None):
+        """
+            Load location records in bulk
+
+            @param location_ids: the location IDs
+            @param _fields: fields to retrieve from the location records
+                            (None for ALL)
+            @param _filter: filter for the locations
+
+            @returns: dict {location ID: Row}
+        """
+
+        ids = set(location_id for location_id in location_ids if location_id)
+        if not ids:
+            return {}
+
+        db = current.db
+        ltable = current.s3db[LOCATION]
+
+        query = (ltable.id.belongs(list(ids)))
+        if _filter is not None:
+            query = query & _filter
+        if not _fields:
+            rows = db(query).select(ltable.ALL)
+        else:
+            fields = list(_fields)
+            if str(ltable.id) not in [str(f) for f in fields]:
+                fields.append(ltable.id)
+            rows = db(query).select(*fields)
+        return dict((row.id, row) for row in rows)
 
     # -------------------------------------------------------------------------
     def set_location(self, location, timestmp=None):
@@ -480,38 +719,14 @@ class S3Trackable(object):
             @returns: the base location(s) of the current instance
         """
 
-        db = current.db
-        s3db = current.s3db
-
-        ltable = s3db[LOCATION]
-        rtable = self.rtable
+        location_ids = self.__get_base_location_ids(self.records)
+        rows = self.__get_locations(location_ids,
+                                    _fields=_fields,
+                                    _filter=_filter)
 
         locations = []
-        for r in self.records:
-            location = None
-            query = None
-            if LOCATION_ID in r:
-                query = (ltable.id == r[LOCATION_ID])
-                if rtable:
-                    query = query & (rtable[LOCATION_ID] == ltable.id)
-                    if TRACK_ID in r:
-                        query = query & (rtable[TRACK_ID] == r[TRACK_ID])
-            elif TRACK_ID in r:
-                q = (self.table[TRACK_ID] == r[TRACK_ID])
-                trackable = db(q).select(limitby=(0, 1)).first()
-                table = s3db[trackable.instance_type]
-                if LOCATION_ID in table.fields:
-                    query = ((table[TRACK_ID] == r[TRACK_ID]) &
-                             (table[LOCATION_ID] == ltable.id))
-            if query:
-                if _filter is not None:
-                    query = query & _filter
-                if not _fields:
-                    location = db(query).select(ltable.ALL,
-                                                limitby=(0, 1)).first()
-                else:
-                    location = db(query).select(limitby=(0, 1),
-                                                *_fields).first()
+        for location_id in location_ids:
+            location = rows.get(location_id, None)
             if location:
                 locations.append(location)
             else:
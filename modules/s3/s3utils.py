@@ -1984,10 +1984,13 @@ class S3BulkImporter(object):
                     pass
             try:
                 # @todo: add extra_data and file attachments
+                chunk_size = current.deployment_settings \
+                                    .get_base_import_chunk_size()
                 result = resource.import_xml(csv,
                                              format="csv",
                                              stylesheet=task[4],
-                                             extra_data=extra_data)
+                                             extra_data=extra_data,
+                                             chunk_size=chunk_size)
             except SyntaxError, e:
                 self.errorList.append("WARNING: import error - %s" % e)
                 return
@@ -2009,10 +2012,15 @@ class S3BulkImporter(object):
             end = datetime.datetime.now()
             duration = end - start
             csvName = task[3][task[3].rfind("/")+1:]
+            records = resource.import_count
             try:
                 # Python-2.7
-                duration = '{:.2f}'.format(duration.total_seconds()/60)
+                seconds = duration.total_seconds()
+                duration = '{:.2f}'.format(seconds/60)
                 msg = "%s import job completed in %s mins" % (csvName, duration)
+                if seconds:
+                    msg = "%s (%s records, %.1f records/s)" % \
+                          (msg, records, records / seconds)
             except AttributeError:
                 # older Python
                 msg = "%s import job completed in %s" % (csvName, duration)
@@ -2146,16 +2154,207 @@ class S3BulkImporter(object):
         self.tasks = []
 
     # -------------------------------------------------------------------------
-    def perform_tasks(self, path):
-        """ convenience method that will load and then execute the import jobs
-            that are listed in the descriptor file
+    def perform_tasks(self, path, processes=None):
+        """
+            Load and then execute the import jobs that are listed in the
+            descriptor file: jobs which do not depend on each other are
+            executed concurrently in a pool of worker processes, each
+            with its own database connection
+
+            @param path: the directory of the descriptor file
+            @param processes: number of worker processes (default: number
+                              of CPUs, 1 = execute all jobs in this process)
         """
+
         self.load_descriptor(path)
-        for task in self.tasks:
-            if task[0] == 1:
-                self.execute_import_task(task)
-            elif task[0] == 2:
-                self.execute_special_task(task)
+        stages = self.schedule(self.tasks)
+
+        if processes is None:
+            try:
+                import multiprocessing
+                processes = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                processes = 1
+        db = current.db
+        if db._dbname == "sqlite" or not hasattr(db._adapter, "reconnect"):
+            # SQLite serializes all writes anyway, and older DAL versions
+            # can not open a separate connection in the worker processes
+            processes = 1
+
+        for stage in stages:
+            if processes > 1 and len(stage) > 1:
+                # Special tasks are barriers, so these are all imports
+                self.execute_import_stage(stage, processes)
+                continue
+            for task in stage:
+                if task[0] == 1:
+                    self.execute_import_task(task)
+                elif task[0] == 2:
+                    self.execute_special_task(task)
+
+    # -------------------------------------------------------------------------
+    def execute_import_stage(self, tasks, processes):
+        """
+            Execute independent import tasks concurrently in a pool of
+            worker processes
+
+            @param tasks: the import tasks
+            @param processes: the maximum number of worker processes
+        """
+
+        import multiprocessing
+
+        # The workers are forked from this process, so commit first
+        # to let them see everything imported so far
+        current.db.commit()
+
+        pool = multiprocessing.Pool(min(processes, len(tasks)),
+                                    _bulk_import_connect)
+        try:
+            results = pool.map(_bulk_import_task, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        for errors, messages in results:
+            self.errorList.extend(errors)
+            self.resultList.extend(messages)
+
+    # -------------------------------------------------------------------------
+    RESOURCE = re.compile(r"""<resource\s+name=["']([a-z0-9]+_[a-z0-9_]+)["']""")
+    REFERENCE = re.compile(r"""<reference\s[^>]*?resource=["']([a-z0-9]+_[a-z0-9_]+)["']""")
+    LOOKUP = re.compile(r"""<reference\s+field=["']([a-z0-9_]+)["']\s*>""")
+    INCLUDE = re.compile(r"""<xsl:(?:include|import)\s+href=["']([^"']+)["']""")
+
+    def task_tables(self, task):
+        """
+            Find the tables an import task writes and references: the
+            target table of the task plus all resources generated by its
+            stylesheet (including imported/included stylesheets) are
+            written, the resources of <reference> elements - or for tuid
+            lookups without resource, the tables of the foreign keys -
+            are referenced
+
+            @param task: the import task
+            @returns: tuple (written, referenced) of sets of table names,
+                      None if unknown (special tasks)
+        """
+
+        if task[0] != 1:
+            return None
+
+        tablename = "%s_%s" % (task[1], task[2])
+        if tablename in self.alternateTables:
+            tablename = self.alternateTables[tablename] \
+                            .get("tablename", tablename)
+        written = set([tablename])
+        referenced = set()
+        lookups = set()
+
+        seen = set()
+        stylesheets = [task[4]]
+        while stylesheets:
+            stylesheet = os.path.normpath(stylesheets.pop())
+            if stylesheet in seen:
+                continue
+            seen.add(stylesheet)
+            try:
+                xsl = open(stylesheet, "r").read()
+            except IOError:
+                continue
+            written.update(self.RESOURCE.findall(xsl))
+            referenced.update(self.REFERENCE.findall(xsl))
+            lookups.update(self.LOOKUP.findall(xsl))
+            folder = os.path.dirname(stylesheet)
+            for href in self.INCLUDE.findall(xsl):
+                stylesheets.append(os.path.join(folder, href))
+
+        if lookups:
+            s3db = current.s3db
+            for tn in written:
+                table = s3db.table(tn)
+                if table is None:
+                    continue
+                for fn in lookups:
+                    if fn not in table.fields:
+                        continue
+                    ftype = str(table[fn].type)
+                    if ftype[:5] == "list:":
+                        ftype = ftype[5:]
+                    if ftype[:10] == "reference ":
+                        referenced.add(ftype[10:])
+        return written, referenced
+
+    # -------------------------------------------------------------------------
+    def schedule(self, tasks):
+        """
+            Build the dependency graph of the tasks, and group them into
+            stages of mutually independent tasks. A task depends on all
+            previous tasks which write any table it writes or references,
+            or reference any table it writes; special tasks depend on -
+            and are a dependency of - all other tasks.
+
+            @param tasks: the list of tasks, in the order of tasks.cfg
+            @returns: list of stages (lists of tasks) in execution order
+        """
+
+        stages = []
+        levels = []
+        tables = []
+        barrier = -1
+        for i, task in enumerate(tasks):
+            t = self.task_tables(task)
+            level = barrier + 1
+            for j in xrange(i):
+                other = tables[j]
+                if t is None or other is None or \
+                   other[0] & (t[0] | t[1]) or other[1] & t[0]:
+                    level = max(level, levels[j] + 1)
+            if t is None:
+                barrier = level
+            levels.append(level)
+            tables.append(t)
+            if level == len(stages):
+                stages.append([])
+            stages[level].append(task)
+
+        if self.tasks is tasks and len(stages) < len(tasks):
+            msg = "%s import tasks in %s stages" % (len(tasks), len(stages))
+            self.resultList.append(msg)
+        return stages
+
+# =============================================================================
+def _bulk_import_connect():
+    """
+        Initializer for the worker processes of S3BulkImporter: open
+        a separate database connection in the worker
+    """
+
+    adapter = current.db._adapter
+
+    # Keep a reference to the connection inherited from the parent
+    # process: closing it here would terminate the parent's session
+    _bulk_import_connect.inherited = (adapter.connection, adapter.cursor)
+
+    adapter.connection = None
+    adapter.cursor = None
+    # Never reuse the pooled connections of the parent process
+    adapter.pool_size = 0
+    adapter.reconnect()
+
+# -----------------------------------------------------------------------------
+def _bulk_import_task(task):
+    """
+        Execute an import task in a worker process of S3BulkImporter
+        (module-level to be usable in a worker pool)
+
+        @param task: the import task
+        @returns: tuple (errors, messages)
+    """
+
+    importer = S3BulkImporter()
+    importer.execute_import_task(task)
+    return ([s3_unicode(e) for e in importer.errorList],
+            [s3_unicode(m) for m in importer.resultList])
 
 # =============================================================================
 class S3DateTime(object):
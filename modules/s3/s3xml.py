@@ -148,6 +148,7 @@ class S3XML(S3Codec):
         error="error",
         start="start",
         limit="limit",
+        next="next",
         success="success",
         results="results",
         lat="lat",
@@ -316,6 +317,7 @@ class S3XML(S3Codec):
              start=None,
              limit=None,
              results=None,
+             cursor=None,
              maxbounds=False):
         """
             Builds a S3XML tree from a list of elements
@@ -327,6 +329,7 @@ class S3XML(S3Codec):
             @param start: the start record (in server-side pagination)
             @param limit: the page size (in server-side pagination)
             @param results: number of total available results
+            @param cursor: cursor for the next page (in keyset pagination)
             @param maxbounds: include maximum Geo-boundaries (lat/lon min/max)
         """
 
@@ -351,6 +354,8 @@ class S3XML(S3Codec):
             set(ATTRIBUTE.limit, str(limit))
         if results is not None:
             set(ATTRIBUTE.results, str(results))
+        if cursor is not None:
+            set(ATTRIBUTE.next, cursor)
         if elements is not None:
             root.extend(elements)
         if domain:
@@ -1761,6 +1766,80 @@ class S3XML(S3Codec):
         else:
             return json.dumps(root_dict)
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stream(cls, root, elements, as_json=False):
+        """
+            Serialize an S3XML tree incrementally, one <resource> element
+            at a time, so that the complete tree never has to be held in
+            memory
+
+            @param root: the (empty) root element, carrying the attributes
+            @param elements: iterable of <resource> elements
+            @param as_json: serialize as S3JSON (same schema as tree2json)
+
+            @returns: a generator of UTF-8 encoded chunks
+        """
+
+        if not as_json:
+            # Serialize the root element and cut it open
+            root.text = ""
+            rootstr = etree.tostring(root,
+                                     xml_declaration=True,
+                                     encoding="utf-8")
+            closing = "</%s>" % root.tag
+            yield "%s\n" % rootstr[:-len(closing)]
+            tostring = etree.tostring
+            for element in elements:
+                yield tostring(element, encoding="utf-8")
+            yield "%s\n" % closing
+            return
+
+        # S3JSON
+        TAG = cls.TAG
+        ATTRIBUTE = cls.ATTRIBUTE
+        PREFIX = cls.PREFIX
+        dumps = json.dumps
+        element2json = cls.__element2json
+
+        attributes = root.attrib
+        head = ", ".join(["%s: %s" % (dumps(PREFIX.attribute + a),
+                                      dumps(attributes[a]))
+                          for a in attributes])
+
+        # <resource> elements of the first table are streamed, all
+        # others are collected and appended at the end (JSON objects
+        # cannot have repeated keys)
+        key = None
+        delimiter = ", "
+        collected = {}
+        for element in elements:
+            if element.tag != TAG.resource:
+                continue
+            tag = "%s_%s" % (PREFIX.resource,
+                             element.get(ATTRIBUTE.name))
+            obj = element2json(element, native=True)
+            if key is None:
+                key = tag
+                if head:
+                    yield "{%s, %s: [" % (head, dumps(key))
+                else:
+                    yield "{%s: [" % dumps(key)
+                yield dumps(obj)
+            elif tag == key:
+                yield "%s%s" % (delimiter, dumps(obj))
+            elif tag in collected:
+                collected[tag].append(obj)
+            else:
+                collected[tag] = [obj]
+        if key is None:
+            yield "{%s}" % head
+            return
+        yield "]"
+        for tag in collected:
+            yield ", %s: %s" % (dumps(tag), dumps(collected[tag]))
+        yield "}"
+
     # -------------------------------------------------------------------------
     @staticmethod
     def collect_errors(job):
@@ -1822,14 +1901,51 @@ class S3XML(S3Codec):
             @todo: add a character encoding parameter to skip the guessing
         """
 
+        trees = cls.csv2trees(source,
+                              resourcename=resourcename,
+                              extra_data=extra_data,
+                              delimiter=delimiter,
+                              quotechar=quotechar)
+        return trees.next()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def csv2trees(cls, source,
+                  resourcename=None,
+                  extra_data=None,
+                  delimiter=",",
+                  quotechar='"',
+                  chunk_size=None):
+        """
+            Convert a table-form CSV source into a sequence of element
+            trees of at most chunk_size rows each (same format as csv2tree),
+            reading the source only as far as needed for the next tree
+
+            @param source: the source (file-like object)
+            @param resourcename: the resource name
+            @param extra_data: dict of extra cols to add to each row
+            @param delimiter: delimiter for values
+            @param quotechar: quotation character
+            @param chunk_size: the maximum number of rows per tree,
+                               None for all rows in one tree
+
+            @returns: a generator of ElementTrees (at least one, even
+                      if the source contains no rows)
+        """
+
         import csv
 
         # Increase field sixe to ne able to import WKTs
         csv.field_size_limit(2**20 * 100)  # 100 megs
 
-        root = etree.Element(cls.TAG.table)
-        if resourcename is not None:
-            root.set(cls.ATTRIBUTE.name, resourcename)
+        TABLE = cls.TAG.table
+        ROW = cls.TAG.row
+
+        def new_root():
+            root = etree.Element(TABLE)
+            if resourcename is not None:
+                root.set(cls.ATTRIBUTE.name, resourcename)
+            return root
 
         def add_col(row, key, value):
             col = etree.SubElement(row, cls.TAG.col)
@@ -1868,6 +1984,9 @@ class S3XML(S3Codec):
                     else:
                         e = encoding
                         break
+
+        root = new_root()
+        count = 0
         try:
             import StringIO
             if not isinstance(source, StringIO.StringIO):
@@ -1876,13 +1995,18 @@ class S3XML(S3Codec):
                                     delimiter=delimiter,
                                     quotechar=quotechar)
             for r in reader:
-                row = etree.SubElement(root, cls.TAG.row)
+                if chunk_size and count == chunk_size:
+                    yield etree.ElementTree(root)
+                    root = new_root()
+                    count = 0
+                row = etree.SubElement(root, ROW)
                 for k in r:
                     add_col(row, k, r[k])
                 if extra_data:
                     for key in extra_data:
                         if key not in r:
                             add_col(row, key, extra_data[key])
+                count += 1
         except csv.Error:
             e = sys.exc_info()[1]
             raise HTTP(400, body=cls.json_message(False, 400, e))
@@ -1890,6 +2014,6 @@ class S3XML(S3Codec):
         # Use this to debug the source tree if needed:
         #print >>sys.stderr, cls.tostring(root, pretty_print=True)
 
-        return  etree.ElementTree(root)
+        yield etree.ElementTree(root)
 
 # End =========================================================================
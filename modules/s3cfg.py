@@ -57,6 +57,7 @@ class S3Config(Storage):
         self.msg = Storage()
         self.options = Storage()
         self.save_search = Storage()
+        self.search = Storage()
         self.security = Storage()
         self.ui = Storage()
         self.cap = Storage()
@@ -69,6 +70,7 @@ class S3Config(Storage):
         self.project = Storage()
         self.req = Storage()
         self.supply = Storage()
+        self.sync = Storage()
 
     # -------------------------------------------------------------------------
     # Template
@@ -280,6 +282,12 @@ class S3Config(Storage):
         return self.base.get("public_url", "http://127.0.0.1:8000")
     def get_base_cdn(self):
         return self.base.get("cdn", False)
+    def get_base_import_chunk_size(self):
+        """
+            Number of rows per chunk for CSV imports by the bulk importer
+            (None = import the whole file at once)
+        """
+        return self.base.get("import_chunk_size", None)
     def get_base_session_memcache(self):
         """
             Should we store sessions in a Memcache service to allow sharing
@@ -513,6 +521,18 @@ class S3Config(Storage):
     def get_terms_of_service(self):
         return self.options.get("terms_of_service", False)
 
+    # -------------------------------------------------------------------------
+    # Search
+    def get_search_text_index(self):
+        """
+            Use a text index for simple searches, datatable filters and
+            autocompletes on tables which configure "text_index" fields:
+                - True = the best backend for the database
+                - "postgres" = PostgreSQL text search
+                - "table" = inverted token table (all databases)
+        """
+        return self.search.get("text_index", False)
+
     # -------------------------------------------------------------------------
     # UI Settings
     def get_ui_navigate_away_confirm(self):
@@ -569,6 +589,19 @@ class S3Config(Storage):
     def get_ui_social_buttons(self):
         """ Display social media Buttons in the footer? """
         return self.ui.get("social_buttons", False)
+    def get_ui_report_cache_size(self):
+        """
+            Maximum number of computed pivot table reports to keep in
+            the process-wide report cache (0 to disable the cache)
+        """
+        return self.ui.get("report_cache_size", 0)
+    def get_ui_approximate_counts(self):
+        """
+            Whether record counts for pagination may be approximate, i.e.
+            query planner estimates for large lists (PostgreSQL) or counts
+            cached for up to 5 minutes
+        """
+        return self.ui.get("approximate_counts", False)
 
     # =========================================================================
     # Messaging
@@ -948,6 +981,15 @@ class S3Config(Storage):
     def get_supply_catalog_default(self):
         return self.inv.get("catalog_default", "Other Items")
 
+    # -------------------------------------------------------------------------
+    # Synchronization
+    def get_sync_journal(self):
+        """
+            Journal all record changes, so that incremental synchronization
+            reads the changes from the journal instead of scanning the tables
+        """
+        return self.sync.get("journal", False)
+
     # -------------------------------------------------------------------------
     # Active modules list
     def has_module(self, module_name):
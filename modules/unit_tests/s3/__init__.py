@@ -1,8 +1,13 @@
 from unit_tests.s3.s3aaa import *
+from unit_tests.s3.s3fields import *
+from unit_tests.s3.s3gis import *
 from unit_tests.s3.s3import import *
 from unit_tests.s3.s3model import *
+from unit_tests.s3.s3report import *
 from unit_tests.s3.s3resource import *
 from unit_tests.s3.s3search import *
 from unit_tests.s3.s3rest import *
+from unit_tests.s3.s3sync import *
+from unit_tests.s3.s3track import *
 from unit_tests.s3.s3widgets import *
 from unit_tests.s3.s3xml import *
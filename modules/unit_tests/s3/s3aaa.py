@@ -1084,6 +1084,80 @@ class S3PermissionTests(unittest.TestCase):
             auth.s3_delete_role("TESTGROUP")
             current.db.rollback()
 
+    def testPrefetchOwners(self):
+
+        db = current.db
+        auth = current.auth
+        s3db = current.s3db
+
+        try:
+            auth.override = True
+            table = s3db.org_office
+            user_id = auth.s3_get_user_id("normaluser@example.com")
+            record1 = table.insert(name="Prefetch Test Office 1",
+                                   owned_by_user=user_id)
+            record2 = table.insert(name="Prefetch Test Office 2",
+                                   owned_by_user=None)
+            auth.override = False
+
+            p = auth.permission
+            records = p.prefetch(table, [record1, str(record2)])
+            self.assertTrue(record1 in records)
+            self.assertTrue(record2 in records)
+
+            # Changes in the DB are not seen while prefetched...
+            db(table.id == record1).update(owned_by_user=None)
+            self.assertEqual(p.get_owners(table, record1)[2], user_id)
+
+            # ...but after forgetting them
+            p.forget(table, record1)
+            self.assertEqual(p.get_owners(table, record1)[2], None)
+
+            # Ownership updates forget automatically
+            p.prefetch(table, [record2])
+            auth.s3_update_record_owner(table, record2, owned_by_user=user_id)
+            self.assertEqual(p.get_owners(table, record2)[2], user_id)
+
+        finally:
+            auth.permission.forget("org_office")
+            auth.override = False
+            db.rollback()
+
+    def testCompiledACLs(self):
+
+        auth = current.auth
+        acl = auth.permission
+
+        try:
+            role = auth.s3_create_role("Test Group", None,
+                                       dict(c="org", uacl=acl.READ, oacl=acl.ALL),
+                                       dict(c="org", f="office", uacl=acl.ALL, oacl=acl.ALL),
+                                       dict(t="org_office", uacl=acl.READ, oacl=acl.ALL),
+                                       uid="TESTGROUP")
+
+            compiled = acl.compiled_acls()
+            self.assertEqual(len(compiled.groups[role]), 3)
+            self.assertEqual(len(compiled.pages[(role, "org")]), 2)
+            rules = compiled.tables[(role, "org_office")]
+            self.assertEqual(len(rules), 1)
+            self.assertEqual((rules[0].uacl, rules[0].oacl), (acl.READ, acl.ALL))
+            self.assertTrue("org_office" in compiled.restricted)
+
+            # Compiled ACLs are re-used until the ACLs change
+            self.assertTrue(acl.compiled_acls() is compiled)
+            acl.update_acl(role, t="org_office", uacl=acl.ALL, oacl=acl.ALL)
+            compiled = acl.compiled_acls()
+            rules = compiled.tables[(role, "org_office")]
+            self.assertEqual((rules[0].uacl, rules[0].oacl), (acl.ALL, acl.ALL))
+
+            acl.delete_acl(role, t="org_office")
+            compiled = acl.compiled_acls()
+            self.assertFalse((role, "org_office") in compiled.tables)
+
+        finally:
+            auth.s3_delete_role("TESTGROUP")
+            current.db.rollback()
+
     # -------------------------------------------------------------------------
     # Helpers
     #
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# S3Fields Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3fields.py
+#
+import unittest
+from gluon import *
+
+# =============================================================================
+class S3RepresentTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        otable = current.s3db.org_organisation
+        self.org_ids = []
+        for name, acronym in (("RepresentTestOrg1", "RTO1"),
+                              ("RepresentTestOrg2", None)):
+            org_id = otable.insert(name=name, acronym=acronym)
+            self.org_ids.append(org_id)
+
+    # -------------------------------------------------------------------------
+    def testBulk(self):
+        """ Test bulk representation of foreign keys """
+
+        from s3.s3fields import S3Represent
+
+        calls = []
+        def represent(id, row=None):
+            calls.append(id)
+            if row:
+                return row.name
+            return "single"
+
+        represent = S3Represent("org_organisation", represent,
+                                fields=["name"])
+        org1, org2 = self.org_ids
+
+        represents = represent.bulk([org1, str(org2), None, org1])
+        self.assertEqual(len(represents), 2)
+        self.assertEqual(represents[org1], "RepresentTestOrg1")
+        self.assertEqual(represents[org2], "RepresentTestOrg2")
+        self.assertEqual(len(calls), 2)
+
+        # Served from the cache
+        self.assertEqual(represent(org1), "RepresentTestOrg1")
+        self.assertEqual(represent(str(org2)), "RepresentTestOrg2")
+        self.assertEqual(len(calls), 2)
+
+        # Not in the cache => single lookup
+        self.assertEqual(represent(None), "single")
+        self.assertEqual(len(calls), 3)
+
+    # -------------------------------------------------------------------------
+    def testSetup(self):
+        """ Test bulk lookup for the values of a column """
+
+        from s3.s3fields import S3Represent
+        from gluon.dal import Row
+
+        field = current.s3db.hrm_human_resource.organisation_id
+        represent = field.represent
+        self.assertTrue(isinstance(represent, S3Represent))
+
+        org1, org2 = self.org_ids
+        rows = [Row(hrm_human_resource=Row(organisation_id=org1)),
+                Row(hrm_human_resource=Row(organisation_id=org2)),
+                Row(hrm_human_resource=Row(organisation_id=None))]
+        S3Represent.setup(field, rows)
+
+        cache = represent._cache(represent.attr)
+        self.assertEqual(cache[org1], "RepresentTestOrg1 (RTO1)")
+        self.assertEqual(cache[org2], "RepresentTestOrg2")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3RepresentTests,
+    )
+
+# END ========================================================================
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+#
+# S3GIS Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3gis.py
+#
+import datetime
+import unittest
+from gluon import *
+
+# =============================================================================
+class S3GISTileTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testTileBounds(self):
+        """ Test the bounds of XYZ tiles """
+
+        from s3.s3gis import GIS
+
+        lon_min, lat_min, lon_max, lat_max = GIS.tile_bounds(0, 0, 0)
+        self.assertEqual(lon_min, -180.0)
+        self.assertEqual(lon_max, 180.0)
+        self.assertAlmostEqual(lat_max, 85.0511, 4)
+        self.assertAlmostEqual(lat_min, -85.0511, 4)
+
+        lon_min, lat_min, lon_max, lat_max = GIS.tile_bounds(1, 1, 0)
+        self.assertEqual(lon_min, 0.0)
+        self.assertEqual(lon_max, 180.0)
+        self.assertAlmostEqual(lat_min, 0.0, 6)
+
+    # -------------------------------------------------------------------------
+    def testSimplifyTolerance(self):
+        """ Test the choice of the simplification tolerance """
+
+        from s3.s3gis import GIS
+
+        tolerances = GIS.SIMPLIFY_TOLERANCES
+        self.assertEqual(GIS.get_simplify_tolerance({}), 0.001)
+        self.assertEqual(GIS.get_simplify_tolerance({"zoom": "2"}),
+                         tolerances[0])
+        self.assertEqual(GIS.get_simplify_tolerance({"zoom": "18"}),
+                         tolerances[-1])
+        self.assertEqual(GIS.get_simplify_tolerance({"bbox": "0,0,2,2"}),
+                         0.001)
+
+# =============================================================================
+class S3SimplifiedTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+        table = current.s3db.gis_location
+        self.polygon = table.insert(name="SimplifiedTestPolygon",
+                                    gis_feature_type=3,
+                                    wkt="POLYGON((0 0,1 0,1 1,0.5 1.0001,0 1,0 0))")
+        self.point = table.insert(name="SimplifiedTestPoint",
+                                  gis_feature_type=1,
+                                  lat=10.0,
+                                  lon=20.0)
+        self.empty = table.insert(name="SimplifiedTestEmpty",
+                                  gis_feature_type=3)
+
+    # -------------------------------------------------------------------------
+    def testGetSimplified(self):
+        """ Test the cache of simplified geometries """
+
+        from s3.s3gis import GIS
+
+        db = current.db
+        table = current.s3db.gis_location_simplified
+        ids = [self.polygon, self.point, self.empty]
+        query = (table.location_id.belongs(ids))
+        tiers = len(GIS.SIMPLIFY_TOLERANCES)
+
+        # Missing entries are simplified on the fly, but not cached
+        geometries = GIS.get_simplified(ids, tolerance=0.001)
+        self.assertTrue(geometries[self.polygon].startswith("POLYGON"))
+        self.assertTrue(geometries[self.point].startswith("POINT"))
+        self.assertFalse(self.empty in geometries)
+        self.assertEqual(db(query).count(), 0)
+
+        # Lines/Polygons are cached per tier, empty ones as such,
+        # Points are not cached
+        for location_id in ids:
+            GIS.update_simplified(location_id, refresh=False)
+        rows = db(query).select(table.location_id, table.tier, table.wkt)
+        self.assertEqual(len(rows), 2 * tiers)
+        self.assertEqual(set(row.tier for row in rows), set(xrange(tiers)))
+        self.assertFalse(self.point in [row.location_id for row in rows])
+
+        # Reads use the cache and never replace it
+        tier = GIS.SIMPLIFY_TOLERANCES.index(0.001)
+        db((table.location_id == self.polygon) &
+           (table.tier == tier)).update(wkt="CACHED")
+        geometries = GIS.get_simplified(ids, tolerance=0.001)
+        self.assertEqual(geometries[self.polygon], "CACHED")
+        self.assertEqual(db(query).count(), 2 * tiers)
+
+        # Explicit refresh replaces the cache entries
+        GIS.update_simplified(self.polygon)
+        geometries = GIS.get_simplified(ids, tolerance=0.001)
+        self.assertNotEqual(geometries[self.polygon], "CACHED")
+        self.assertEqual(db(query).count(), 2 * tiers)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class S3LocationTreeRebuildTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+        table = current.s3db.gis_location
+        self.L0 = table.insert(name="RebuildTestL0",
+                               level="L0",
+                               lat=10.0,
+                               lon=20.0)
+        # Polygon wrongly flagged as inheriting its Lat/Lon
+        self.L1 = table.insert(name="RebuildTestL1",
+                               level="L1",
+                               parent=self.L0,
+                               gis_feature_type=3,
+                               wkt="POLYGON((0 0,1 0,1 1,0 1,0 0))",
+                               inherited=True)
+        self.L2 = table.insert(name="RebuildTestL2",
+                               level="L2",
+                               parent=self.L1)
+        modified_on = datetime.datetime(2000, 1, 1)
+        ids = [self.L0, self.L1, self.L2]
+        current.db(table.id.belongs(ids)).update(modified_on=modified_on)
+        current.db.commit()
+        self.modified_on = modified_on
+
+    # -------------------------------------------------------------------------
+    def testRebuild(self):
+        """ Test the bulk rebuild of the location tree """
+
+        import json
+        import os
+
+        gis = current.gis
+        db = current.db
+        table = current.s3db.gis_location
+
+        # Progress of another run must not be resumed
+        folder = os.path.join(current.request.folder, "private")
+        stale = os.path.join(folder, "location_tree_rebuild-stale.json")
+        f = open(stale, "w")
+        try:
+            json.dump({"stage": "hierarchy", "last": 0}, f)
+        finally:
+            f.close()
+
+        try:
+            result = gis.rebuild_location_tree(processes=1)
+        finally:
+            os.remove(stale)
+        path = os.path.join(folder, "location_tree_rebuild-%s.json" % result.run)
+        self.assertFalse(os.path.exists(path))
+
+        fields = [table.id, table.lat, table.lon, table.inherited,
+                  table.modified_on]
+        rows = db(table.id.belongs([self.L1, self.L2])).select(*fields)
+        records = dict((row.id, row) for row in rows)
+
+        # Polygon keeps its own centroid
+        L1 = records[self.L1]
+        self.assertAlmostEqual(L1.lat, 0.5, 6)
+        self.assertAlmostEqual(L1.lon, 0.5, 6)
+        self.assertFalse(L1.inherited)
+
+        # Location without geometry inherits from its parent
+        L2 = records[self.L2]
+        self.assertEqual(L2.lat, L1.lat)
+        self.assertEqual(L2.lon, L1.lon)
+        self.assertTrue(L2.inherited)
+
+        # Bulk updates mark the records as modified
+        for row in rows:
+            self.assertTrue(row.modified_on > self.modified_on)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        db = current.db
+        table = current.s3db.gis_location
+        db(table.id.belongs([self.L2, self.L1, self.L0])).delete()
+        db.commit()
+        current.auth.override = False
+
+# =============================================================================
+class S3ClusterIndexTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testCells(self):
+        """ Test aggregation of points into grid cells """
+
+        from s3.s3gis import S3ClusterIndex
+
+        points = [(1, 10.0, 10.0),
+                  (2, 10.0000001, 10.0000001),
+                  (3, 20.0, 20.0),
+                  (4, None, None),
+                  ]
+        grid = {"levels": {S3ClusterIndex.MAX_ZOOM:
+                           S3ClusterIndex.build(points)}}
+
+        cells = S3ClusterIndex.cells(grid, S3ClusterIndex.MAX_ZOOM)
+        self.assertEqual(len(cells), 2)
+        self.assertEqual(sorted(c[0] for c in cells.values()), [1, 2])
+
+        # All points in one cell at zoom level 0
+        cells = S3ClusterIndex.cells(grid, 0).values()
+        self.assertEqual(len(cells), 1)
+        size, lon, lat, record_id = cells[0]
+        self.assertEqual(size, 3)
+        self.assertAlmostEqual(lon / size, 40.0 / 3, 5)
+
+    # -------------------------------------------------------------------------
+    def testCache(self):
+        """ Test rebuild of outdated grids """
+
+        from s3.s3gis import S3ClusterIndex
+
+        S3ClusterIndex.clear()
+        points = lambda: [(1, 0.0, 0.0)]
+        grid = S3ClusterIndex.get("test", (1, None), points)
+        self.assertTrue(S3ClusterIndex.get("test", (1, None), points) is grid)
+
+        points = lambda: [(1, 0.0, 0.0), (2, 0.0, 0.0)]
+        grid = S3ClusterIndex.get("test", (2, None), points)
+        cells = S3ClusterIndex.cells(grid, 0).values()
+        self.assertEqual(cells[0][0], 2)
+        S3ClusterIndex.clear()
+
+# =============================================================================
+class S3SpatialIndexTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        from s3.s3gis import S3SpatialIndex
+
+        current.auth.override = True
+        S3SpatialIndex.clear()
+        table = current.s3db.gis_location
+        self.location_id = table.insert(name="SpatialIndexTest",
+                                        lat=10.5,
+                                        lon=20.5,
+                                        lat_min=10.5,
+                                        lat_max=10.5,
+                                        lon_min=20.5,
+                                        lon_max=20.5)
+
+    # -------------------------------------------------------------------------
+    def testSearch(self):
+        """ Test bbox search and update of the spatial index """
+
+        from s3.s3gis import S3SpatialIndex
+
+        location_id = self.location_id
+
+        ids = S3SpatialIndex.search(20, 10, 21, 11)
+        self.assertTrue(location_id in ids)
+        ids = S3SpatialIndex.search(-21, -11, -20, -10)
+        self.assertFalse(location_id in ids)
+
+        # Too large for the index
+        self.assertEqual(S3SpatialIndex.search(-180, -90, 180, 90), None)
+
+        table = current.s3db.gis_location
+        current.db(table.id == location_id).update(lat=-10.5,
+                                                   lon=-20.5,
+                                                   lat_min=-10.5,
+                                                   lat_max=-10.5,
+                                                   lon_min=-20.5,
+                                                   lon_max=-20.5)
+        S3SpatialIndex.update(location_id)
+
+        ids = S3SpatialIndex.search(20, 10, 21, 11)
+        self.assertFalse(location_id in ids)
+        ids = S3SpatialIndex.search(-21, -11, -20, -10)
+        self.assertTrue(location_id in ids)
+
+    # -------------------------------------------------------------------------
+    def testQuery(self):
+        """ Test that the index never hides changes from other processes """
+
+        from s3.s3gis import S3SpatialIndex
+
+        location_id = self.location_id
+        db = current.db
+        table = current.s3db.gis_location
+
+        query = S3SpatialIndex.query(-21, -11, -20, -10)
+        self.assertNotEqual(query, None)
+        signature = S3SpatialIndex.signature
+
+        # Change without updating the index (like in another process)
+        import datetime
+        modified_on = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        db(table.id == location_id).update(lat=-10.5,
+                                           lon=-20.5,
+                                           lat_min=-10.5,
+                                           lat_max=-10.5,
+                                           lon_min=-20.5,
+                                           lon_max=-20.5,
+                                           modified_on=modified_on)
+        self.assertFalse(location_id in
+                         S3SpatialIndex.search(-21, -11, -20, -10))
+        query = S3SpatialIndex.query(-21, -11, -20, -10)
+        rows = db(query & (table.id == location_id)).select(table.id)
+        self.assertEqual(len(rows), 1)
+
+        # Updates in this process do not validate the signature
+        S3SpatialIndex.update(location_id)
+        self.assertEqual(S3SpatialIndex.signature, signature)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        from s3.s3gis import S3SpatialIndex
+
+        current.db.rollback()
+        S3SpatialIndex.clear()
+        current.auth.override = False
+
+# =============================================================================
+class S3GISCodecTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testFallback(self):
+        """ Test fallback to the stylesheets for special tables """
+
+        from s3.s3codec import S3Codec
+
+        current.auth.override = True
+        resource = current.manager.define_resource("gis", "location")
+        for format in ("geojson", "kml", "gpx"):
+            codec = S3Codec.get_codec(format)
+            self.assertEqual(codec.encode(resource), None)
+
+        resource = current.manager.define_resource("org", "office")
+        codec = S3Codec.get_codec("kml")
+        self.assertEqual(codec.encode(resource), None)
+
+    # -------------------------------------------------------------------------
+    def testGeoJSON(self):
+        """ Test native GeoJSON encoding of point features """
+
+        from gluon.contrib import simplejson as json
+        from s3.s3codec import S3Codec
+
+        current.auth.override = True
+        s3db = current.s3db
+        location_id = s3db.gis_location.insert(name="CodecTestLocation",
+                                                lat=10.5,
+                                                lon=20.5)
+        office_id = s3db.org_office.insert(name="CodecTestOffice",
+                                           location_id=location_id)
+
+        resource = current.manager.define_resource("org", "office",
+                                                   id=office_id)
+        codec = S3Codec.get_codec("geojson")
+        output = json.loads("".join(codec.encode(resource)))
+        self.assertEqual(output["type"], "Feature")
+        geometry = output["geometry"]
+        self.assertEqual(geometry["type"], "Point")
+        self.assertEqual(geometry["coordinates"], ["20.5000", "10.5000"])
+        self.assertEqual(output["properties"]["name"], "CodecTestOffice")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3GISTileTests,
+        S3SimplifiedTests,
+        S3LocationTreeRebuildTests,
+        S3ClusterIndexTests,
+        S3SpatialIndexTests,
+        S3GISCodecTests,
+    )
+
+# END ========================================================================
@@ -101,6 +101,58 @@ class S3ComponentDisambiguationTests(unittest.TestCase):
 
         current.db.rollback()
 
+# =============================================================================
+class S3ImportJobDeduplicationTests(unittest.TestCase):
+    """ Test UID-based deduplication in import jobs """
+
+    def setUp(self):
+
+        xmlstr = """
+<s3xml>
+    <resource name="hms_hospital" uuid="DEDUPTESTHOSPITAL1">
+        <data field="name">DedupTestHospital1</data>
+    </resource>
+    <resource name="hms_hospital" uuid="DEDUPTESTHOSPITAL2">
+        <data field="name">DedupTestHospital2</data>
+    </resource>
+    <resource name="hms_hospital" uuid="DEDUPTESTHOSPITAL2">
+        <data field="name">DedupTestHospital2Updated</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        self.tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+    def testDeduplicateByUID(self):
+        """ Test that repeated and existing UIDs update the same record """
+
+        db = current.db
+        s3db = current.s3db
+
+        current.auth.override = True
+        table = s3db.hms_hospital
+        record_id = table.insert(uuid="DEDUPTESTHOSPITAL1",
+                                 name="DedupTestHospital")
+
+        resource = current.manager.define_resource("hms", "hospital")
+        resource.import_xml(self.tree)
+
+        query = (table.uuid == "DEDUPTESTHOSPITAL1")
+        rows = db(query).select(table.id, table.name)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].id, record_id)
+        self.assertEqual(rows[0].name, "DedupTestHospital1")
+
+        query = (table.uuid == "DEDUPTESTHOSPITAL2")
+        rows = db(query).select(table.id, table.name)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].name, "DedupTestHospital2Updated")
+
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -118,6 +170,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3ComponentDisambiguationTests,
+        S3ImportJobDeduplicationTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# S3Report Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3report.py
+#
+import unittest
+from gluon import *
+
+from gluon.storage import Storage
+from s3.s3report import S3Report, S3ReportCache
+
+# =============================================================================
+class S3ReportAggregationTests(unittest.TestCase):
+    """ Tests for the incremental aggregation of report totals """
+
+    # -------------------------------------------------------------------------
+    def _totals(self, cells, method):
+        """ Combine the partial aggregates of cells into a total """
+
+        partial = None
+        for values in cells:
+            partial = S3Report._combine(partial,
+                                        S3Report._partial(values, method),
+                                        method)
+        return S3Report._total(partial, method)
+
+    # -------------------------------------------------------------------------
+    def testCount(self):
+
+        cells = [[1, 2, 3], [], [4]]
+        self.assertEqual(self._totals(cells, "count"), 4)
+        self.assertEqual(self._totals([[]], "count"), 0)
+
+    # -------------------------------------------------------------------------
+    def testSum(self):
+
+        cells = [[1, 2, 3], [], [4]]
+        self.assertEqual(self._totals(cells, "sum"), 10)
+        self.assertEqual(self._totals([[]], "sum"), 0)
+
+    # -------------------------------------------------------------------------
+    def testMinMax(self):
+
+        cells = [[5, 2, 3], [], [4]]
+        self.assertEqual(self._totals(cells, "min"), 2)
+        self.assertEqual(self._totals(cells, "max"), 5)
+        self.assertEqual(self._totals([[]], "min"), None)
+        self.assertEqual(S3Report._aggregate([], "max"), None)
+
+    # -------------------------------------------------------------------------
+    def testAvg(self):
+
+        cells = [[1, 2, 3], [], [6]]
+        self.assertEqual(self._totals(cells, "avg"), 3.0)
+        self.assertEqual(self._totals([[]], "avg"), 0.0)
+
+    # -------------------------------------------------------------------------
+    def testList(self):
+
+        cell = [1, 2]
+        cells = [cell, [], [3]]
+        self.assertEqual(self._totals(cells, "list"), [1, 2, 3])
+        self.assertEqual(self._totals([[]], "list"), None)
+
+        # Partial aggregates must not be modified by combining them
+        partial = S3Report._partial(cell, "list")
+        total = S3Report._combine(None, partial, "list")
+        S3Report._combine(total, [3], "list")
+        self.assertEqual(partial, [1, 2])
+
+    # -------------------------------------------------------------------------
+    def testRecordTotal(self):
+        """ Test that the overall record count counts distinct records """
+
+        # Record 1 expands into both columns
+        report = S3Report.__new__(S3Report)
+        report.resource = Storage(table=Storage(_id=Storage(name="id")))
+        report.lfields = Storage(id=Storage(tname="org_office", fname="id"))
+        report.records = Storage([(1, Storage(id=1)), (2, Storage(id=2))])
+        report.row = [Storage(value="A")]
+        report.col = [Storage(value="X"), Storage(value="Y")]
+        report.cell = [[Storage(records=[1, 2]), Storage(records=[1])]]
+        report.numrows = 1
+        report.numcols = 2
+        report.totals = Storage()
+
+        report._add_layer(None, "count")
+        layer = (None, "count")
+        self.assertEqual(report.cell[0][0][layer], 2)
+        self.assertEqual(report.cell[0][1][layer], 1)
+        self.assertEqual(report.totals[layer], 2)
+
+# =============================================================================
+class S3ReportCacheTests(unittest.TestCase):
+    """ Tests for the report cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        S3ReportCache.clear()
+
+    # -------------------------------------------------------------------------
+    def _report(self, numrecords):
+        """ Construct a minimal report object """
+
+        class Report(Storage):
+            def __len__(self):
+                return numrecords
+
+        report = Report()
+        for a in S3ReportCache.ATTRIBUTES:
+            report[a] = None
+        report.numrows = numrecords
+        return report
+
+    # -------------------------------------------------------------------------
+    def testStoreAndGet(self):
+
+        cache = S3ReportCache
+        cache.store("org_office:a", ("stamp1",), self._report(3), size=5)
+
+        data = cache.get("org_office:a", ("stamp1",))
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["numrows"], 3)
+
+        # Outdated stamp
+        self.assertEqual(cache.get("org_office:a", ("stamp2",)), None)
+        self.assertEqual(cache.get("org_office:a", ("stamp1",)), None)
+
+    # -------------------------------------------------------------------------
+    def testEviction(self):
+
+        cache = S3ReportCache
+        cache.store("org_office:a", ("stamp",), self._report(1), size=2)
+        cache.store("org_office:b", ("stamp",), self._report(1), size=2)
+
+        # Use a, so that b is the least recently used report
+        self.assertNotEqual(cache.get("org_office:a", ("stamp",)), None)
+        cache.store("org_office:c", ("stamp",), self._report(1), size=2)
+
+        self.assertNotEqual(cache.get("org_office:a", ("stamp",)), None)
+        self.assertEqual(cache.get("org_office:b", ("stamp",)), None)
+        self.assertNotEqual(cache.get("org_office:c", ("stamp",)), None)
+
+    # -------------------------------------------------------------------------
+    def testClear(self):
+
+        cache = S3ReportCache
+        cache.store("org_office:a", ("stamp",), self._report(1), size=5)
+        cache.store("org_organisation:a", ("stamp",), self._report(1), size=5)
+
+        cache.clear("org_office")
+        self.assertEqual(cache.get("org_office:a", ("stamp",)), None)
+        self.assertNotEqual(cache.get("org_organisation:a", ("stamp",)), None)
+
+    # -------------------------------------------------------------------------
+    def testReportCacheHit(self):
+        """ Test that an unchanged report is served from the cache """
+
+        settings = current.deployment_settings
+        cache_size = settings.ui.get("report_cache_size", None)
+        settings.ui.report_cache_size = 5
+        current.auth.override = True
+        try:
+            otable = current.s3db.org_organisation
+            otable.insert(name="ReportCacheTestOrg1", acronym="RCTO")
+            otable.insert(name="ReportCacheTestOrg2", acronym="RCTO")
+
+            define_resource = current.manager.define_resource
+            layers = [("name", "count")]
+
+            resource = define_resource("org", "organisation")
+            report = S3Report(resource, "acronym", None, layers)
+            self.assertFalse(report.empty)
+            self.assertEqual(len(S3ReportCache.reports), 1)
+
+            # Same report again => must not retrieve the records
+            def sqltable(*args, **kwargs):
+                raise AssertionError("report not served from the cache")
+            resource = define_resource("org", "organisation")
+            resource.sqltable = sqltable
+            cached = S3Report(resource, "acronym", None, layers)
+            self.assertEqual(cached.numrows, report.numrows)
+            self.assertEqual(cached.totals, report.totals)
+
+            # Changes to the cached report must not affect the cache
+            cached.row[0].value = "modified"
+            self.assertTrue(isinstance(cached.cell[0][0].records, tuple))
+            resource = define_resource("org", "organisation")
+            resource.sqltable = sqltable
+            again = S3Report(resource, "acronym", None, layers)
+            self.assertEqual(again.row[0].value, report.row[0].value)
+            self.assertEqual(list(again.cell[0][0].records),
+                             report.cell[0][0].records)
+
+            # Only the fields of rows, cols and facts are cached
+            record = again.records.values()[0]
+            self.assertEqual(record.keys(), ["org_organisation"])
+            self.assertEqual(sorted(record.org_organisation.keys()),
+                             ["acronym", "name"])
+            self.assertEqual(len(again), len(report))
+
+            # Clearing the table's reports works with the real cache keys
+            S3ReportCache.clear("org_organisation")
+            self.assertEqual(len(S3ReportCache.reports), 0)
+        finally:
+            settings.ui.report_cache_size = cache_size
+            current.db.rollback()
+            current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        S3ReportCache.clear()
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3ReportAggregationTests,
+        S3ReportCacheTests,
+    )
+
+# END ========================================================================
@@ -8,6 +8,7 @@
 import unittest
 import datetime
 from gluon import *
+from gluon.contrib import simplejson as json
 from gluon.storage import Storage
 
 # =============================================================================
@@ -115,6 +116,33 @@ class S3ResourceExportXMLTests(unittest.TestCase):
         self.assertTrue("lonmin" in attrib)
         self.assertTrue("lonmax" in attrib)
 
+    # -------------------------------------------------------------------------
+    def testExportStream(self):
+
+        xml = current.xml
+
+        current.auth.override = True
+        resource = current.manager.define_resource("org", "office", id=1)
+        output = "".join(resource.export_stream(start=0, limit=1,
+                                                dereference=False))
+
+        from lxml import etree
+        root = etree.fromstring(output)
+        self.assertEqual(root.tag, xml.TAG.root)
+        self.assertEqual(root.get("success"), "true")
+        self.assertEqual(root.get("results"), "1")
+
+        self.assertEqual(len(root), 1)
+        self.assertEqual(root[0].get("name"), "org_office")
+
+        resource = current.manager.define_resource("org", "office", id=1)
+        output = "".join(resource.export_stream(start=0, limit=1,
+                                                dereference=False,
+                                                as_json=True))
+        data = json.loads(output)
+        self.assertEqual(data["@results"], "1")
+        self.assertEqual(len(data["$_org_office"]), 1)
+
     # -------------------------------------------------------------------------
     def testExportTreeWithMSince(self):
         """ Test automatic ordering of export items by mtime if msince is given """
@@ -258,6 +286,118 @@ class S3ResourceExportXMLTests(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class S3ResourceFilterTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testSplitQuery(self):
+
+        from s3.s3resource import S3FieldSelector
+
+        resource = current.manager.define_resource("org", "organisation")
+        table = resource.table
+
+        real = S3FieldSelector("name") == "TestOrg"
+        virtual = S3FieldSelector("virtual_name") == "TestOrg"
+
+        query, vfltr = (real & virtual).split(resource)
+        self.assertEqual(str(query), str(table.name == "TestOrg"))
+        self.assertTrue(vfltr is virtual)
+
+        query, vfltr = (real | virtual).split(resource)
+        self.assertEqual(query, None)
+        self.assertEqual(vfltr.op, vfltr.OR)
+
+        query, vfltr = real.split(resource)
+        self.assertEqual(str(query), str(table.name == "TestOrg"))
+        self.assertEqual(vfltr, None)
+
+    # -------------------------------------------------------------------------
+    def testCountCache(self):
+
+        from s3.s3resource import S3CountCache
+
+        tablenames = set(["org_organisation", "org_office"])
+        S3CountCache.store("testkey", tablenames, 5)
+        self.assertEqual(S3CountCache.get("testkey", tablenames), 5)
+
+        # Write to any of the tables => invalidated
+        S3CountCache.invalidate("org_office")
+        self.assertEqual(S3CountCache.get("testkey", tablenames), None)
+
+        # Write to other tables => still valid
+        S3CountCache.store("testkey", tablenames, 6)
+        S3CountCache.invalidate("pr_person")
+        self.assertEqual(S3CountCache.get("testkey", tablenames), 6)
+        S3CountCache.invalidate("org_organisation")
+
+    # -------------------------------------------------------------------------
+    def testCount(self):
+
+        from s3.s3resource import S3FieldSelector
+
+        current.auth.override = True
+        table = current.s3db.org_organisation
+        for name in ("CountTestOrg1", "CountTestOrg2"):
+            table.insert(name=name)
+
+        resource = current.manager.define_resource("org", "organisation",
+                        filter=S3FieldSelector("name").like("CountTestOrg%"))
+        self.assertEqual(resource.count(), 2)
+        self.assertEqual(resource.count(distinct=True), 2)
+        self.assertEqual(resource.count(approximate=True), 2)
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testKeysetPagination(self):
+
+        from s3.s3resource import S3FieldSelector
+
+        current.auth.override = True
+        table = current.s3db.org_organisation
+        names = ["KeysetTestOrg%s" % i for i in (3, 1, 4, 5, 2)]
+        for name in names:
+            table.insert(name=name)
+        names.sort()
+
+        selector = S3FieldSelector("name").like("KeysetTestOrg%")
+        define_resource = current.manager.define_resource
+
+        # Page through the records
+        loaded = []
+        after = None
+        for i in xrange(3):
+            resource = define_resource("org", "organisation",
+                                       filter=selector)
+            rows = resource.load(limit=2, orderby="name", after=after)
+            loaded.extend([row.name for row in rows])
+            after = resource.get_cursor()
+            if i < 2:
+                self.assertNotEqual(after, None)
+        self.assertEqual(after, None)
+        self.assertEqual(loaded, names)
+
+        # Descending
+        resource = define_resource("org", "organisation", filter=selector)
+        rows = resource.load(limit=3, orderby=~table.name)
+        self.assertEqual([row.name for row in rows], names[:-4:-1])
+        after = resource.get_cursor()
+        resource = define_resource("org", "organisation", filter=selector)
+        rows = resource.load(limit=3, orderby=~table.name, after=after)
+        self.assertEqual([row.name for row in rows], names[1::-1])
+
+        # Cursor for a different orderby
+        resource = define_resource("org", "organisation", filter=selector)
+        self.assertRaises(SyntaxError, resource.load,
+                          limit=2, orderby="acronym", after=after)
+        self.assertRaises(SyntaxError, resource.load,
+                          limit=2, after="invalid")
+
+        current.auth.override = False
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -276,6 +416,7 @@ if __name__ == "__main__":
     run_suite(
         S3ResourceRepresentationTests,
         S3ResourceExportXMLTests,
+        S3ResourceFilterTests,
     )
 
 # END ========================================================================
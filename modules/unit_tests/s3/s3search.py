@@ -6,7 +6,8 @@
 import unittest
 
 from gluon import *
-from s3.s3search import S3SearchSimpleWidget, S3SearchOptionsWidget, S3SearchMinMaxWidget
+from s3.s3search import S3SearchSimpleWidget, S3SearchOptionsWidget, S3SearchMinMaxWidget, S3SearchLocationWidget, S3LocationNameIndex
+from s3.s3index import S3TextIndex
 
 # =============================================================================
 class TestS3SearchSimpleWidget(unittest.TestCase):
@@ -143,6 +144,212 @@ class TestS3SearchMinMaxWidget(unittest.TestCase):
                          str(INPUT(_name="wname", _id="id-wname", _class="wclass")))
 
 
+# =============================================================================
+class TestS3TextIndex(unittest.TestCase):
+    """
+        Test the token table backend of S3TextIndex
+    """
+
+    def setUp(self):
+
+        settings = current.deployment_settings
+        self.text_index = settings.search.get("text_index")
+        settings.search.text_index = "table"
+
+        current.auth.override = True
+        table = current.s3db.org_organisation
+        self.table = table
+        self.ids = []
+        for name, acronym in (("Text Index Test Organisation", "TITO"),
+                              ("Text Index Testing Ministry", "TITM")):
+            record_id = table.insert(name=name, acronym=acronym)
+            S3TextIndex(table).update(record_id)
+            self.ids.append(record_id)
+
+    def testTokens(self):
+        # Test tokenization
+        self.assertEqual(S3TextIndex.tokens("Red Cross, red crescent"),
+                         ["red", "cross", "crescent"])
+        self.assertEqual(S3TextIndex.tokens(None), [])
+
+    def testSearch(self):
+        # Test search by word prefixes
+        text_index = S3TextIndex(self.table)
+        self.assertTrue(text_index.indexed(["name", "acronym"]))
+        self.assertFalse(text_index.indexed(["website"]))
+
+        ids = text_index.search("text ind")
+        self.assertTrue(self.ids[0] in ids)
+        self.assertTrue(self.ids[1] in ids)
+
+        # Whole-word matches first
+        ids = text_index.search("index test")
+        self.assertEqual(ids[0], self.ids[0])
+
+        # Restrict to fields
+        ids = text_index.search("tito", fields=["name"])
+        self.assertEqual(ids, [])
+        ids = text_index.search("tito", fields=["acronym"])
+        self.assertEqual(ids, [self.ids[0]])
+
+        # Deleted records are removed from the index
+        text_index.delete(self.ids[1])
+        ids = text_index.search("ministry")
+        self.assertEqual(ids, [])
+
+    def testSimpleWidgetQuery(self):
+        # Test the simple search widget query with indexed fields
+        resource = current.manager.define_resource("org", "organisation")
+        widget = S3SearchSimpleWidget(field=["name", "acronym"])
+        query = widget.query(resource, "tito")
+        self.assertEqual(widget.indexed, ["name", "acronym"])
+
+        table = self.table
+        query = query.query(resource) & (table.id.belongs(self.ids))
+        rows = current.db(query).select(table.id)
+        self.assertEqual([row.id for row in rows], [self.ids[0]])
+
+    def tearDown(self):
+
+        current.deployment_settings.search.text_index = self.text_index
+        current.auth.override = False
+        current.db.rollback()
+
+# =============================================================================
+class TestS3LocationNameIndex(unittest.TestCase):
+    """
+        Test the location name index
+    """
+
+    def setUp(self):
+
+        current.auth.override = True
+        S3LocationNameIndex.clear()
+
+        table = current.s3db.gis_location
+        self.table = table
+        self.L0 = table.insert(name="Nameindex Land", level="L0")
+        table[self.L0] = dict(path=str(self.L0))
+        self.L1 = []
+        for name in ("Alpha Province", "Alpine Region", "Beta Province"):
+            record_id = table.insert(name=name,
+                                     level="L1",
+                                     parent=self.L0)
+            table[record_id] = dict(path="%s/%s" % (self.L0, record_id))
+            self.L1.append(record_id)
+
+    def testSearch(self):
+        # Test prefix search within a parent
+        index = S3LocationNameIndex
+        result = index.search("ALP", level="L1", parent=self.L0)
+        self.assertEqual(result, [(self.L1[0], "Alpha Province"),
+                                  (self.L1[1], "Alpine Region")])
+
+        # Test substring search in descendants
+        result = index.search("province", level="L1",
+                              parent=self.L0,
+                              descendants=True,
+                              prefix=False)
+        self.assertEqual([r[0] for r in result], [self.L1[0], self.L1[2]])
+
+    def testUpdate(self):
+        # Test incremental update of the index
+        index = S3LocationNameIndex
+        result = index.search("alp", level="L1", parent=self.L0)
+        self.assertEqual(len(result), 2)
+
+        self.table[self.L1[2]] = dict(name="Alpaca Province")
+        index.update(self.L1[2])
+        result = index.search("alp", level="L1", parent=self.L0)
+        self.assertEqual(result[0], (self.L1[2], "Alpaca Province"))
+        self.assertEqual(len(result), 3)
+
+    def testResultCache(self):
+        # Test that building other buckets keeps the cached results
+        index = S3LocationNameIndex
+        result = index.search("alp", level="L1", parent=self.L0)
+        version = index.version
+        index.search("nameindex", level="L0")
+        self.assertEqual(index.version, version)
+        key = ("alp", ("L1",), self.L0, False, True, None)
+        used = index.results[key]["used"]
+        self.assertEqual(index.search("alp", level="L1", parent=self.L0),
+                         result)
+        self.assertTrue(index.results[key]["used"] > used)
+
+    def tearDown(self):
+
+        S3LocationNameIndex.clear()
+        current.auth.override = False
+        current.db.rollback()
+
+# =============================================================================
+class TestS3LocationAncestors(unittest.TestCase):
+    """
+        Test the location closure table and its use in hierarchy lookups
+    """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        gis = current.gis
+        table = current.s3db.gis_location
+        self.L0 = table.insert(name="Closure Land", level="L0")
+        gis.update_location_tree(dict(id=self.L0, level="L0"))
+        self.L1 = table.insert(name="Closure Province",
+                               level="L1",
+                               parent=self.L0)
+        gis.update_location_tree(dict(id=self.L1, level="L1"))
+        self.L2 = table.insert(name="Closure District",
+                               level="L2",
+                               parent=self.L1)
+        gis.update_location_tree(dict(id=self.L2, level="L2"))
+
+    def testGetParents(self):
+        # Test ancestors, nearest first
+        parents = current.gis.get_parents(self.L2)
+        self.assertEqual([row.id for row in parents], [self.L1, self.L0])
+
+    def testGetChildren(self):
+        # Test descendants
+        children = current.gis.get_children(self.L0)
+        self.assertEqual(set([row.id for row in children]),
+                         set([self.L1, self.L2]))
+        children = current.gis.get_children(self.L0, level="L2")
+        self.assertEqual([row.id for row in children], [self.L2])
+
+    def testGetChildrenWithoutClosure(self):
+        # Test fallback to the path where the closure is not yet built
+        table = current.s3db.gis_location
+        L0 = table.insert(name="Pathland", level="L0")
+        table[L0] = dict(path="%s" % L0)
+        L1 = table.insert(name="Path Province", level="L1", parent=L0)
+        table[L1] = dict(path="%s/%s" % (L0, L1))
+        children = current.gis.get_children(L0)
+        self.assertEqual([row.id for row in children], [L1])
+
+    def testLocationWidgetQuery(self):
+        # Test the "within location" query of the location search widget
+        db = current.db
+        otable = current.s3db.org_office
+        office1 = otable.insert(name="Closure Office 1", location_id=self.L2)
+        office2 = otable.insert(name="Closure Office 2", location_id=self.L0)
+        office3 = otable.insert(name="Closure Office 3", location_id=self.L1)
+
+        resource = current.manager.define_resource("org", "office")
+        query = S3SearchLocationWidget.query(resource, str(self.L1))
+        query = query.query(resource) & \
+                (otable.id.belongs([office1, office2, office3]))
+        rows = db(query).select(otable.id)
+        self.assertEqual(set([row.id for row in rows]),
+                         set([office1, office3]))
+
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -162,6 +369,9 @@ if __name__ == "__main__":
         TestS3SearchSimpleWidget,
         TestS3SearchOptionsWidget,
         TestS3SearchMinMaxWidget,
+        TestS3TextIndex,
+        TestS3LocationNameIndex,
+        TestS3LocationAncestors,
     )
 
 # END ========================================================================
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# S3Sync Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3sync.py
+#
+import unittest
+from gluon import *
+
+# =============================================================================
+class S3SyncTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testCompress(self):
+        """ Test gzip compression of sync payloads """
+
+        from s3.s3sync import S3Sync
+
+        chunks = ["<s3xml>", "<resource name=\"org_organisation\"/>" * 100,
+                  "", "</s3xml>"]
+        data = "".join(S3Sync.compress(chunks))
+        self.assertEqual(data[:2], "\x1f\x8b")
+        self.assertTrue(len(data) < len("".join(chunks)))
+        self.assertEqual(S3Sync.decompress(data), "".join(chunks))
+
+        import gzip
+        from StringIO import StringIO
+        f = gzip.GzipFile(fileobj=StringIO(data))
+        self.assertEqual(f.read(), "".join(chunks))
+
+    # -------------------------------------------------------------------------
+    def testPagedExport(self):
+        """ Test paged export for sync by modified_on cursor """
+
+        current.auth.override = True
+        try:
+            xml = current.xml
+            manager = current.manager
+            otable = current.s3db.org_organisation
+
+            import datetime
+            msince = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+            for i in xrange(3):
+                otable.insert(name="SyncTestOrg%s" % i)
+
+            uids = []
+            cursor = None
+            while True:
+                resource = manager.define_resource("org", "organisation",
+                                                   include_deleted=True)
+                tree = resource.export_tree(limit=2,
+                                            msince=msince,
+                                            after=cursor,
+                                            dereference=False)
+                root = tree.getroot()
+                cursor = root.get(xml.ATTRIBUTE.next)
+                self.assertEqual(cursor, resource.get_cursor())
+                for element in root.findall("resource"):
+                    uids.append(element.get(xml.UID))
+                if not cursor:
+                    break
+            self.assertEqual(len(uids), len(set(uids)))
+            self.assertTrue(len(uids) >= 3)
+        finally:
+            current.db.rollback()
+            current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testOffsetPaging(self):
+        """ Test start/limit paging for peers which do not send cursors """
+
+        from s3.s3sync import S3Sync
+
+        xml = current.xml
+        next_start = S3Sync.next_start
+
+        # Peer without cursor support: page by start/limit
+        root = xml.tree([], start=0, limit=2, results=5).getroot()
+        self.assertEqual(next_start(root, None, 2), 2)
+        root = xml.tree([], start=2, limit=2, results=5).getroot()
+        self.assertEqual(next_start(root, 2, 2), 4)
+        root = xml.tree([], start=4, limit=2, results=5).getroot()
+        self.assertEqual(next_start(root, 4, 2), None)
+
+        # Peer ignoring the limit: everything received with the first page
+        root = xml.tree([], results=5).getroot()
+        self.assertEqual(next_start(root, None, 2), None)
+
+        # No results count: can not page
+        root = xml.tree([], limit=2).getroot()
+        self.assertEqual(next_start(root, None, 2), None)
+
+    # -------------------------------------------------------------------------
+    def testJournal(self):
+        """ Test the change journal for incremental synchronization """
+
+        from s3.s3sync import S3SyncJournal
+
+        settings = current.deployment_settings
+        journal = settings.sync.get("journal", None)
+        settings.sync.journal = True
+        current.auth.override = True
+        try:
+            db = current.db
+            s3db = current.s3db
+
+            otable = s3db.org_organisation
+            org1 = otable.insert(name="JournalTestOrg1")
+            org2 = otable.insert(name="JournalTestOrg2")
+            org3 = otable.insert(name="JournalTestOrg3")
+            since = S3SyncJournal.last()
+
+            # Plain DAL update => journaled
+            db(otable.id == org1).update(acronym="JTO1")
+
+            # Component change => master record
+            ftable = s3db.org_office
+            ftable.insert(name="JournalTestOffice", organisation_id=org2)
+
+            resource = current.manager.define_resource("org", "organisation")
+            ids = S3SyncJournal.changes(resource, since, overlap=0)
+            self.assertTrue(org1 in ids)
+            self.assertTrue(org2 in ids)
+            self.assertFalse(org3 in ids)
+
+            # Entries written shortly before the range are re-read
+            ids = S3SyncJournal.changes(resource, since)
+            self.assertTrue(org3 in ids)
+
+            # Nothing after the end of the journal
+            until = S3SyncJournal.last(since=since)
+            self.assertTrue(until > since)
+            self.assertEqual(S3SyncJournal.changes(resource, until,
+                                                   overlap=0), set())
+
+            # Deletion => journaled with the UUID
+            uuid = db(otable.id == org3).select(otable.uuid).first().uuid
+            db(otable.id == org3).delete()
+            jtable = S3SyncJournal.define_table()
+            query = (jtable.id > until) & \
+                    (jtable.tablename == "org_organisation") & \
+                    (jtable.record_id == org3)
+            row = db(query).select(jtable.uuid, jtable.operation).first()
+            self.assertNotEqual(row, None)
+            self.assertEqual(row.operation, "delete")
+            self.assertEqual(row.uuid, uuid)
+
+            # Inserts are journaled with the UUID the record gets
+            org4 = otable.insert(name="JournalTestOrg4")
+            uuid = db(otable.id == org4).select(otable.uuid).first().uuid
+            query = (jtable.tablename == "org_organisation") & \
+                    (jtable.record_id == org4)
+            row = db(query).select(jtable.uuid, jtable.operation).first()
+            self.assertEqual(row.operation, "create")
+            self.assertEqual(row.uuid, uuid)
+
+            # Hard-deleted component => master record
+            office = ftable.insert(name="JournalTestOffice4",
+                                   organisation_id=org4)
+            since = S3SyncJournal.last(since=until)
+            db(ftable.id == office).delete()
+            ids = S3SyncJournal.changes(resource, since, overlap=0)
+            self.assertEqual(ids, set([org4]))
+        finally:
+            settings.sync.journal = journal
+            current.db.rollback()
+            current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3SyncTests,
+    )
+
+# END ========================================================================
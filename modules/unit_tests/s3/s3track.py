@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# S3Track Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3track.py
+#
+import unittest
+from gluon import *
+
+# =============================================================================
+class S3TrackerTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        ptable = s3db.pr_person
+        self.person_ids = []
+        for name in ("TrackerTestPerson1", "TrackerTestPerson2"):
+            person_id = ptable.insert(first_name=name)
+            s3db.update_super(ptable, dict(id=person_id))
+            self.person_ids.append(person_id)
+
+        ltable = s3db.gis_location
+        self.location_id = ltable.insert(name="TrackerTestLocation",
+                                         lat=10.5,
+                                         lon=20.5)
+
+    # -------------------------------------------------------------------------
+    def testGetLocation(self):
+        """ Test bulk location lookup following check-ins """
+
+        from s3.s3track import S3Tracker
+
+        tracker = S3Tracker()
+        ptable = current.s3db.pr_person
+        person1, person2 = self.person_ids
+
+        tracker(ptable, person1).set_location(self.location_id)
+        tracker(ptable, person2).check_in(ptable, person1)
+
+        # Results in the order of the record IDs
+        trackable = tracker(ptable, [person2, person1])
+        locations = trackable.get_location(as_rows=True)
+        self.assertEqual(len(locations), 2)
+        for location in locations:
+            self.assertEqual(location.id, self.location_id)
+            self.assertEqual(location.lat, 10.5)
+
+        # Circular check-in => no location
+        tracker(ptable, person1).check_in(ptable, person2)
+        trackable = tracker(ptable, [person1, person2])
+        locations = trackable.get_location(as_rows=True)
+        self.assertEqual(len(locations), 2)
+        for location in locations:
+            self.assertEqual(location.lat, None)
+
+    # -------------------------------------------------------------------------
+    def testLatestPresence(self):
+        """ Test the lookup of the latest presence per track """
+
+        import datetime
+        from s3.s3track import S3Tracker
+
+        s3db = current.s3db
+        ptable = s3db.pr_person
+        table = s3db.sit_presence
+        person1, person2 = self.person_ids
+        trackable = S3Tracker()(ptable, [person1, person2])
+        tracks = dict((row.id, row.track_id) for row in trackable.records)
+        track1, track2 = tracks[person1], tracks[person2]
+
+        now = datetime.datetime.utcnow()
+        hour = datetime.timedelta(hours=1)
+        location_id = self.location_id
+        table.insert(track_id=track1, location_id=location_id,
+                     timestmp=now - 2 * hour)
+        # Same timestamp => the one with the highest ID
+        table.insert(track_id=track1, location_id=location_id,
+                     timestmp=now - hour)
+        latest = table.insert(track_id=track1, location_id=location_id,
+                              timestmp=now - hour)
+        # Deleted and future presences are ignored
+        table.insert(track_id=track1, location_id=location_id,
+                     timestmp=now - hour / 2, deleted=True)
+        table.insert(track_id=track1, location_id=location_id,
+                     timestmp=now + hour)
+        # The latest presence of the other track is older
+        other = table.insert(track_id=track2, location_id=location_id,
+                             timestmp=now - 3 * hour)
+
+        presences = trackable._S3Trackable__get_presences([track1, track2],
+                                                          now)
+        self.assertEqual(len(presences), 2)
+        self.assertEqual(presences[track1].id, latest)
+        self.assertEqual(presences[track2].id, other)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3TrackerTests,
+    )
+
+# END ========================================================================
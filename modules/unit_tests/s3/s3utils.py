@@ -177,6 +177,98 @@ class S3DataTableTests(unittest.TestCase):
                                           limit=2)
         self.assertEqual(len(table.rows), 1)
 
+# =============================================================================
+class S3BulkImporterTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testTaskOrder(self):
+        """ Test that import tasks are performed in the order of tasks.cfg """
+
+        import os
+        import shutil
+        import tempfile
+
+        path = tempfile.mkdtemp()
+        try:
+            for filename in ("config.xsl", "hierarchy.xsl"):
+                open(os.path.join(path, filename), "w").close()
+            tasks = open(os.path.join(path, "tasks.cfg"), "w")
+            tasks.write("gis,config,config.csv,config.xsl\n"
+                        "*,import_role,roles.csv\n"
+                        "gis,hierarchy,hierarchy.csv,hierarchy.xsl\n")
+            tasks.close()
+
+            performed = []
+            importer = S3BulkImporter()
+            importer.execute_import_task = \
+                lambda task: performed.append(task[2])
+            importer.execute_special_task = \
+                lambda task: performed.append(task[1])
+            importer.perform_tasks(path, processes=1)
+            self.assertEqual(importer.errorList, [])
+            self.assertEqual(performed,
+                             ["config", "import_role", "hierarchy"])
+        finally:
+            shutil.rmtree(path)
+
+    # -------------------------------------------------------------------------
+    def testSchedule(self):
+        """ Test that tasks run after the tasks writing what they reference """
+
+        import os
+        import shutil
+        import tempfile
+
+        path = tempfile.mkdtemp()
+        try:
+            stylesheets = {
+                "schedule_config.xsl": '''<resource name="gis_config">
+                                <reference field="default_location_id"
+                                           resource="gis_location"/>
+                              </resource>
+                              <resource name="gis_location"/>''',
+                "schedule_hierarchy.xsl": '''<resource name="gis_hierarchy">
+                                   <reference field="location_id" resource="gis_location"/>
+                                 </resource>''',
+                "schedule_post.xsl": '<resource name="cms_post"/>',
+                "schedule_office.xsl": '''<resource name="org_office">
+                                <reference field="organisation_id">
+                                  <xsl:attribute name="tuid">Org</xsl:attribute>
+                                </reference>
+                              </resource>''',
+                "schedule_organisation.xsl": '<resource name="org_organisation"/>',
+            }
+            for filename, xsl in stylesheets.items():
+                f = open(os.path.join(path, filename), "w")
+                f.write(xsl)
+                f.close()
+            tasks = open(os.path.join(path, "tasks.cfg"), "w")
+            tasks.write("gis,hierarchy,hierarchy.csv,schedule_hierarchy.xsl\n"
+                        "gis,config,config.csv,schedule_config.xsl\n"
+                        "gis,hierarchy,hierarchy.csv,schedule_hierarchy.xsl\n"
+                        "cms,post,post.csv,schedule_post.xsl\n"
+                        "org,organisation,organisation.csv,schedule_organisation.xsl\n"
+                        "org,office,office.csv,schedule_office.xsl\n"
+                        "*,import_role,roles.csv\n"
+                        "cms,post,post.csv,schedule_post.xsl\n")
+            tasks.close()
+
+            importer = S3BulkImporter()
+            importer.load_descriptor(path)
+            stages = [[(task[1], task[2]) if task[0] == 1 else task[1]
+                       for task in stage]
+                      for stage in importer.schedule(importer.tasks)]
+            self.assertEqual(stages, [[("gis", "hierarchy"),
+                                       ("cms", "post"),
+                                       ("org", "organisation")],
+                                      [("gis", "config"),
+                                       ("org", "office")],
+                                      [("gis", "hierarchy")],
+                                      ["import_role"],
+                                      [("cms", "post")]])
+        finally:
+            shutil.rmtree(path)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -196,6 +288,7 @@ if __name__ == "__main__":
         S3FKWrappersTests,
         S3SQLTableTests,
         S3DataTableTests,
+        S3BulkImporterTests,
     )
 
 # END ========================================================================
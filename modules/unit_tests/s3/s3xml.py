@@ -157,6 +157,41 @@ class S3JSONMessageTests(unittest.TestCase):
         self.assertEqual(len(tree), 1)
         self.assertEqual(tree["test"], "value")
 
+# =============================================================================
+class S3CSVTreeTests(unittest.TestCase):
+
+    def setUp(self):
+
+        from StringIO import StringIO
+        self.source = lambda: StringIO("name,code\n"
+                                       "Org1,O1\n"
+                                       "Org2,O2\n"
+                                       "Org3,O3\n")
+
+    def testCSV2Tree(self):
+
+        xml = current.xml
+        tree = xml.csv2tree(self.source(), resourcename="org_organisation")
+        root = tree.getroot()
+        self.assertEqual(root.tag, xml.TAG.table)
+        self.assertEqual(root.get(xml.ATTRIBUTE.name), "org_organisation")
+        self.assertEqual(len(root), 3)
+
+    def testCSV2TreesChunks(self):
+
+        xml = current.xml
+        trees = list(xml.csv2trees(self.source(), chunk_size=2))
+        self.assertEqual(len(trees), 2)
+        self.assertEqual(len(trees[0].getroot()), 2)
+        self.assertEqual(len(trees[1].getroot()), 1)
+
+        row = trees[1].getroot()[0]
+        cols = dict((col.get(xml.ATTRIBUTE.field), col.text) for col in row)
+        self.assertEqual(cols, {"name": "Org3", "code": "O3"})
+
+        trees = list(xml.csv2trees(self.source(), chunk_size=3))
+        self.assertEqual(len(trees), 1)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -175,6 +210,7 @@ if __name__ == "__main__":
     run_suite(
         S3JSONMessageTests,
         S3TreeBuilderTests,
+        S3CSVTreeTests,
     )
 
 # END ========================================================================
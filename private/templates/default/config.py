@@ -212,6 +212,8 @@ settings.L10n.decimal_separator = "."
 #settings.ui.label_postcode = T("ZIP Code")
 # Enable Social Media share buttons
 #settings.ui.social_buttons = True
+# Allow approximate record counts for pagination (faster for large lists)
+#settings.ui.approximate_counts = True
 
 # Request
 #settings.req.type_inv_label = T("Donations")
@@ -360,6 +362,15 @@ settings.L10n.decimal_separator = "."
 # Save Search Widget
 #settings.save_search.widget = False
 
+# Text index for simple searches, datatable filters and autocompletes
+# (True = PostgreSQL text search where available, else a token table)
+# - run static/scripts/tools/indexes.py after enabling this
+#settings.search.text_index = True
+
+# Journal record changes for incremental synchronization
+# (deltas are read from the journal instead of scanning the tables)
+#settings.sync.journal = True
+
 # Terms of Service to be able to Register on the system
 #settings.options.terms_of_service = T("Terms of Service\n\nYou have to be eighteen or over to register as a volunteer.")
 
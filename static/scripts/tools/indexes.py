@@ -37,3 +37,38 @@ try:
 except:
     # Index already present
     pass
+
+tablename = "gis_location_ancestor"
+s3db.table(tablename)
+field = "location_id"
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+except:
+    # Index already present
+    pass
+field = "ancestor_id"
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+except:
+    # Index already present
+    pass
+# Populate the closure table from the location paths
+if not db(db[tablename].id > 0).select(db[tablename].id, limitby=(0, 1)).first():
+    gis.rebuild_location_ancestors()
+    db.commit()
+
+tablename = "gis_location_simplified"
+s3db.table(tablename)
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(location_id, tolerance);" % (tablename, tablename))
+except:
+    # Index already present
+    pass
+
+# Text index for searches (if enabled in deployment settings)
+s3db.load_all_models()
+s3base.S3TextIndex.create_indexes()
+# Index the existing records
+for tablename in db.tables:
+    s3base.S3TextIndex(db[tablename]).rebuild()
+db.commit()